@@ -17,6 +17,7 @@ from bpy.props import BoolProperty
 from bpy.props import IntProperty
 from bpy.props import FloatProperty
 from bpy.props import EnumProperty
+from bpy.props import StringProperty
 
 def get_preset_item(self,context):
     preset_items=[]
@@ -40,6 +41,12 @@ class MMR_property(bpy.types.PropertyGroup):
     auto_select_mesh:BoolProperty(default=True,description="自动选择模型")
     auto_select_rigid_body:BoolProperty(default=True,description="自动选择刚体")
     extend_ribbon:BoolProperty(default=True,description="延展飘带区域")
+    split_cloth:BoolProperty(default=False,description="按相连部分拆分布料")
+    cloth_cache_dir:StringProperty(default='//mmr_cloth_cache',subtype='DIR_PATH',description="布料缓存目录")
+    cloth_bake_chunk:IntProperty(default=250,min=1,description="每段烘焙的帧数")
+    cloth_bake_workers:IntProperty(default=4,min=1,description="并行烘焙的进程数")
+    cloth_bake_timeout:IntProperty(default=3600,min=0,description="每个布料并行烘焙的最长秒数,超时的进程被结束,0为不限制")
+    rig_cache:BoolProperty(default=True,description="缓存生成的骨骼")
     debug:BoolProperty(default=False,description="debug")
     rig_preset_name:EnumProperty(
         items=mmr_operators.preset.get_rig_preset_item,
@@ -78,6 +85,10 @@ class MMR_property(bpy.types.PropertyGroup):
     extra_options1:bpy.props.BoolProperty(default=False,description="高级选项")
     extra_options2:bpy.props.BoolProperty(default=False,description="高级选项")
     mass_multiply_rate:FloatProperty(default=12.5,description="刚体质量倍率",min=0)
+    decimate_action:BoolProperty(default=False,description="导入FBX/BVH后精简逐帧烘焙的关键帧")
+    decimate_rotation:FloatProperty(default=0.5,min=0.001,description="旋转误差(度)")
+    decimate_translation:FloatProperty(default=0.001,min=0.00001,precision=4,description="位移误差")
+    decimate_per_bone:BoolProperty(default=True,description="同一骨骼的曲线共用关键帧")
     import_as_NLA_strip: bpy.props.BoolProperty(
         name='Import as NLA strip',
         description="Import as NLA strip",
@@ -108,6 +119,7 @@ class MikuMikuRig_1(Mmr_Panel_Base):
         layout.prop(mmr_property,'auto_shoulder',text="Shoulder IK")
         layout.prop(mmr_property,'solid_rig',text="Replace the controller")
         layout.prop(mmr_property,'pole_target',text="Use pole target")
+        layout.prop(mmr_property,'rig_cache',text="Cache generated rig")
 
 class MikuMikuRig_2(Mmr_Panel_Base):
     bl_idname="MMR_PT_panel_2"
@@ -166,6 +178,25 @@ class MikuMikuRig_4(Mmr_Panel_Base):
         layout.prop(mmr_property,'auto_select_mesh',text="Auto select mesh",toggle=True)
         layout.prop(mmr_property,'auto_select_rigid_body',text="Auto select rigid body",toggle=True)
         layout.prop(mmr_property,'extend_ribbon',text="Extend ribbon area",toggle=True)
+        layout.prop(mmr_property,'split_cloth',text="Split connected parts",toggle=True)
+        layout.label(text='Cloth cache:')
+        layout.prop(mmr_property,'cloth_cache_dir',text="Cache directory")
+        layout.prop(mmr_property,'cloth_bake_chunk',text="Frames per chunk")
+        row=layout.row()
+        row.operator("mmr.bake_cloth_cache",text="Bake cloth cache")
+        row.operator("mmr.refresh_cloth_cache",text="Refresh cache")
+        row.operator("mmr.clear_cloth_cache",text="Clear cache")
+        row=layout.row()
+        row.prop(mmr_property,'cloth_bake_workers',text="Workers")
+        row.prop(mmr_property,'cloth_bake_timeout',text="Timeout")
+        row.operator("mmr.bake_cloth_parallel",text="Bake in parallel")
+        #各布料的缓存状态和大小
+        #cache state and size of every cloth
+        cache_info=mmr_operators.cloth_cache.cache_info
+        if cache_info:
+            box=layout.box()
+            for line in mmr_operators.cloth_cache.summary_lines(cache_info):
+                box.label(text=line,translate=False)
         layout.label(text="This featur is developed in cooperation with")
         layout.label(text="UuuNyaa")
 
@@ -183,10 +214,14 @@ class MikuMikuRig_5(Mmr_Panel_Base):
         layout.label(text="作者:小威廉伯爵")
         layout.prop(mmr_property,'debug',text="Debug")
 
-def alert_error(title,message):
-    def draw(self,context):
-        self.layout.label(text=str(message))
-    bpy.context.window_manager.popup_menu(draw,title=title,icon='ERROR')
+        #最近一次阶段计时
+        #latest stage trace
+        last_trace=mmr_operators.trace.last_trace
+        if last_trace:
+            box=layout.box()
+            for line in mmr_operators.trace.summary_lines(last_trace):
+                box.label(text=line)
+            layout.operator("mmr.save_trace",text="Save trace")
 
 class_list=[MikuMikuRig_2,MikuMikuRig_4,MikuMikuRig_5]
 Model_list=[mmr_operators]
@@ -5,8 +5,12 @@ from . import rig
 from . import retarget
 from . import physics
 from . import extra
+from . import trace
+from . import infer
+from . import decimate
+from . import cloth_cache
 
-Model_list=[preset,rig,retarget,physics,extra]
+Model_list=[preset,rig,retarget,physics,extra,trace,infer,decimate,cloth_cache]
 
 def register():
     for Model in Model_list:
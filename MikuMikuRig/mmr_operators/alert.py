@@ -0,0 +1,29 @@
+import bpy
+import contextlib
+
+#提示信息在批量导入或后台运行时收集起来,而不是弹窗
+#messages are collected instead of shown as popups during batch runs
+#or when blender runs in background
+capture_stack=[]
+
+def alert_error(title,message):
+    if capture_stack:
+        capture_stack[-1].append((title,str(message)))
+        return
+    if bpy.app.background:
+        print(title+': '+str(message))
+        return
+    def draw(self,context):
+        self.layout.label(text=str(message))
+    bpy.context.window_manager.popup_menu(draw,title=title,icon='ERROR')
+
+#with capture_alert() as messages: 期间的提示写入messages
+#alerts raised inside the with block are appended to messages
+@contextlib.contextmanager
+def capture_alert():
+    messages=[]
+    capture_stack.append(messages)
+    try:
+        yield messages
+    finally:
+        capture_stack.pop()
@@ -0,0 +1,427 @@
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import tempfile
+import traceback
+import subprocess
+
+try:
+    from . import synthetic
+    from . import farm
+except ImportError:
+    sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+    import synthetic
+    import farm
+
+#性能测试
+#在后台blender中生成合成骨骼和动作,按不同规模给主要操作计时,
+#结果写入JSON,给出与基准文件的比值和每个操作的规模曲线斜率
+#benchmark suite, runs in background blender on synthetic rigs and clips,
+#times the hot operators at several sizes and writes JSON with the ratio
+#to a baseline file and the log-log scaling slope of every case
+#
+#python benchmark.py [--cases retarget_mixmao load_vmd] [--frames 1000 10000 100000]
+#                    [--rigid-bodies 32 128 512] [--output bench.json] [--baseline old.json]
+#blender -b --python benchmark.py -- [same arguments]
+#
+#除retarget_mixmao和retarget_bvh_importer外都需要mmd_tools,RIG2和之后的动作测试还需要rigify
+#every case but retarget_mixmao and retarget_bvh_importer needs mmd_tools,
+#RIG2 and the motion cases that use its result also need rigify
+
+default_frames=[1000,10000,100000]
+default_rigid_bodies=[32,128,512]
+case_list=['RIG2','retarget_mixmao','retarget_bvh_importer','load_vmd','export_vmd','convert_rigid_body_to_cloth','hide_skirt']
+#比基准慢这么多倍记为退化
+#slower than the baseline by this ratio counts as a regression
+regression_ratio=1.2
+
+#以下在blender中运行
+#everything below runs inside blender
+
+#合成MMD模型,骨骼名称来自MMD_JP预设,可以附带裙子骨骼,网格和刚体
+#synthetic MMD model named after the MMD_JP preset, optionally with skirt
+#bones, a skinned skirt mesh and rigid bodies with joints
+def build_mmd_model(addon,name='synthetic',columns=0,rows=0,subdivision=4):
+    import bpy
+    preset=addon.mmr_operators.preset
+    bpy.ops.wm.read_homefile(use_empty=True)
+    skeleton=synthetic.mmd_skeleton()
+    if columns>0:
+        skeleton+=synthetic.skirt_skeleton(columns,rows)
+
+    arm_data=bpy.data.armatures.new(name)
+    arm=bpy.data.objects.new(name,arm_data)
+    bpy.context.collection.objects.link(arm)
+    bpy.context.view_layer.objects.active=arm
+    arm.select_set(True)
+    bpy.ops.object.mode_set(mode='EDIT')
+    edit_bones=arm_data.edit_bones
+    for bone_name,parent,head,tail in skeleton:
+        edit_bone=edit_bones.new(bone_name)
+        edit_bone.head=head
+        edit_bone.tail=tail
+        if parent:
+            edit_bone.parent=edit_bones[parent]
+            edit_bone.use_connect=(edit_bones[parent].tail-edit_bone.head).length<1e-5
+    bpy.ops.object.mode_set(mode='OBJECT')
+
+    mesh_obj=None
+    if columns>0:
+        verts,faces,vertex_bone_names=synthetic.skirt_mesh(columns,rows,subdivision)
+        mesh=bpy.data.meshes.new(name+'_mesh')
+        mesh.from_pydata(verts,[],faces)
+        mesh.validate()
+        mesh_obj=bpy.data.objects.new(name+'_mesh',mesh)
+        bpy.context.collection.objects.link(mesh_obj)
+        mesh_obj.parent=arm
+        modifier=mesh_obj.modifiers.new('Armature','ARMATURE')
+        modifier.object=arm
+        group_dict={}
+        for i,bone_name in enumerate(vertex_bone_names):
+            group_dict.setdefault(bone_name,[]).append(i)
+        for bone_name,index_list in group_dict.items():
+            mesh_obj.vertex_groups.new(name=bone_name).add(index_list,1.0,'REPLACE')
+
+    bpy.ops.object.select_all(action='DESELECT')
+    bpy.context.view_layer.objects.active=arm
+    arm.select_set(True)
+    if mesh_obj:
+        mesh_obj.select_set(True)
+    bpy.ops.mmd_tools.convert_to_mmd_model()
+    for pose_bone in arm.pose.bones:
+        pose_bone.mmd_bone.name_j=synthetic.mmd_name_j(pose_bone.name)
+    preset.set_bone_type(arm.pose,preset.preset_dict_dict['rig']['MMD_JP'])
+
+    rigid_bodys=[]
+    if columns>0:
+        rigid_bodys=add_skirt_physics(arm,columns,rows)
+    return arm,mesh_obj,rigid_bodys
+
+#为裙子骨骼添加刚体,相邻刚体之间添加关节,第一节连到下半身的静态刚体
+#rigid bodies on the skirt bones, joints between neighbours and from the
+#first row to a static rigid body on 下半身
+def add_skirt_physics(arm,columns,rows):
+    import bpy
+
+    def add_rigid_body(bone_names,rigid_type):
+        bpy.ops.object.select_all(action='DESELECT')
+        bpy.context.view_layer.objects.active=arm
+        arm.select_set(True)
+        bpy.ops.object.mode_set(mode='POSE')
+        for pose_bone in arm.pose.bones:
+            pose_bone.bone.select=pose_bone.name in bone_names
+        bpy.ops.mmd_tools.rigid_body_add(rigid_type=rigid_type,rigid_shape='SPHERE',size=(0.02,0.02,0.02),collision_group_number=5 if rigid_type!='0' else 0)
+        bpy.ops.object.mode_set(mode='OBJECT')
+
+    skirt_names={'skirt_%02d_%02d'%(column,row) for column in range(columns) for row in range(rows)}
+    add_rigid_body({'下半身'},'0')
+    add_rigid_body(skirt_names,'1')
+    rigid_dict={}
+    for obj in bpy.data.objects:
+        if hasattr(obj,'mmd_rigid') and obj.mmd_rigid.bone:
+            rigid_dict[obj.mmd_rigid.bone]=obj
+
+    pair_list=[]
+    for column in range(columns):
+        pair_list.append(('下半身','skirt_%02d_00'%column))
+        for row in range(rows):
+            name='skirt_%02d_%02d'%(column,row)
+            if row>0:
+                pair_list.append(('skirt_%02d_%02d'%(column,row-1),name))
+            pair_list.append((name,'skirt_%02d_%02d'%((column+1)%columns,row)))
+    for i,(name1,name2) in enumerate(pair_list):
+        joint=bpy.data.objects.new('joint_%04d'%i,None)
+        bpy.context.collection.objects.link(joint)
+        bpy.context.view_layer.objects.active=joint
+        bpy.ops.rigidbody.constraint_add(type='GENERIC_SPRING')
+        joint.rigid_body_constraint.object1=rigid_dict[name1]
+        joint.rigid_body_constraint.object2=rigid_dict[name2]
+    return [rigid_dict[name] for name in sorted(skirt_names)]
+
+def select_objects(obj_list,active=None):
+    import bpy
+    if bpy.context.object and bpy.context.object.mode!='OBJECT':
+        bpy.ops.object.mode_set(mode='OBJECT')
+    bpy.ops.object.select_all(action='DESELECT')
+    for obj in obj_list:
+        obj.select_set(True)
+    bpy.context.view_layer.objects.active=active or obj_list[0]
+
+#RIG2生成的控制器骨骼保存为文件,动作测试直接打开
+#the rig generated by RIG2 is saved once and reopened by the motion cases
+def get_rigged_file(addon,work_dir):
+    import bpy
+    path=os.path.join(work_dir,'rigged.blend')
+    if not os.path.exists(path):
+        arm,mesh_obj,rigid_bodys=build_mmd_model(addon)
+        select_objects([arm])
+        if addon.mmr_operators.rig.RIG2(bpy.context)!=True:
+            raise RuntimeError('RIG2 failed')
+        bpy.ops.wm.save_as_mainfile(filepath=path,copy=True)
+    return path
+
+def open_rigged(addon,work_dir):
+    import bpy
+    bpy.ops.wm.open_mainfile(filepath=get_rigged_file(addon,work_dir))
+    for obj in bpy.data.objects:
+        if obj.type=='ARMATURE' and obj.name.endswith('_Rig'):
+            select_objects([obj])
+            return obj
+    raise RuntimeError('no rig in rigged file')
+
+def get_clip(work_dir,ext,frame_count,key_step):
+    path=os.path.join(work_dir,'clip_%d%s'%(frame_count,ext))
+    if not os.path.exists(path):
+        if ext=='.bvh':
+            synthetic.write_bvh(path,frame_count)
+        else:
+            synthetic.write_vmd(path,frame_count,key_step)
+    return path
+
+#每个测试返回(准备函数,计时函数),只给计时函数计时
+#every case returns (setup,run), only run is timed
+
+def case_RIG2(addon,size,work_dir,args):
+    import bpy
+    def setup():
+        arm,mesh_obj,rigid_bodys=build_mmd_model(addon)
+        select_objects([arm])
+    def run():
+        return addon.mmr_operators.rig.RIG2(bpy.context)
+    return setup,run
+
+def case_retarget_mixmao(addon,size,work_dir,args):
+    import bpy
+    retarget=addon.mmr_operators.retarget
+    clip=get_clip(work_dir,'.bvh',size,1)
+    def setup():
+        rig=farm.build_synthetic_rig('bench')
+        bpy.context.scene.mmr_property.retarget_preset_name='mixamo'
+        rig.animation_data_create()
+    def run():
+        return retarget.retarget_mixmao(farm.JobOptions(retarget.OT_Import_Mixamo,{},clip),bpy.context)
+    return setup,run
+
+#用blender的BVH导入代替原生读取,用于对比
+#blender's BVH import instead of the native reader, for comparison
+def case_retarget_bvh_importer(addon,size,work_dir,args):
+    import bpy
+    retarget=addon.mmr_operators.retarget
+    clip=get_clip(work_dir,'.bvh',size,1)
+    def setup():
+        rig=farm.build_synthetic_rig('bench')
+        bpy.context.scene.mmr_property.retarget_preset_name='mixamo'
+        rig.animation_data_create()
+    def run():
+        return retarget.retarget_mixmao(farm.JobOptions(retarget.OT_Import_Mixamo,{'native_reader':False},clip),bpy.context)
+    return setup,run
+
+def case_load_vmd(addon,size,work_dir,args):
+    import bpy
+    retarget=addon.mmr_operators.retarget
+    clip=get_clip(work_dir,'.vmd',size,args.key_step)
+    def setup():
+        open_rigged(addon,work_dir)
+    def run():
+        return retarget.load_vmd(farm.JobOptions(retarget.OT_Import_Vmd,{},clip),bpy.context)
+    return setup,run
+
+def case_export_vmd(addon,size,work_dir,args):
+    import bpy
+    retarget=addon.mmr_operators.retarget
+    clip=get_clip(work_dir,'.vmd',size,args.key_step)
+    output=os.path.join(work_dir,'export_%d.vmd'%size)
+    def setup():
+        rig=open_rigged(addon,work_dir)
+        if retarget.load_vmd(farm.JobOptions(retarget.OT_Import_Vmd,{},clip),bpy.context)!=True:
+            raise RuntimeError('load_vmd failed')
+        select_objects([rig])
+    def run():
+        return retarget.export_vmd(farm.JobOptions(retarget.OT_Export_Vmd,{},output),bpy.context)
+    return setup,run
+
+#刚体数量换算为裙子的列数和节数
+#rigid body count to skirt columns and rows
+def skirt_size(size):
+    rows=max(1,int(round(math.sqrt(size/2))))
+    columns=max(3,size//rows)
+    return columns,rows
+
+def case_convert_rigid_body_to_cloth(addon,size,work_dir,args):
+    import bpy
+    def setup():
+        arm,mesh_obj,rigid_bodys=build_mmd_model(addon,'synthetic',*skirt_size(size))
+        select_objects(rigid_bodys+[mesh_obj],rigid_bodys[0])
+    def run():
+        return addon.mmr_operators.physics.convert_rigid_body_to_cloth(bpy.context)
+    return setup,run
+
+def case_hide_skirt(addon,size,work_dir,args):
+    def setup():
+        arm,mesh_obj,rigid_bodys=build_mmd_model(addon,'synthetic',*skirt_size(size))
+        select_objects(rigid_bodys,rigid_bodys[0])
+    def run():
+        return addon.mmr_operators.extra.hide_skirt()
+    return setup,run
+
+case_function_dict={
+    'RIG2':case_RIG2,
+    'retarget_mixmao':case_retarget_mixmao,
+    'retarget_bvh_importer':case_retarget_bvh_importer,
+    'load_vmd':case_load_vmd,
+    'export_vmd':case_export_vmd,
+    'convert_rigid_body_to_cloth':case_convert_rigid_body_to_cloth,
+    'hide_skirt':case_hide_skirt,
+}
+
+def get_case_sizes(case,args):
+    if case=='RIG2':
+        return [len(synthetic.mmd_skeleton())]
+    if case in {'convert_rigid_body_to_cloth','hide_skirt'}:
+        return args.rigid_bodies
+    return args.frames
+
+#重复repeat次取最短时间,准备阶段不计时
+#best of repeat runs, setup is not timed
+def run_case(addon,case,size,work_dir,args):
+    import bpy
+    alert=addon.mmr_operators.alert
+    result={'case':case,'size':size,'seconds':None,'status':'done'}
+    seconds_list=[]
+    try:
+        setup,run=case_function_dict[case](addon,size,work_dir,args)
+        for i in range(args.repeat):
+            setup()
+            with alert.capture_alert() as messages:
+                start_time=time.perf_counter()
+                succeed=run()
+                seconds_list.append(time.perf_counter()-start_time)
+            if succeed is False or succeed=={False}:
+                raise RuntimeError(messages[-1][1] if messages else 'returned False')
+        result['seconds']=min(seconds_list)
+    except Exception as e:
+        traceback.print_exc()
+        result['status']='failed'
+        result['error']=repr(e)
+    print('%s\t%d\t%s'%(case,size,'%.3fs'%result['seconds'] if result['seconds']!=None else result['status']))
+    sys.stdout.flush()
+    return result
+
+#对数坐标下耗时对规模的斜率,1为线性,2为平方
+#log-log slope of time over size, 1 is linear and 2 quadratic
+def scaling_slope(point_list):
+    point_list=[(math.log(size),math.log(seconds)) for size,seconds in point_list if size>0 and seconds and seconds>0]
+    if len(point_list)<2:
+        return None
+    mean_x=sum(x for x,y in point_list)/len(point_list)
+    mean_y=sum(y for x,y in point_list)/len(point_list)
+    d=sum((x-mean_x)**2 for x,y in point_list)
+    if d==0:
+        return None
+    return sum((x-mean_x)*(y-mean_y) for x,y in point_list)/d
+
+#与基准比较,写入比值并列出退化的测试
+#compare with the baseline, add the ratios and list the regressions
+def compare_baseline(report,baseline,ratio_limit=regression_ratio):
+    baseline_dict={}
+    for result in baseline.get('results',[]):
+        if result.get('seconds'):
+            baseline_dict[(result['case'],result['size'])]=result['seconds']
+    regression_list=[]
+    for result in report['results']:
+        baseline_seconds=baseline_dict.get((result['case'],result['size']))
+        if baseline_seconds==None or not result['seconds']:
+            continue
+        result['baseline']=baseline_seconds
+        result['ratio']=result['seconds']/baseline_seconds
+        if result['ratio']>ratio_limit:
+            regression_list.append('%s:%d'%(result['case'],result['size']))
+    report['baseline_scaling']=baseline.get('scaling',{})
+    report['regressions']=regression_list
+    return regression_list
+
+def run_benchmark(args):
+    import bpy
+    addon=farm.load_addon()
+    work_dir=tempfile.mkdtemp(prefix='mmr_bench_')
+    report={
+        'blender':bpy.app.version_string,
+        'addon_version':'.'.join(str(i) for i in addon.bl_info.get('version',())),
+        'date':time.strftime('%Y-%m-%d %H:%M:%S'),
+        'repeat':args.repeat,
+        'key_step':args.key_step,
+        'results':[],
+    }
+    try:
+        for case in args.cases:
+            for size in get_case_sizes(case,args):
+                report['results'].append(run_case(addon,case,size,work_dir,args))
+    finally:
+        if args.keep:
+            print('test files kept in '+work_dir)
+        else:
+            shutil.rmtree(work_dir,ignore_errors=True)
+
+    report['scaling']={}
+    for case in args.cases:
+        point_list=[(result['size'],result['seconds']) for result in report['results'] if result['case']==case]
+        report['scaling'][case]=scaling_slope(point_list)
+
+    regression_list=[]
+    if args.baseline:
+        with open(args.baseline,'r',encoding='utf-8') as f:
+            baseline=json.load(f)
+        regression_list=compare_baseline(report,baseline,args.ratio)
+        for result in report['results']:
+            if 'ratio' in result:
+                print('%s\t%d\t%.3fs\tx%.2f'%(result['case'],result['size'],result['seconds'],result['ratio']))
+        if regression_list:
+            print('regressions: '+', '.join(regression_list))
+
+    with open(args.output,'w',encoding='utf-8') as f:
+        json.dump(report,f,indent=4,ensure_ascii=False)
+    print('benchmark written to '+args.output)
+    fail_number=len([result for result in report['results'] if result['status']!='done'])
+    if fail_number or (args.fail_on_regression and regression_list):
+        return 1
+    return 0
+
+def main(argv):
+    inside_blender='bpy' in sys.modules
+    #blender把"--"之后的参数留给脚本
+    #blender passes the arguments after "--" to the script
+    if '--' in argv:
+        argv=argv[argv.index('--')+1:]
+    parser=argparse.ArgumentParser(description='MikuMikuRig benchmark')
+    parser.add_argument('--cases',nargs='+',choices=case_list,default=case_list)
+    parser.add_argument('--frames',nargs='+',type=int,default=default_frames)
+    parser.add_argument('--rigid-bodies',nargs='+',type=int,default=default_rigid_bodies)
+    parser.add_argument('--key-step',type=int,default=1)
+    parser.add_argument('--repeat',type=int,default=1)
+    parser.add_argument('--output',default='mmr_benchmark.json')
+    parser.add_argument('--baseline')
+    parser.add_argument('--ratio',type=float,default=regression_ratio)
+    parser.add_argument('--fail-on-regression',action='store_true')
+    parser.add_argument('--keep',action='store_true')
+    parser.add_argument('--blender')
+    args=parser.parse_args(argv)
+    args.output=os.path.abspath(args.output)
+    if args.baseline:
+        args.baseline=os.path.abspath(args.baseline)
+
+    if inside_blender:
+        return run_benchmark(args)
+
+    #在普通python中运行时启动后台blender
+    #started from plain python, rerun inside background blender
+    command=[farm.find_blender(args.blender),'-b','--python-exit-code','1','--python',os.path.abspath(__file__),'--']+argv
+    if '--output' not in argv:
+        command+=['--output',args.output]
+    return subprocess.call(command)
+
+if __name__=='__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,286 @@
+import itertools
+import numpy as np
+from mathutils import Matrix,Vector
+from . import vector_math
+from . import preset
+
+#原生读取BVH:只解析骨架层级,MOTION部分分块读入NumPy数组,
+#不再导入临时骨骼和动作,结果与blender的BVH导入(四元数模式)一致
+#native BVH reader: only the hierarchy is parsed up front, the MOTION block
+#is streamed in chunks into NumPy arrays, so no temporary armature or action
+#is created. The result matches blender's BVH import in quaternion mode
+
+#与blender的BVH导入默认值一致:Y轴向上,-Z轴向前,缩放1,从第1帧开始
+#same as the defaults of blender's BVH import: Y up, -Z forward, scale 1, starts at frame 1
+global_matrix=np.array(((1,0,0),(0,0,-1),(0,1,0)),dtype=np.float64)
+frame_start=1
+#每次读取的帧数
+#frames read per chunk
+chunk_frames=4096
+
+channel_index_dict={
+    'Xposition':0,'Yposition':1,'Zposition':2,
+    'Xrotation':3,'Yrotation':4,'Zrotation':5,
+}
+
+#骨骼方向转矩阵,扭转为0,与blender的vec_roll_to_mat3一致
+#bone direction to matrix with zero roll, same as blender's vec_roll_to_mat3
+def vec_roll_to_mat3(vector):
+    vector=np.asarray(vector,dtype=np.float64)
+    length=np.linalg.norm(vector,axis=-1,keepdims=True)
+    length[length==0]=1
+    x,y,z=np.moveaxis(vector/length,-1,0)
+    theta=1+y
+    theta_alt=x*x+z*z
+    #接近-Y轴时theta_alt更精确
+    #near the negative Y axis theta_alt is more precise
+    theta=np.where(theta<=6.1e-3,theta_alt*0.5+theta_alt*theta_alt*0.125,theta)
+    negative_y=(theta<=6.1e-3)&(theta_alt<=2.5e-4*2.5e-4)
+    theta[negative_y]=1
+    mat=np.empty(vector.shape[:-1]+(3,3),dtype=np.float64)
+    mat[...,0,0]=1-x*x/theta
+    mat[...,1,0]=-x
+    mat[...,2,0]=-x*z/theta
+    mat[...,0,1]=x
+    mat[...,1,1]=y
+    mat[...,2,1]=z
+    mat[...,0,2]=-x*z/theta
+    mat[...,1,2]=-z
+    mat[...,2,2]=1-z*z/theta
+    mat[negative_y]=np.diag((-1.0,-1.0,1.0))
+    return mat
+
+class BvhMotion:
+
+    #只读取骨架层级和帧数,记录MOTION数据的起始位置
+    #read the hierarchy and the frame count, remember where the motion data starts
+    def __init__(self,filepath):
+        self.filepath=filepath
+        self.names=[]
+        self.parents=[]
+        offsets=[]
+        tails=[]
+        self.channels=[]
+        self.rotation_orders=[]
+        self.channel_count=0
+        self.frame_count=0
+        self.frame_time=0.0
+
+        stack=[]
+        in_end_site=False
+        with open(filepath,'rb') as f:
+            for raw_line in f:
+                words=raw_line.decode('utf-8',errors='replace').split()
+                if not words:
+                    continue
+                keyword=words[0]
+                if keyword in ('ROOT','JOINT'):
+                    self.parents.append(stack[-1] if stack else -1)
+                    stack.append(len(self.names))
+                    self.names.append(' '.join(words[1:]))
+                    offsets.append((0.0,0.0,0.0))
+                    tails.append(None)
+                    self.channels.append([-1]*6)
+                    self.rotation_orders.append('')
+                elif keyword=='End':
+                    in_end_site=True
+                elif keyword=='OFFSET':
+                    offset=tuple(float(word) for word in words[1:4])
+                    if in_end_site:
+                        tails[stack[-1]]=offset
+                    else:
+                        offsets[stack[-1]]=offset
+                elif keyword=='CHANNELS':
+                    joint=stack[-1]
+                    for name in words[2:]:
+                        index=channel_index_dict.get(name)
+                        if index!=None:
+                            self.channels[joint][index]=self.channel_count
+                            if index>=3:
+                                self.rotation_orders[joint]+=name[0]
+                        self.channel_count+=1
+                elif keyword=='}':
+                    if in_end_site:
+                        in_end_site=False
+                    else:
+                        stack.pop()
+                elif keyword=='MOTION':
+                    break
+            for raw_line in f:
+                words=raw_line.decode('utf-8',errors='replace').split()
+                if words[:1]==['Frames:']:
+                    self.frame_count=int(words[1])
+                elif words[:2]==['Frame','Time:']:
+                    self.frame_time=float(words[2])
+                    break
+            self.motion_offset=f.tell()
+
+        if len(self.names)==0:
+            raise ValueError('no joints in BVH file: '+str(filepath))
+        self.name_index_dict={name:i for i,name in enumerate(self.names)}
+        self.channels=np.array(self.channels,dtype=np.int64)
+        self.get_rest(np.array(offsets,dtype=np.float64),tails)
+
+    #与blender的BVH导入一致的静止姿态:头部在关节位置,尾部朝向子级平均位置或末端
+    #rest pose as blender's BVH import builds it: the head sits on the joint,
+    #the tail points to the End Site or the average of the children
+    def get_rest(self,offsets,tails):
+        joint_len=len(self.names)
+        self.head_local=offsets
+        head=np.empty((joint_len,3),dtype=np.float64)
+        children=[[] for i in range(joint_len)]
+        for i,parent in enumerate(self.parents):
+            head[i]=offsets[i] if parent<0 else head[parent]+offsets[i]
+            if parent>=0:
+                children[parent].append(i)
+        tail=np.empty((joint_len,3),dtype=np.float64)
+        for i in range(joint_len):
+            if tails[i]!=None:
+                tail[i]=head[i]+tails[i]
+            elif children[i]:
+                tail[i]=head[children[i]].mean(axis=0)
+            else:
+                tail[i]=head[i]
+            #长度为0的骨骼尾部沿Y轴加0.1
+            #zero length bones get their tail moved 0.1 along Y
+            if np.linalg.norm(tail[i]-head[i])<=0.001:
+                tail[i,1]+=0.1
+        self.head=head
+        self.tail=tail
+        self.rest_matrix=vec_roll_to_mat3(tail-head)
+
+    def get_frames(self,frame_len=None):
+        if frame_len==None:
+            frame_len=self.frame_count
+        return np.arange(frame_len,dtype=np.float64)+frame_start
+
+    def get_frame_range(self):
+        return (float(frame_start),float(frame_start+max(self.frame_count-1,1)))
+
+    #分块读取指定列,每块只保留需要的列,文件帧数不足时截断
+    #stream the given columns chunk by chunk, only those columns are kept,
+    #the result is cut short when the file has fewer frames than declared
+    def read_columns(self,columns,frame_limit=None):
+        frame_count=self.frame_count if frame_limit==None else min(frame_limit,self.frame_count)
+        columns=np.asarray(columns,dtype=np.int64)
+        data=np.empty((frame_count,len(columns)),dtype=np.float32)
+        row=0
+        with open(self.filepath,'rb') as f:
+            f.seek(self.motion_offset)
+            while row<frame_count:
+                lines=list(itertools.islice(f,min(chunk_frames,frame_count-row)))
+                if not lines:
+                    break
+                chunk=np.fromstring(b' '.join(lines),dtype=np.float32,sep=' ')
+                chunk_len=len(chunk)//self.channel_count
+                chunk=chunk[:chunk_len*self.channel_count].reshape(chunk_len,self.channel_count)
+                data[row:row+chunk_len]=chunk[:,columns]
+                row+=chunk_len
+                if chunk_len<len(lines):
+                    break
+        return data[:row]
+
+    #blender导入时写入的局部位置和四元数,(n,3)和(n,4),没有对应通道时为None
+    #local location and quaternion as blender's import keys them, (n,3) and
+    #(n,4), None for a joint without those channels
+    def convert_joint(self,joint,location_data,rotation_data):
+        mat=self.rest_matrix[joint]
+        locations=None
+        if location_data is not None:
+            locations=(location_data.astype(np.float64)-self.head_local[joint]) @ mat
+        quaternions=None
+        if rotation_data is not None:
+            euler=np.radians(rotation_data.astype(np.float64))
+            quaternions=vector_math.euler_to_quaternion(euler,self.rotation_orders[joint][::-1])
+            q_rest=vector_math.matrix_to_quaternion(mat)
+            quaternions=vector_math.quaternion_multiply(vector_math.quaternion_conjugate(q_rest),vector_math.quaternion_multiply(quaternions,q_rest))
+            quaternions=vector_math.quaternion_make_continuous(quaternions)
+        return locations,quaternions
+
+    #关节的位置列和旋转列,没有时为None
+    #location and rotation columns of a joint, None when missing
+    def get_joint_columns(self,joint):
+        channels=self.channels[joint]
+        location_columns=channels[:3] if (channels[:3]>=0).all() else None
+        rotation_columns=channels[3:] if (channels[3:]>=0).all() else None
+        return location_columns,rotation_columns
+
+    #一次读取所有需要的关节,逐个返回(名称,位置,四元数)
+    #read every requested joint in one pass, then yield (name,locations,quaternions)
+    def iter_joints(self,name_list):
+        column_list=[]
+        slice_list=[]
+        for name in name_list:
+            joint=self.name_index_dict[name]
+            column_slices=[]
+            for columns in self.get_joint_columns(joint):
+                if columns is None:
+                    column_slices.append(None)
+                else:
+                    column_slices.append(slice(len(column_list),len(column_list)+3))
+                    column_list+=columns.tolist()
+            slice_list.append((name,joint,column_slices))
+        data=self.read_columns(column_list)
+        for name,joint,(location_slice,rotation_slice) in slice_list:
+            location_data=data[:,location_slice] if location_slice else None
+            rotation_data=data[:,rotation_slice] if rotation_slice else None
+            locations,quaternions=self.convert_joint(joint,location_data,rotation_data)
+            yield name,locations,quaternions
+
+    #第一帧的姿态矩阵(骨架空间),用于以第一帧为静止姿态
+    #armature space pose matrices of the first frame, for first_frame_as_rest_pose
+    def get_first_pose(self):
+        joint_len=len(self.names)
+        rest=np.zeros((joint_len,4,4),dtype=np.float64)
+        rest[:,:3,:3]=self.rest_matrix
+        rest[:,:3,3]=self.head
+        rest[:,3,3]=1
+        pose=np.empty((joint_len,4,4),dtype=np.float64)
+        columns=[column for column in self.channels.ravel() if column>=0]
+        data=self.read_columns(sorted(set(columns)),1)
+        column_dict={column:i for i,column in enumerate(sorted(set(columns)))}
+        for joint in range(joint_len):
+            location_columns,rotation_columns=self.get_joint_columns(joint)
+            location_data=None
+            rotation_data=None
+            if len(data) and location_columns is not None:
+                location_data=data[:,[column_dict[column] for column in location_columns]]
+            if len(data) and rotation_columns is not None:
+                rotation_data=data[:,[column_dict[column] for column in rotation_columns]]
+            locations,quaternions=self.convert_joint(joint,location_data,rotation_data)
+            basis=np.identity(4)
+            if quaternions is not None:
+                basis[:3,:3]=vector_math.quaternion_to_matrix(quaternions[0])
+            if locations is not None:
+                basis[:3,3]=locations[0]
+            parent=self.parents[joint]
+            if parent<0:
+                pose[joint]=rest[joint] @ basis
+            else:
+                pose[joint]=pose[parent] @ np.linalg.inv(rest[parent]) @ rest[joint] @ basis
+        return pose
+
+    #重定向需要的源骨骼数据,格式与retarget.get_retarget_source相同
+    #source skeleton for the retarget, same layout as retarget.get_retarget_source
+    def get_retarget_source(self,preset_dict,first_frame_as_rest_pose):
+        from_dict={}
+        for name in self.names:
+            if name in preset_dict:
+                bone_type=preset_dict[name][0]
+                if preset.is_bone_type(bone_type):
+                    from_dict[bone_type]=name
+        matrix_world=np.identity(4)
+        matrix_world[:3,:3]=global_matrix
+        source={'from_dict':from_dict,'matrix_world':Matrix(matrix_world.tolist()),'matrix_local':{},'head_local':{},'matrix':{},'head':{}}
+        pose=self.get_first_pose() if first_frame_as_rest_pose else None
+        for name in from_dict.values():
+            joint=self.name_index_dict[name]
+            matrix_local=np.identity(4)
+            matrix_local[:3,:3]=self.rest_matrix[joint]
+            matrix_local[:3,3]=self.head[joint]
+            source['matrix_local'][name]=Matrix(matrix_local.tolist())
+            source['head_local'][name]=Vector(self.head[joint].tolist())
+            if pose is not None:
+                source['matrix'][name]=Matrix(pose[joint].tolist())
+                source['head'][name]=Vector(pose[joint,:3,3].tolist())
+        return source
@@ -0,0 +1,246 @@
+import os
+import sys
+import json
+import traceback
+
+try:
+    from . import farm
+except ImportError:
+    sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+    import farm
+
+#无界面命令行入口,参数为JSON字符串或JSON文件路径
+#结果以MMR_RESULT开头的一行JSON输出,退出码见下方
+#headless command line entry point, the argument is a JSON string or the path
+#of a JSON file, the result is printed as one JSON line starting with
+#MMR_RESULT and the exit code tells what went wrong
+#
+#blender -b character.blend --python cli.py -- '{"command": "generate_rig", "object": "miku", "preset": "MMD_JP", "output": "miku_rig.blend"}'
+#blender -b miku_rig.blend --python cli.py -- commands.json
+#blender -b miku_rig.blend --python-expr "import sys;sys.path.append('path/to/mmr_operators');import cli;sys.exit(cli.main(['{...}']))"
+#
+#命令 / commands:
+#{"command": "generate_rig", "object": "miku", "preset": "MMD_JP", "properties": {"auto_shoulder": true}, "output": "out.blend"}
+#{"command": "import_motion", "object": "miku_Rig", "clip": "dance.vmd", "options": {"native_reader": true}, "output": "out.blend"}
+#{"command": "export_vmd", "object": "miku_Rig", "clip": "walk.fbx", "output": "walk.vmd", "options": {"scale": 0.08}}
+#{"command": "convert_cloth", "objects": ["skirt_rigid_0", "skirt_rigid_1", "miku_mesh"], "output": "out.blend"}
+#多个命令写成{"commands": [...]},依次运行,遇到失败停止
+#several commands go in {"commands": [...]} and run in order until one fails
+#options是操作器的属性,properties是场景mmr_property的属性
+#options are operator properties, properties are scene.mmr_property values
+
+exit_done=0
+#操作返回失败,错误信息来自提示
+#the operation returned failure, the error comes from its alert
+exit_failed=1
+exit_bad_argument=2
+exit_not_found=3
+exit_exception=4
+
+result_prefix='MMR_RESULT '
+
+class CommandError(Exception):
+    def __init__(self,code,message):
+        Exception.__init__(self,message)
+        self.code=code
+
+def get_object(name,obj_type=None):
+    import bpy
+    if name:
+        obj=bpy.data.objects.get(name)
+        if obj==None:
+            raise CommandError(exit_not_found,'object not found: '+name)
+    else:
+        obj=bpy.context.view_layer.objects.active
+        if obj==None:
+            raise CommandError(exit_bad_argument,'no "object" given and no active object')
+    if obj_type and obj.type!=obj_type:
+        raise CommandError(exit_bad_argument,'%s is not %s'%(obj.name,obj_type.lower()))
+    return obj
+
+def get_path(command,key,must_exist=True):
+    path=command.get(key)
+    if not path:
+        raise CommandError(exit_bad_argument,'"%s" is required'%key)
+    path=os.path.abspath(path)
+    if must_exist and not os.path.exists(path):
+        raise CommandError(exit_not_found,'file not found: '+path)
+    return path
+
+def set_properties(command):
+    import bpy
+    mmr_property=bpy.context.scene.mmr_property
+    for name,value in command.get('properties',{}).items():
+        if not hasattr(mmr_property,name):
+            raise CommandError(exit_bad_argument,'unknown property: '+name)
+        setattr(mmr_property,name,value)
+
+def select_objects(obj_list,active):
+    import bpy
+    if bpy.context.object and bpy.context.object.mode!='OBJECT':
+        bpy.ops.object.mode_set(mode='OBJECT')
+    bpy.ops.object.select_all(action='DESELECT')
+    for obj in obj_list:
+        obj.select_set(True)
+    bpy.context.view_layer.objects.active=active
+
+def save_output(command,result):
+    import bpy
+    if command.get('output'):
+        path=get_path(command,'output',False)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        bpy.ops.wm.save_as_mainfile(filepath=path)
+        result['output']=path
+
+def import_clip(addon,rig,clip,options):
+    import bpy
+    retarget=addon.mmr_operators.retarget
+    select_objects([rig],rig)
+    rig.animation_data_create()
+    if clip.lower().endswith('.vmd'):
+        succeed=retarget.load_vmd(farm.JobOptions(retarget.OT_Import_Vmd,options,clip),bpy.context)
+    else:
+        succeed=retarget.retarget_mixmao(farm.JobOptions(retarget.OT_Import_Mixamo,options,clip),bpy.context)
+    select_objects([rig],rig)
+    return succeed
+
+def command_generate_rig(addon,command,result):
+    import bpy
+    preset=addon.mmr_operators.preset
+    mmd_arm=get_object(command.get('object'),'ARMATURE')
+    select_objects([mmd_arm],mmd_arm)
+    if command.get('preset'):
+        rig_preset_dict=preset.preset_dict_dict['rig']
+        if command['preset'] not in rig_preset_dict:
+            raise CommandError(exit_bad_argument,'unknown rig preset: '+command['preset'])
+        preset.set_bone_type(mmd_arm.pose,rig_preset_dict[command['preset']])
+    if addon.mmr_operators.rig.RIG2(bpy.context)!=True:
+        return False
+    result['rig']=bpy.context.view_layer.objects.active.name
+    save_output(command,result)
+    return True
+
+def command_import_motion(addon,command,result):
+    rig=get_object(command.get('object'),'ARMATURE')
+    clip=get_path(command,'clip')
+    if import_clip(addon,rig,clip,command.get('options',{}))!=True:
+        return False
+    if rig.animation_data.action:
+        result['action']=rig.animation_data.action.name
+    save_output(command,result)
+    return True
+
+def command_export_vmd(addon,command,result):
+    import bpy
+    retarget=addon.mmr_operators.retarget
+    rig=get_object(command.get('object'),'ARMATURE')
+    output=get_path(command,'output',False)
+    options=command.get('options',{})
+    if command.get('clip'):
+        if import_clip(addon,rig,get_path(command,'clip'),options)!=True:
+            return False
+    select_objects([rig],rig)
+    animation_data=rig.animation_data
+    #导出时动作必须是当前动作
+    #export reads the active action, take the last imported strip otherwise
+    if animation_data and animation_data.action==None and len(animation_data.nla_tracks)>0:
+        track=animation_data.nla_tracks[-1]
+        if len(track.strips)>0:
+            animation_data.action=track.strips[-1].action
+    os.makedirs(os.path.dirname(output),exist_ok=True)
+    if retarget.export_vmd(farm.JobOptions(retarget.OT_Export_Vmd,options,output),bpy.context)!=True:
+        return False
+    result['output']=output
+    return True
+
+def command_convert_cloth(addon,command,result):
+    import bpy
+    name_list=command.get('objects')
+    if not name_list:
+        raise CommandError(exit_bad_argument,'"objects" is required')
+    obj_list=[get_object(name) for name in name_list]
+    rigid_body_list=[obj for obj in obj_list if getattr(obj,'mmd_type',None)=='RIGID_BODY']
+    select_objects(obj_list,rigid_body_list[0] if rigid_body_list else obj_list[0])
+    object_set=set(bpy.data.objects)
+    if addon.mmr_operators.physics.convert_rigid_body_to_cloth(bpy.context)==False:
+        return False
+    result['objects']=[obj.name for obj in bpy.data.objects if obj not in object_set]
+    save_output(command,result)
+    return True
+
+command_function_dict={
+    'generate_rig':command_generate_rig,
+    'import_motion':command_import_motion,
+    'export_vmd':command_export_vmd,
+    'convert_cloth':command_convert_cloth,
+}
+
+def run_command(addon,command):
+    alert=addon.mmr_operators.alert
+    name=command.get('command')
+    result={'command':name,'code':exit_done,'messages':[]}
+    try:
+        if name not in command_function_dict:
+            raise CommandError(exit_bad_argument,'unknown command: %s, expected one of %s'%(name,', '.join(command_function_dict)))
+        set_properties(command)
+        with alert.capture_alert() as messages:
+            try:
+                succeed=command_function_dict[name](addon,command,result)
+            finally:
+                result['messages']=[message for title,message in messages]
+        if succeed!=True:
+            result['code']=exit_failed
+            result['error']=result['messages'][-1] if result['messages'] else name+' failed'
+    except CommandError as e:
+        result['code']=e.code
+        result['error']=str(e)
+    except Exception as e:
+        traceback.print_exc()
+        result['code']=exit_exception
+        result['error']=repr(e)
+    return result
+
+def read_argument(argument):
+    if os.path.exists(argument):
+        with open(argument,'r',encoding='utf-8') as f:
+            return json.load(f)
+    return json.loads(argument)
+
+#运行命令,返回退出码和每个命令的结果
+#run the commands, returns the exit code and the result of every command
+def run(argument):
+    if isinstance(argument,dict):
+        command_list=argument.get('commands',[argument])
+    else:
+        command_list=argument
+    addon=farm.load_addon()
+    result_list=[]
+    code=exit_done
+    for command in command_list:
+        result=run_command(addon,command)
+        result_list.append(result)
+        print(result_prefix+json.dumps(result,ensure_ascii=False))
+        sys.stdout.flush()
+        if result['code']!=exit_done:
+            code=result['code']
+            break
+    return code,result_list
+
+def main(argv):
+    #blender把"--"之后的参数留给脚本
+    #blender passes the arguments after "--" to the script
+    if '--' in argv:
+        argv=argv[argv.index('--')+1:]
+    if len(argv)!=1:
+        print(result_prefix+json.dumps({'code':exit_bad_argument,'error':'expected one JSON argument or JSON file'}))
+        return exit_bad_argument
+    try:
+        argument=read_argument(argv[0])
+    except (OSError,ValueError) as e:
+        print(result_prefix+json.dumps({'code':exit_bad_argument,'error':'invalid JSON: '+str(e)}))
+        return exit_bad_argument
+    code,result_list=run(argument)
+    return code
+
+if __name__=='__main__':
+    sys.exit(main(sys.argv[1:]))
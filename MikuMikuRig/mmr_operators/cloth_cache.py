@@ -0,0 +1,510 @@
+import bpy
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+from bpy.types import Operator
+from . import fcurve_utils
+from . import cloth_farm
+from .alert import alert_error
+from .retarget_cache import hash_array
+
+#布料磁盘缓存:生成的布料默认使用内存缓存,长动作占用大量内存,重新打开文件后也会丢失
+#按帧段写入磁盘缓存,每段完成后记录进度,中断后从最后完成的帧继续,
+#全部完成后把缓存文件移到项目缓存目录,作为外部缓存链接到布料
+#驱动布料的动作或布料设置的哈希变化后,缓存失效并被删除
+#cloth disk cache: generated cloth uses the in-memory point cache, which eats
+#RAM on long clips and is lost on reload. Frames go to disk in chunks and the
+#progress is recorded after every chunk, so an interrupted bake resumes from
+#the last finished frame. A finished bake is moved into the project cache
+#directory and linked to the cloth as an external cache, and it is evicted
+#once the hash of the driving animation or of the cloth settings changes
+
+cloth_modifier_name='mmd_cloth'
+manifest_name='manifest.json'
+
+#物体名称:缓存状态,烘焙和刷新后更新,面板只读取这里
+#object name: cache status, updated by bakes and refreshes, the panel only reads this
+cache_info={}
+
+def get_cloth_modifier(obj):
+    if obj==None or obj.type!='MESH':
+        return None
+    mod=obj.modifiers.get(cloth_modifier_name)
+    if mod==None or mod.type!='CLOTH':
+        return None
+    return mod
+
+def get_all_cloth_objects(scene):
+    return [obj for obj in scene.objects if get_cloth_modifier(obj)]
+
+#选中的布料,没有选中时为场景中所有布料
+#the selected cloth objects, or every cloth object of the scene
+def get_cloth_objects(context):
+    obj_list=[obj for obj in context.selected_objects if get_cloth_modifier(obj)]
+    if len(obj_list)==0:
+        obj_list=get_all_cloth_objects(context.scene)
+    return obj_list
+
+#缓存文件名只能用安全字符,加上名称的哈希区分中文名称
+#cache file names only take safe characters, the name hash keeps non-ascii names apart
+def get_cache_name(obj):
+    safe_name=re.sub(r'[^0-9A-Za-z_\-]','_',obj.name)
+    return 'mmr_%s_%s'%(safe_name,hashlib.sha1(obj.name.encode('utf-8')).hexdigest()[:8])
+
+def get_cache_dir(mmr_property):
+    return bpy.path.abspath(mmr_property.cloth_cache_dir)
+
+def get_object_dir(cache_dir,obj):
+    return os.path.join(cache_dir,get_cache_name(obj))
+
+#烘焙时blender把磁盘缓存写在文件旁的blendcache_文件名目录
+#while baking blender writes the disk cache next to the blend file
+def get_bake_dir():
+    name=os.path.splitext(os.path.basename(bpy.data.filepath))[0]
+    return bpy.path.abspath('//blendcache_'+name)
+
+#目录中一个缓存的帧:路径
+#frame: path of one cache in a directory
+def list_frames(directory,cache_name):
+    pattern=re.compile(re.escape(cache_name)+r'_(\d{6})_\d{2}\.bphys$')
+    frame_dict={}
+    if os.path.isdir(directory):
+        for entry in os.scandir(directory):
+            match=pattern.match(entry.name)
+            if match:
+                frame_dict[int(match.group(1))]=entry.path
+    return frame_dict
+
+def get_size(frame_dict):
+    size=0
+    for path in frame_dict.values():
+        try:
+            size+=os.path.getsize(path)
+        except OSError:
+            pass
+    return size
+
+def hash_action(sha,action):
+    if action==None:
+        return
+    for fcurve in action.fcurves:
+        if fcurve.mute:
+            continue
+        sha.update(('%s\1%d\1'%(fcurve.data_path,fcurve.array_index)).encode('utf-8'))
+        keyframe_points=fcurve.keyframe_points
+        for name in ('co','handle_left','handle_right'):
+            array=np.empty(len(keyframe_points)*2,dtype=np.float32)
+            keyframe_points.foreach_get(name,array)
+            hash_array(sha,array)
+        hash_array(sha,fcurve_utils.foreach_get_enum(keyframe_points,'interpolation',fcurve_utils.interpolation_enum))
+
+#动画:当前动作和NLA片段的关键帧,骨骼约束的目标物体一起计算
+#animation: keys of the active action and the NLA strips, following the
+#targets of the bone constraints
+def hash_animation(sha,obj,visited):
+    if obj==None or obj in visited:
+        return
+    visited.add(obj)
+    sha.update(obj.name.encode('utf-8'))
+    animation_data=obj.animation_data
+    if animation_data:
+        action_list=[animation_data.action]
+        for track in animation_data.nla_tracks:
+            if track.mute:
+                continue
+            for strip in track.strips:
+                if strip.mute:
+                    continue
+                sha.update(json.dumps([strip.frame_start,strip.frame_end,strip.action_frame_start,strip.action_frame_end,
+                    strip.scale,strip.repeat,strip.blend_type,strip.influence,strip.blend_in,strip.blend_out]).encode('utf-8'))
+                action_list.append(strip.action)
+        for action in action_list:
+            hash_action(sha,action)
+    if obj.type=='ARMATURE':
+        for pose_bone in obj.pose.bones:
+            for constraint in pose_bone.constraints:
+                hash_animation(sha,getattr(constraint,'target',None),visited)
+
+#结构体的所有数值属性
+#every value property of a struct
+def hash_settings(sha,struct):
+    value_list=[]
+    for prop in struct.bl_rna.properties:
+        if prop.identifier=='rna_type' or prop.type in ('POINTER','COLLECTION'):
+            continue
+        value=getattr(struct,prop.identifier)
+        if isinstance(value,set):
+            value=sorted(value)
+        elif isinstance(value,float):
+            value=round(value,6)
+        elif hasattr(value,'__len__') and not isinstance(value,str):
+            value=[round(v,6) if isinstance(v,float) else v for v in value]
+        value_list.append([prop.identifier,value])
+    sha.update(json.dumps(value_list).encode('utf-8'))
+
+#布料网格,钉固权重,布料之前的修改器,布料和碰撞设置,
+#以及布料物体,父级和驱动骨骼的动画
+#cloth mesh, pin weights, the modifiers before the cloth, the cloth and
+#collision settings, and the animation of the cloth object, its parent and
+#the driving armature
+def get_hash(obj):
+    mod=get_cloth_modifier(obj)
+    scene=bpy.context.scene
+    sha=hashlib.sha1()
+    hash_array(sha,[scene.render.fps/scene.render.fps_base,scene.use_gravity]+list(scene.gravity))
+
+    mesh=obj.data
+    co=np.empty(len(mesh.vertices)*3,dtype=np.float32)
+    mesh.vertices.foreach_get('co',co)
+    hash_array(sha,co)
+    edge_vertices=np.empty(len(mesh.edges)*2,dtype=np.int64)
+    mesh.edges.foreach_get('vertices',edge_vertices)
+    sha.update(edge_vertices.tobytes())
+    sha.update('\0'.join(vertex_group.name for vertex_group in obj.vertex_groups).encode('utf-8'))
+    hash_array(sha,[(vertex.index,element.group,element.weight) for vertex in mesh.vertices for element in vertex.groups])
+
+    visited=set()
+    hash_animation(sha,obj,visited)
+    hash_animation(sha,obj.parent,visited)
+    for modifier in obj.modifiers:
+        if modifier==mod:
+            break
+        sha.update(('%s\1%s\1%s\1'%(modifier.name,modifier.type,modifier.show_viewport)).encode('utf-8'))
+        hash_animation(sha,getattr(modifier,'object',None),visited)
+    for struct in (mod.settings,mod.settings.effector_weights,mod.collision_settings):
+        hash_settings(sha,struct)
+    return sha.hexdigest()
+
+def read_manifest(obj_dir):
+    path=os.path.join(obj_dir,manifest_name)
+    if os.path.exists(path):
+        try:
+            with open(path,'r',encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError,ValueError):
+            pass
+    return None
+
+#先写临时文件再替换,中断时不会留下写了一半的记录
+#written to a temporary file first, an interruption never leaves half a manifest
+def write_manifest(obj_dir,manifest):
+    os.makedirs(obj_dir,exist_ok=True)
+    path=os.path.join(obj_dir,manifest_name)
+    with open(path+'.tmp','w',encoding='utf-8') as f:
+        json.dump(manifest,f,indent=4,ensure_ascii=False)
+    os.replace(path+'.tmp',path)
+
+#缓存属性的更新回调会清空未烘焙的缓存,只在值不同时写入
+#the update callbacks of cache properties clear unbaked frames, so only
+#changed values are written
+def set_value(struct,name,value):
+    if getattr(struct,name)!=value:
+        setattr(struct,name,value)
+
+#把目录中的缓存文件链接为外部缓存,已经链接时重新读取
+#link the cache files of a directory as an external cache, relinking reloads them
+def link_cache(obj,obj_dir):
+    point_cache=get_cloth_modifier(obj).point_cache
+    if point_cache.use_external:
+        point_cache.use_external=False
+    set_value(point_cache,'name',get_cache_name(obj))
+    set_value(point_cache,'filepath',bpy.path.relpath(obj_dir))
+    point_cache.use_external=True
+
+#删除缓存文件和记录,布料恢复为未烘焙的缓存
+#delete the cache files and the manifest, the cloth is left unbaked
+def clear_cache(obj,cache_dir):
+    point_cache=get_cloth_modifier(obj).point_cache
+    cache_name=get_cache_name(obj)
+    obj_dir=get_object_dir(cache_dir,obj)
+    set_value(point_cache,'use_external',False)
+    if point_cache.is_baked:
+        with bpy.context.temp_override(point_cache=point_cache):
+            bpy.ops.ptcache.free_bake()
+    for directory in (obj_dir,get_bake_dir()):
+        for path in list_frames(directory,cache_name).values():
+            os.remove(path)
+    manifest_path=os.path.join(obj_dir,manifest_name)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    cache_info.pop(obj.name,None)
+
+#哈希和帧范围相同且磁盘上的帧完整时返回记录,完成的或可以继续的缓存
+#returns the manifest of a finished or resumable cache, that is when the hash
+#and frame range match and its frames are all on disk
+def check_manifest(obj,cache_dir,frame_start,frame_end):
+    cache_name=get_cache_name(obj)
+    obj_dir=get_object_dir(cache_dir,obj)
+    manifest=read_manifest(obj_dir)
+    if manifest==None or manifest['frame_start']!=frame_start or manifest['frame_end']!=frame_end:
+        return None
+    if manifest['hash']!=get_hash(obj):
+        return None
+    if manifest['finished']:
+        frame_dict=list_frames(obj_dir,cache_name)
+    else:
+        frame_dict=list_frames(get_bake_dir(),cache_name)
+    if all(frame in frame_dict for frame in range(frame_start,manifest['baked_frame']+1)):
+        return manifest
+    return None
+
+#可以继续的缓存保留,否则清除后从头开始
+#a resumable cache is kept, anything else is cleared and started over
+def prepare_object(obj,cache_dir,frame_start,frame_end):
+    point_cache=get_cloth_modifier(obj).point_cache
+    cache_name=get_cache_name(obj)
+    obj_dir=get_object_dir(cache_dir,obj)
+    manifest=check_manifest(obj,cache_dir,frame_start,frame_end)
+    if manifest!=None and manifest['finished']:
+        return {'obj':obj,'obj_dir':obj_dir,'cache_name':cache_name,'manifest':manifest}
+
+    if manifest==None:
+        clear_cache(obj,cache_dir)
+        manifest={
+            'object':obj.name,
+            'hash':get_hash(obj),
+            'frame_start':frame_start,
+            'frame_end':frame_end,
+            'baked_frame':frame_start-1,
+            'finished':False,
+            'seconds':0.0,
+        }
+        write_manifest(obj_dir,manifest)
+    #中断后重新打开的文件里缓存设置没有保存,继续烘焙前也要重新设置,
+    #否则之后的帧只写入内存缓存
+    #the file reopened after an interruption has not saved the cache
+    #settings, so a resumed bake sets them again or the remaining frames only
+    #go to the in-memory cache
+    set_value(point_cache,'use_disk_cache',True)
+    set_value(point_cache,'name',cache_name)
+    set_value(point_cache,'frame_start',frame_start)
+    set_value(point_cache,'frame_end',frame_end)
+    return {'obj':obj,'obj_dir':obj_dir,'cache_name':cache_name,'manifest':manifest}
+
+#烘焙完成:帧文件移到项目缓存目录并链接
+#a finished bake: move the frames into the project cache directory and link them
+def finish_object(state):
+    obj_dir=state['obj_dir']
+    manifest=state['manifest']
+    frame_dict=list_frames(get_bake_dir(),state['cache_name'])
+    #有帧没有写入磁盘时不算完成,删除记录,下次烘焙从头开始
+    #frames missing on disk do not count as finished, the manifest is
+    #deleted so the next bake starts over
+    if not all(frame in frame_dict for frame in range(manifest['frame_start'],manifest['frame_end']+1)):
+        os.remove(os.path.join(obj_dir,manifest_name))
+        return
+    os.makedirs(obj_dir,exist_ok=True)
+    for path in frame_dict.values():
+        shutil.move(path,os.path.join(obj_dir,os.path.basename(path)))
+    manifest['finished']=True
+    write_manifest(obj_dir,manifest)
+    link_cache(state['obj'],obj_dir)
+
+#按场景帧范围分段烘焙,所有布料一起逐帧模拟,返回每个物体的记录
+#bake the scene frame range in chunks, every cloth steps through the frames
+#together, returns the manifest of every object
+def bake_objects(context,obj_list,cache_dir,chunk_frames):
+    scene=context.scene
+    frame_start=scene.frame_start
+    frame_end=scene.frame_end
+    state_list=[prepare_object(obj,cache_dir,frame_start,frame_end) for obj in obj_list]
+    active_list=[state for state in state_list if not state['manifest']['finished']]
+
+    if active_list:
+        frame_current=scene.frame_current
+        frame=min(state['manifest']['baked_frame'] for state in active_list)+1
+        window_manager=context.window_manager
+        window_manager.progress_begin(frame_start,frame_end)
+        #读取最后完成的帧,下一帧从它继续模拟
+        #read the last finished frame, the next frame simulates on from it
+        if frame>frame_start:
+            scene.frame_set(frame-1)
+        while frame<=frame_end:
+            chunk_end=min(frame+chunk_frames-1,frame_end)
+            start_time=time.perf_counter()
+            for chunk_frame in range(frame,chunk_end+1):
+                scene.frame_set(chunk_frame)
+                window_manager.progress_update(chunk_frame)
+            seconds=time.perf_counter()-start_time
+            for state in active_list:
+                manifest=state['manifest']
+                if manifest['baked_frame']<chunk_end:
+                    manifest['baked_frame']=chunk_end
+                    manifest['seconds']+=seconds
+                    write_manifest(state['obj_dir'],manifest)
+            #界面中由进度条显示,后台进程没有进度条,每段的耗时通过提示写入日志
+            #the UI shows the progress bar, a background worker has none so
+            #each chunk is reported through alert_error into its log
+            if bpy.app.background:
+                alert_error("提示",'布料缓存%d-%d帧,%.2fs'%(frame,chunk_end,seconds))
+            frame=chunk_end+1
+        window_manager.progress_end()
+        for state in active_list:
+            finish_object(state)
+        scene.frame_set(frame_current)
+
+    refresh_info(context,cache_dir,obj_list)
+    return [state['manifest'] for state in state_list]
+
+#在后台blender进程池中烘焙,每个进程烘焙一个布料,完成后在当前文件中重新链接
+#返回每个任务的状态,已经完成的布料不再烘焙,timeout为每个任务的最长秒数,0为不限制
+#bake in a pool of background blender processes, one cloth per process, then
+#relink the finished caches in this file. Returns the status of every job,
+#cloth that is already finished is not baked again. timeout is the longest a
+#job may run in seconds, 0 for no limit
+def bake_parallel(context,obj_list,cache_dir,chunk_frames,worker_count,blender=None,timeout=0):
+    scene=context.scene
+    frame_start=scene.frame_start
+    frame_end=scene.frame_end
+    job_dir=os.path.join(cache_dir,'jobs')
+    blend_path=os.path.join(job_dir,'scene.blend')
+    job_list=[]
+    for obj in obj_list:
+        manifest=check_manifest(obj,cache_dir,frame_start,frame_end)
+        if manifest!=None and manifest['finished']:
+            continue
+        cache_name=get_cache_name(obj)
+        job_list.append({
+            'id':cache_name,
+            'object':obj.name,
+            'blend':blend_path,
+            'cache_dir':cache_dir,
+            'chunk':chunk_frames,
+            'frame_start':frame_start,
+            'frame_end':frame_end,
+            'cost':len(obj.data.vertices)*(frame_end-frame_start+1),
+            'timeout':timeout,
+            'path':os.path.join(job_dir,cache_name+'.json'),
+            'status':os.path.join(job_dir,cache_name+'.status.json'),
+            'log':os.path.join(job_dir,cache_name+'.log'),
+        })
+
+    status_list=[]
+    if job_list:
+        #工作进程打开当前文件的副本,副本的blendcache目录固定,中断后可以继续
+        #the workers open a copy of this file, its blendcache directory stays
+        #the same between runs so an interrupted job resumes
+        os.makedirs(job_dir,exist_ok=True)
+        bpy.ops.wm.save_as_mainfile(filepath=blend_path,copy=True)
+        status_list=cloth_farm.run_pool(job_list,worker_count,blender or bpy.app.binary_path)
+
+    for obj in obj_list:
+        manifest=check_manifest(obj,cache_dir,frame_start,frame_end)
+        if manifest!=None and manifest['finished']:
+            link_cache(obj,get_object_dir(cache_dir,obj))
+    refresh_info(context,cache_dir,obj_list)
+    return status_list
+
+#更新面板显示的缓存状态,哈希变化的缓存被删除
+#update the cache status shown in the panel, caches whose hash changed are evicted
+def refresh_info(context,cache_dir,obj_list=None):
+    if obj_list==None:
+        cache_info.clear()
+        obj_list=get_all_cloth_objects(context.scene)
+    evict_list=[]
+    for obj in obj_list:
+        cache_name=get_cache_name(obj)
+        obj_dir=get_object_dir(cache_dir,obj)
+        manifest=read_manifest(obj_dir)
+        if manifest==None:
+            cache_info[obj.name]={'state':'none','frames':0,'size':0,'seconds':0.0}
+            continue
+        if manifest['hash']!=get_hash(obj):
+            clear_cache(obj,cache_dir)
+            evict_list.append(obj.name)
+            cache_info[obj.name]={'state':'evicted','frames':0,'size':0,'seconds':0.0}
+            continue
+        if manifest['finished']:
+            frame_dict=list_frames(obj_dir,cache_name)
+        else:
+            frame_dict=list_frames(get_bake_dir(),cache_name)
+        cache_info[obj.name]={
+            'state':'done' if manifest['finished'] else 'partial',
+            'frames':len(frame_dict),
+            'total':manifest['frame_end']-manifest['frame_start']+1,
+            'size':get_size(frame_dict),
+            'seconds':manifest['seconds'],
+        }
+    return evict_list
+
+def summary_lines(info_dict):
+    lines=[]
+    for name,info in info_dict.items():
+        if info['state'] in ('none','evicted'):
+            lines.append('%s: %s'%(name,info['state']))
+        else:
+            lines.append('%s: %s %d/%d, %.1fMB, %.1fs'%(name,info['state'],info['frames'],info['total'],info['size']/1048576,info['seconds']))
+    return lines
+
+def check_file():
+    if bpy.data.filepath=='':
+        alert_error("提示","请先保存文件,磁盘缓存需要文件路径")
+        return False
+    return True
+
+class OT_Bake_Cloth_Cache(Operator):
+    bl_idname = "mmr.bake_cloth_cache" # python 提示
+    bl_label = "Bake Cloth Cache"
+    bl_options = {'REGISTER'}
+
+    def execute(self,context):
+        if not check_file():
+            return{"CANCELLED"}
+        obj_list=get_cloth_objects(context)
+        if len(obj_list)==0:
+            alert_error("提示","场景中没有生成的布料")
+            return{"CANCELLED"}
+        mmr_property=context.scene.mmr_property
+        bake_objects(context,obj_list,get_cache_dir(mmr_property),mmr_property.cloth_bake_chunk)
+        alert_error("提示",'\n'.join(summary_lines(cache_info)))
+        return{"FINISHED"}
+
+class OT_Bake_Cloth_Parallel(Operator):
+    bl_idname = "mmr.bake_cloth_parallel" # python 提示
+    bl_label = "Bake Cloth In Parallel"
+    bl_options = {'REGISTER'}
+
+    def execute(self,context):
+        if not check_file():
+            return{"CANCELLED"}
+        obj_list=get_all_cloth_objects(context.scene)
+        if len(obj_list)==0:
+            alert_error("提示","场景中没有生成的布料")
+            return{"CANCELLED"}
+        mmr_property=context.scene.mmr_property
+        status_list=bake_parallel(context,obj_list,get_cache_dir(mmr_property),mmr_property.cloth_bake_chunk,mmr_property.cloth_bake_workers,timeout=mmr_property.cloth_bake_timeout)
+        alert_error("提示",'\n'.join(cloth_farm.summary_lines(status_list)+summary_lines(cache_info)))
+        return{"FINISHED"}
+
+class OT_Refresh_Cloth_Cache(Operator):
+    bl_idname = "mmr.refresh_cloth_cache" # python 提示
+    bl_label = "Refresh Cloth Cache"
+    bl_options = {'REGISTER'}
+
+    def execute(self,context):
+        if not check_file():
+            return{"CANCELLED"}
+        evict_list=refresh_info(context,get_cache_dir(context.scene.mmr_property))
+        if evict_list:
+            alert_error("提示","动作或布料设置已改变,已删除缓存:"+', '.join(evict_list))
+        return{"FINISHED"}
+
+class OT_Clear_Cloth_Cache(Operator):
+    bl_idname = "mmr.clear_cloth_cache" # python 提示
+    bl_label = "Clear Cloth Cache"
+    bl_options = {'REGISTER'}
+
+    def execute(self,context):
+        if not check_file():
+            return{"CANCELLED"}
+        cache_dir=get_cache_dir(context.scene.mmr_property)
+        for obj in get_cloth_objects(context):
+            clear_cache(obj,cache_dir)
+        refresh_info(context,cache_dir)
+        return{"FINISHED"}
+
+Class_list=[OT_Bake_Cloth_Cache,OT_Bake_Cloth_Parallel,OT_Refresh_Cloth_Cache,OT_Clear_Cloth_Cache]
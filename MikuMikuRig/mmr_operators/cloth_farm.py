@@ -0,0 +1,256 @@
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import tempfile
+import traceback
+import subprocess
+
+try:
+    from . import synthetic
+    from . import farm
+except ImportError:
+    sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+    import synthetic
+    import farm
+
+#布料并行烘焙:每个布料一个任务,在blender -b工作进程池中同时烘焙各自的磁盘缓存,
+#主文件等待全部完成后重新链接缓存,见cloth_cache.bake_parallel
+#parallel cloth bake: one job per cloth object, a pool of blender -b workers
+#bakes their disk caches at the same time and the main file relinks the
+#finished caches, see cloth_cache.bake_parallel
+#
+#python cloth_farm.py scene.blend [--objects mmd_cloth mmd_cloth.001] [--workers N] [--chunk 250] [--timeout 3600] [--cache-dir DIR] [--blender PATH]
+#python cloth_farm.py --selftest [--count 4] [--frames 60] [--workers 2] [--timeout 3600] [--keep] [--blender PATH]
+
+#最大的任务先启动,有空闲进程时启动下一个任务
+#超过job['timeout']秒的工作进程被结束,任务记为失败,已完成的帧段保留,下次烘焙从那里继续
+#largest job first, the next job starts as soon as a worker is free. A worker
+#running longer than job['timeout'] seconds is killed and its job fails, the
+#chunks it finished are kept and the next bake resumes from them
+def run_pool(job_list,worker_count,blender=None):
+    blender=farm.find_blender(blender)
+    worker_count=max(1,min(worker_count,len(job_list)))
+    #每个进程分到的线程数,避免进程之间争抢
+    #threads per worker so the workers do not fight over the cores
+    threads=max(1,(os.cpu_count() or 1)//worker_count)
+    pending_list=sorted(job_list,key=lambda job:-job['cost'])
+    running_list=[]
+    status_list=[]
+    while pending_list or running_list:
+        while pending_list and len(running_list)<worker_count:
+            job=pending_list.pop(0)
+            if os.path.exists(job['status']):
+                os.remove(job['status'])
+            with open(job['path'],'w',encoding='utf-8') as f:
+                json.dump(job,f,indent=4,ensure_ascii=False)
+            log_file=open(job['log'],'w')
+            command=[blender,'-b',job['blend'],'-t',str(threads),'--python-exit-code','1',
+                '--python',os.path.abspath(__file__),'--','--worker',job['path']]
+            process=subprocess.Popen(command,stdout=log_file,stderr=subprocess.STDOUT)
+            running_list.append((process,log_file,job,time.perf_counter()))
+        time.sleep(0.1)
+        for item in list(running_list):
+            process,log_file,job,start_time=item
+            return_code=process.poll()
+            timeout=job.get('timeout',0)
+            timed_out=return_code==None and timeout>0 and time.perf_counter()-start_time>timeout
+            if return_code==None and not timed_out:
+                continue
+            if timed_out:
+                process.kill()
+                process.wait()
+            running_list.remove(item)
+            log_file.close()
+            if timed_out:
+                status={'id':job['id'],'object':job['object'],'status':'failed','error':'timed out after %ds'%timeout}
+            elif os.path.exists(job['status']):
+                with open(job['status'],'r',encoding='utf-8') as f:
+                    status=json.load(f)
+            else:
+                #工作进程崩溃,没有写入状态
+                #the worker died before writing its status
+                status={'id':job['id'],'object':job['object'],'status':'failed','error':'worker exited with code %d'%return_code}
+            status['seconds']=time.perf_counter()-start_time
+            status_list.append(status)
+            print('%s %s %.2fs'%(job['object'],status['status'],status['seconds']))
+            sys.stdout.flush()
+    return status_list
+
+#每个布料的烘焙时间,seconds包括进程启动和打开文件
+#bake time of every cloth, seconds also counts starting blender and loading the file
+def summary_lines(status_list):
+    lines=[]
+    for status in status_list:
+        if status['status']=='done':
+            lines.append('%s: %.1fs (%.1fs), %d frames'%(status['object'],status.get('bake_seconds',0.0),status['seconds'],status.get('frames',0)))
+        else:
+            lines.append('%s: %s %s'%(status['object'],status['status'],status.get('error','')))
+    return lines
+
+#以下在blender中运行
+#everything below runs inside blender
+
+def run_worker(job_path):
+    import bpy
+    with open(job_path,'r',encoding='utf-8') as f:
+        job=json.load(f)
+    status={'id':job['id'],'object':job['object']}
+    start_time=time.perf_counter()
+    try:
+        addon=farm.load_addon()
+        cloth_cache=addon.mmr_operators.cloth_cache
+        scene=bpy.context.scene
+        obj=bpy.data.objects[job['object']]
+        #其他布料不参与模拟
+        #the other cloth objects stay out of the simulation
+        for other in cloth_cache.get_all_cloth_objects(scene):
+            if other!=obj:
+                mod=cloth_cache.get_cloth_modifier(other)
+                mod.show_viewport=False
+                mod.show_render=False
+        scene.frame_start=job['frame_start']
+        scene.frame_end=job['frame_end']
+        manifest=cloth_cache.bake_objects(bpy.context,[obj],job['cache_dir'],job['chunk'])[0]
+        info=cloth_cache.cache_info.get(obj.name,{})
+        status['status']='done' if manifest['finished'] else 'failed'
+        status['bake_seconds']=manifest['seconds']
+        status['frames']=info.get('frames',0)
+        status['size']=info.get('size',0)
+    except Exception as e:
+        traceback.print_exc()
+        status['status']='failed'
+        status['error']=repr(e)
+    status['worker_seconds']=time.perf_counter()-start_time
+    with open(job['status'],'w',encoding='utf-8') as f:
+        json.dump(status,f,indent=4,ensure_ascii=False)
+
+#打开的文件中烘焙,完成后保存,链接的缓存写入文件
+#bake the opened file and save it so the relinked caches are kept
+def run_main(args):
+    import bpy
+    addon=farm.load_addon()
+    cloth_cache=addon.mmr_operators.cloth_cache
+    scene=bpy.context.scene
+    if args.objects:
+        obj_list=[bpy.data.objects[name] for name in args.objects]
+    else:
+        obj_list=cloth_cache.get_all_cloth_objects(scene)
+    if args.cache_dir:
+        cache_dir=os.path.abspath(args.cache_dir)
+    else:
+        cache_dir=cloth_cache.get_cache_dir(scene.mmr_property)
+    status_list=cloth_cache.bake_parallel(bpy.context,obj_list,cache_dir,args.chunk,args.workers,args.blender,args.timeout)
+    for line in summary_lines(status_list):
+        print(line)
+    bpy.ops.wm.save_mainfile()
+    fail_number=len([status for status in status_list if status['status']!='done'])
+    return 1 if fail_number else 0
+
+#用于自测的布料:不同大小的圆筒,顶部一圈钉固,物体转动带动布料
+#test cloth: cylinders of different sizes pinned along the top ring, the
+#object spins to drag the cloth around
+def build_synthetic_cloth(count,frame_count):
+    import bpy
+    bpy.ops.wm.read_homefile(use_empty=True)
+    scene=bpy.context.scene
+    scene.frame_start=1
+    scene.frame_end=frame_count
+    obj_list=[]
+    for i in range(count):
+        columns=4+2*i
+        subdivision=3
+        verts,faces,vertex_bone_names=synthetic.skirt_mesh(columns,3,subdivision)
+        mesh=bpy.data.meshes.new('mmd_cloth')
+        mesh.from_pydata(verts,[],faces)
+        obj=bpy.data.objects.new('mmd_cloth',mesh)
+        scene.collection.objects.link(obj)
+        obj.location=(i*0.5,0,0)
+        pin_vertex_group=obj.vertex_groups.new(name='mmd_cloth_pin')
+        pin_vertex_group.add(list(range(columns*subdivision)),1,'REPLACE')
+        mod=obj.modifiers.new('mmd_cloth','CLOTH')
+        mod.settings.vertex_group_mass='mmd_cloth_pin'
+        obj.keyframe_insert('rotation_euler',index=2,frame=1)
+        obj.rotation_euler[2]=math.pi
+        obj.keyframe_insert('rotation_euler',index=2,frame=frame_count)
+        obj_list.append(obj)
+    return obj_list
+
+#自测:合成布料并行烘焙,检查每个布料的帧数和链接,再次烘焙时不应启动工作进程
+#self test: bake synthetic cloth in parallel, check the frames and the link of
+#every cloth, a second bake must not start any worker
+def run_selftest(args):
+    import bpy
+    addon=farm.load_addon()
+    cloth_cache=addon.mmr_operators.cloth_cache
+    test_dir=tempfile.mkdtemp(prefix='mmr_cloth_farm_')
+    obj_list=build_synthetic_cloth(args.count,args.frames)
+    bpy.ops.wm.save_as_mainfile(filepath=os.path.join(test_dir,'cloth.blend'))
+    cache_dir=os.path.join(test_dir,'cache')
+
+    status_list=cloth_cache.bake_parallel(bpy.context,obj_list,cache_dir,args.chunk,args.workers,args.blender,args.timeout)
+    for line in summary_lines(status_list):
+        print(line)
+    fail_number=len([status for status in status_list if status['status']!='done'])
+    for obj in obj_list:
+        info=cloth_cache.cache_info.get(obj.name,{})
+        point_cache=cloth_cache.get_cloth_modifier(obj).point_cache
+        if info.get('state')!='done' or info.get('frames')!=args.frames or not point_cache.use_external:
+            print('%s not linked: %s'%(obj.name,info))
+            fail_number+=1
+    if cloth_cache.bake_parallel(bpy.context,obj_list,cache_dir,args.chunk,args.workers,args.blender,args.timeout):
+        print('finished caches were baked again')
+        fail_number+=1
+
+    if fail_number==0 and not args.keep:
+        shutil.rmtree(test_dir,ignore_errors=True)
+    else:
+        print('test files kept in '+test_dir)
+    print('%d cloth, %d failed'%(len(obj_list),fail_number))
+    return fail_number==0
+
+def main(argv):
+    inside_blender='bpy' in sys.modules
+    #blender把"--"之后的参数留给脚本
+    #blender passes the arguments after "--" to the script
+    if '--' in argv:
+        argv=argv[argv.index('--')+1:]
+    parser=argparse.ArgumentParser(description='MikuMikuRig parallel cloth bake')
+    parser.add_argument('blend',nargs='?')
+    parser.add_argument('--objects',nargs='+')
+    parser.add_argument('--workers',type=int,default=os.cpu_count() or 1)
+    parser.add_argument('--chunk',type=int,default=250)
+    parser.add_argument('--timeout',type=int,default=3600)
+    parser.add_argument('--cache-dir')
+    parser.add_argument('--blender')
+    parser.add_argument('--selftest',action='store_true')
+    parser.add_argument('--count',type=int,default=4)
+    parser.add_argument('--frames',type=int,default=60)
+    parser.add_argument('--keep',action='store_true')
+    parser.add_argument('--worker')
+    args=parser.parse_args(argv)
+
+    if args.worker:
+        run_worker(args.worker)
+        return 0
+    if inside_blender:
+        if args.selftest:
+            return 0 if run_selftest(args) else 1
+        return run_main(args)
+    if not args.blend and not args.selftest:
+        parser.print_help()
+        return 2
+
+    #在普通python中运行时启动后台blender
+    #started from plain python, rerun inside background blender
+    command=[farm.find_blender(args.blender),'-b']
+    if args.blend:
+        command.append(os.path.abspath(args.blend))
+    command+=['--python-exit-code','1','--python',os.path.abspath(__file__),'--']+argv
+    return subprocess.call(command)
+
+if __name__=='__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,92 @@
+#布料网格的拓扑分析:飘带扩展,头部尾部侧边分类和多余填充边过滤,
+#全部用集合和哈希表,与顶点数和边数成线性关系
+#topology analysis of the generated cloth mesh: ribbon extension, up/down/side
+#classification and fill edge filtering, all on sets and hash maps so the
+#cost is linear in vertices and edges
+
+#保持插入顺序的集合,成员判断为O(1),遍历顺序与原来的列表一致
+#insertion ordered set, O(1) membership and the same iteration order as the
+#lists it replaces
+class OrderedSet(dict):
+    def add(self,item):
+        self[item]=None
+
+def edge_key(index1,index2):
+    if index1<index2:
+        return (index1,index2)
+    return (index2,index1)
+
+#删除填充孔洞时新建的、没有对应关节的边
+#remove the edges holes_fill added that have no joint behind them
+def remove_fill_edges(bm,edge_index):
+    edge_set={edge_key(index1,index2) for index1,index2 in edge_index}
+    extra_edges=[e for e in bm.edges if edge_key(e.verts[0].index,e.verts[1].index) not in edge_set]
+    for e in extra_edges:
+        bm.edges.remove(e)
+
+#飘带顶点:孤立边上的顶点,扩展时沿边广度优先找到整个相连部分
+#ribbon vertices are the ones on wire edges, extending them walks the whole
+#connected part breadth first
+def get_ribbon_verts(bm,extend):
+    ribbon_verts={v for v in bm.verts if v.is_wire}
+    if extend:
+        boundary_verts=list(ribbon_verts)
+        while boundary_verts:
+            next_verts=[]
+            for v in boundary_verts:
+                for e in v.link_edges:
+                    v2=e.other_vert(v)
+                    if v2 not in ribbon_verts:
+                        ribbon_verts.add(v2)
+                        next_verts.append(v2)
+            boundary_verts=next_verts
+    return ribbon_verts
+
+#所有面都至少有一个飘带顶点时整个网格都是飘带
+#the whole mesh is ribbon when every face touches a ribbon vertex
+def is_all_ribbon(bm,ribbon_verts):
+    for f in bm.faces:
+        if not any(v in ribbon_verts for v in f.verts):
+            return False
+    return True
+
+#按骨骼父子关系找出头部和尾部顶点,bones_list与顶点一一对应
+#up (root) and down (tip) vertices from the bone hierarchy, bones_list
+#matches the vertices one to one
+def classify_verts(bm,bones_list):
+    bone_set=set(bones_list)
+    up_verts=OrderedSet()
+    down_verts=OrderedSet()
+    for i in range(len(bones_list)):
+        v=bm.verts[i]
+        bone=bones_list[i]
+        if bone.bone.use_connect==False and v.is_boundary:
+            up_verts.add(v)
+        elif bone.parent not in bone_set:
+            up_verts.add(v)
+        elif len(bone.children)==0:
+            down_verts.add(v)
+        elif bone.children[0] not in bone_set:
+            down_verts.add(v)
+    return up_verts,down_verts
+
+#边界边分为头部边,尾部边和侧边,返回侧边的顶点
+#boundary edges split into up, down and side edges, plus the side vertices
+def classify_edges(bm,up_verts,down_verts):
+    up_edges=OrderedSet()
+    down_edges=OrderedSet()
+    side_edges=OrderedSet()
+    side_verts=OrderedSet()
+    for e in bm.edges:
+        if e.is_boundary:
+            vert1=e.verts[0]
+            vert2=e.verts[1]
+            if vert1 in up_verts and vert2 in up_verts:
+                up_edges.add(e)
+            elif vert1 in down_verts and vert2 in down_verts:
+                down_edges.add(e)
+            else:
+                side_edges.add(e)
+                side_verts.add(vert1)
+                side_verts.add(vert2)
+    return up_edges,down_edges,side_edges,side_verts
@@ -0,0 +1,220 @@
+import bpy
+import re
+import math
+import numpy as np
+from bpy.types import Operator
+from . import fcurve_utils
+from .alert import alert_error
+
+#关键帧精简:烘焙和重定向得到的动作每帧都有关键帧,
+#在旋转和位移误差范围内用贝塞尔曲线拟合,只保留需要的关键帧
+#每轮对所有段一起做最小二乘拟合控制柄,误差超出的段在误差最大的帧处插入关键帧,
+#直到所有帧都在误差范围内
+#keyframe decimation: baked and retargeted actions have a key on every frame,
+#they are refitted with bezier segments within a rotation/translation error.
+#Every round fits the handles of all segments at once by least squares and
+#splits each segment that is out of tolerance at its worst frame, until every
+#frame is within tolerance
+
+bone_path_pattern=re.compile(r'^pose\.bones\["((?:[^"\\]|\\.)*)"\]')
+
+#曲线类型:四元数,欧拉,位置,其他
+#curve kinds: quaternion, euler, location, other
+def get_kind(data_path):
+    if data_path.endswith('rotation_quaternion'):
+        return 'quaternion'
+    if data_path.endswith('rotation_euler') or data_path.endswith('rotation_axis_angle'):
+        return 'euler'
+    if data_path.endswith('location'):
+        return 'location'
+    return 'other'
+
+#每类曲线的误差,四元数差的模的两倍约等于旋转角度
+#error of each kind, twice the quaternion difference is about the rotation angle
+def kind_error(kind,diff):
+    if kind=='quaternion':
+        return 2*np.sqrt(np.sum(diff*diff,axis=1))
+    if kind=='location':
+        return np.sqrt(np.sum(diff*diff,axis=1))
+    return np.max(np.abs(diff),axis=1)
+
+#每段两端关键帧之间的帧做最小二乘,求两个中间控制点,
+#控制柄的横坐标在三分之一处,曲线对时间是三次多项式
+#least squares of the two inner control points over the frames of every
+#segment, handles sit at one third in time so the curve is a cubic in time
+def fit_segments(frames,values,key_index):
+    segment_len=len(key_index)-1
+    frame_index=np.arange(len(frames))
+    segment=np.clip(np.searchsorted(key_index,frame_index,side='right')-1,0,segment_len-1)
+    start=key_index[segment]
+    end=key_index[segment+1]
+    u=(frames-frames[start])/(frames[end]-frames[start])
+    b0=(1-u)**3
+    b1=3*u*(1-u)**2
+    b2=3*u*u*(1-u)
+    b3=u**3
+    y0=values[key_index[:-1]]
+    y1=values[key_index[1:]]
+
+    residual=values-b0[:,None]*y0[segment]-b3[:,None]*y1[segment]
+    a11=np.bincount(segment,b1*b1,segment_len)
+    a12=np.bincount(segment,b1*b2,segment_len)
+    a22=np.bincount(segment,b2*b2,segment_len)
+    r1=np.empty((segment_len,values.shape[1]))
+    r2=np.empty((segment_len,values.shape[1]))
+    for c in range(values.shape[1]):
+        r1[:,c]=np.bincount(segment,b1*residual[:,c],segment_len)
+        r2[:,c]=np.bincount(segment,b2*residual[:,c],segment_len)
+    det=a11*a22-a12*a12
+
+    #中间帧少于两帧时退化为直线
+    #segments with fewer than two inner frames fall back to a straight line
+    p1=y0+(y1-y0)/3
+    p2=y0+(y1-y0)*2/3
+    solvable=np.abs(det)>1e-9
+    if solvable.any():
+        inverse=1/det[solvable,None]
+        p1[solvable]=(a22[solvable,None]*r1[solvable]-a12[solvable,None]*r2[solvable])*inverse
+        p2[solvable]=(a11[solvable,None]*r2[solvable]-a12[solvable,None]*r1[solvable])*inverse
+
+    fitted=b0[:,None]*y0[segment]+b1[:,None]*p1[segment]+b2[:,None]*p2[segment]+b3[:,None]*y1[segment]
+    return fitted,p1,p2
+
+#part_list为(类型,列切片),返回保留的帧序号,控制点和每类的最大误差
+#part_list holds (kind, column slice), returns the kept frame indices, the
+#control points and the max error of every kind
+def decimate_curves(frames,values,part_list,tolerance_dict):
+    frames=np.asarray(frames,dtype=np.float64)
+    values=np.asarray(values,dtype=np.float64)
+    frame_len=len(frames)
+    keep=np.zeros(frame_len,dtype=bool)
+    keep[0]=keep[-1]=True
+    while True:
+        key_index=np.flatnonzero(keep)
+        fitted,p1,p2=fit_segments(frames,values,key_index)
+        diff=values-fitted
+        error_dict={}
+        normalized=np.zeros(frame_len)
+        for kind,columns in part_list:
+            error=kind_error(kind,diff[:,columns])
+            error_dict[kind]=max(error_dict.get(kind,0.0),float(error.max()))
+            normalized=np.maximum(normalized,error/max(tolerance_dict[kind],1e-9))
+        over=normalized>1
+        if not over.any():
+            return key_index,p1,p2,error_dict
+        #每个超出误差的段在误差最大的帧处插入关键帧
+        #split every failing segment at its worst frame
+        segment_max=np.maximum.reduceat(normalized,key_index[:-1])
+        segment=np.searchsorted(key_index,np.arange(frame_len),side='right')-1
+        segment=np.clip(segment,0,len(key_index)-2)
+        worst=over&(normalized==segment_max[segment])
+        worst_segment,first=np.unique(segment[worst],return_index=True)
+        keep[np.flatnonzero(worst)[first]]=True
+
+def read_co(fcurve):
+    co=np.empty(len(fcurve.keyframe_points)*2,dtype=np.float32)
+    fcurve.keyframe_points.foreach_get('co',co)
+    return co.reshape(-1,2).astype(np.float64)
+
+#按骨骼或按曲线分组,同一组的曲线共用关键帧
+#group the curves per bone or per channel, curves of a group share their keys
+def get_group_key(fcurve,per_bone):
+    if per_bone:
+        match=bone_path_pattern.match(fcurve.data_path)
+        if match:
+            return match.group(0)
+        return fcurve.data_path
+    return (fcurve.data_path,fcurve.array_index)
+
+def decimate_action(action,rotation_tolerance=0.5,translation_tolerance=0.001,per_bone=True):
+    tolerance_dict={
+        'quaternion':math.radians(rotation_tolerance),
+        'euler':math.radians(rotation_tolerance),
+        'location':translation_tolerance,
+        'other':translation_tolerance,
+    }
+    group_dict={}
+    for fcurve in action.fcurves:
+        keyframe_points=fcurve.keyframe_points
+        if len(keyframe_points)<3:
+            continue
+        #阶梯曲线(如IK_FK开关)不能用贝塞尔拟合
+        #stepped curves such as IK_FK switches are left alone
+        interpolation=fcurve_utils.foreach_get_enum(keyframe_points,'interpolation',fcurve_utils.interpolation_enum)
+        if (interpolation==fcurve_utils.interpolation_enum['CONSTANT']).any():
+            continue
+        co=read_co(fcurve)
+        #帧不同的曲线不能共用关键帧
+        #only curves sampled on the same frames can share keys
+        key=(get_group_key(fcurve,per_bone),co[:,0].tobytes())
+        group_dict.setdefault(key,[]).append((fcurve,co))
+
+    report={'keys_before':0,'keys_after':0,'max_rotation_error':0.0,'max_translation_error':0.0}
+    fcurves=action.fcurves
+    for group in group_dict.values():
+        group.sort(key=lambda item:(item[0].data_path,item[0].array_index))
+        frames=group[0][1][:,0]
+        values=np.column_stack([co[:,1] for fcurve,co in group])
+        part_list=[]
+        start=0
+        for i in range(1,len(group)+1):
+            if i==len(group) or group[i][0].data_path!=group[start][0].data_path:
+                part_list.append((get_kind(group[start][0].data_path),slice(start,i)))
+                start=i
+        key_index,p1,p2,error_dict=decimate_curves(frames,values,part_list,tolerance_dict)
+
+        report['keys_before']+=len(frames)*len(group)
+        report['keys_after']+=len(key_index)*len(group)
+        for kind,error in error_dict.items():
+            if kind in ('quaternion','euler'):
+                report['max_rotation_error']=max(report['max_rotation_error'],math.degrees(error))
+            else:
+                report['max_translation_error']=max(report['max_translation_error'],error)
+        if len(key_index)==len(frames):
+            continue
+
+        key_frames=frames[key_index]
+        third=(key_frames[1:]-key_frames[:-1])/3
+        for c,(fcurve,co) in enumerate(group):
+            key_values=values[key_index,c]
+            handle_left=np.column_stack((key_frames,key_values))
+            handle_right=handle_left.copy()
+            handle_right[:-1,0]+=third
+            handle_right[:-1,1]=p1[:,c]
+            handle_left[1:,0]-=third
+            handle_left[1:,1]=p2[:,c]
+            #首尾控制柄沿相邻段方向,避免首尾帧外的曲线突变
+            #the outer handles follow the neighbouring segment
+            handle_left[0]=2*handle_left[0]-handle_right[0]
+            handle_right[-1]=2*handle_right[-1]-handle_left[-1]
+            group_name=fcurve.group.name if fcurve.group else None
+            fcurve=fcurve_utils.new_fcurve(fcurves,fcurve.data_path,fcurve.array_index,group_name)
+            fcurve_utils.set_handle_keyframes(fcurve,np.column_stack((key_frames,key_values)),handle_left,handle_right)
+
+    report['ratio']=report['keys_before']/max(report['keys_after'],1)
+    return report
+
+def report_message(report):
+    return '关键帧 %d -> %d (%.1fx),最大旋转误差 %.3f°,最大位移误差 %.4f'%(
+        report['keys_before'],report['keys_after'],report['ratio'],report['max_rotation_error'],report['max_translation_error'])
+
+#按场景设置精简动作,导入完成后调用
+#decimate with the scene settings, called after an import
+def decimate_with_property(action,mmr_property):
+    return decimate_action(action,mmr_property.decimate_rotation,mmr_property.decimate_translation,mmr_property.decimate_per_bone)
+
+class OT_Decimate_Action(Operator):
+    bl_idname = "mmr.decimate_action" # python 提示
+    bl_label = "Decimate Action"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    def execute(self,context):
+        obj=context.view_layer.objects.active
+        if obj==None or obj.animation_data==None or obj.animation_data.action==None:
+            alert_error("提示","所选对象没有动作")
+            return{"CANCELLED"}
+        report=decimate_with_property(obj.animation_data.action,context.scene.mmr_property)
+        alert_error("提示",report_message(report))
+        return{"FINISHED"}
+
+Class_list=[OT_Decimate_Action]
@@ -1,12 +1,9 @@
 import bpy
-import bmesh
 from bpy.types import Operator
 from . import rig
-
-def alert_error(title,message):
-    def draw(self,context):
-        self.layout.label(text=str(message))
-    bpy.context.window_manager.popup_menu(draw,title=title,icon='ERROR')
+from . import physics_graph
+from . import weight_merge
+from .alert import alert_error
 
 def hide_skirt():
 
@@ -41,18 +38,13 @@ def hide_skirt():
         alert_error("提示","所选刚体没有对应网格模型")
         return(False)
 
-    bpy.ops.object.select_all(action='DESELECT')
-    bpy.context.view_layer.objects.active=select_rigid_body[0]
-    bpy.ops.mmd_tools.rigid_body_select(properties={'collision_group_number'})
-
+    #按碰撞组查询物理图,不再调用mmd_tools选择
+    #query the physics graph by collision group instead of selecting with mmd_tools
+    graph=physics_graph.PhysicsGraph(mmd_parent)
     bones_list=[]
-
-    for obj in bpy.context.selected_objects:
-        if hasattr(obj,'mmd_rigid'):
-            mmd_rigid=obj.mmd_rigid
-            if mmd_rigid.name != ''and mmd_rigid.type != '0':
-                bone=mmd_arm.pose.bones[obj.mmd_rigid.bone]
-                bones_list.append(bone)
+    for obj in graph.get_group(select_rigid_body[0]):
+        bone=mmd_arm.pose.bones[graph.get_bone_name(obj)]
+        bones_list.append(bone)
 
 
     #写入形变权重或骨骼约束
@@ -64,29 +56,8 @@ def hide_skirt():
         hide_vertex_group=mmd_mesh_object.vertex_groups['mmd_hide_skirt']
     else:
         hide_vertex_group=mmd_mesh_object.vertex_groups.new(name='mmd_hide_skirt')
-    to_index = hide_vertex_group.index
-    mmd_mesh = mmd_mesh_object.data
-    mmd_bm = bmesh.new()
-    mmd_bm.from_mesh(mmd_mesh)
-
-    mmd_bm.verts.layers.deform.verify()
-    deform_layer = mmd_bm.verts.layers.deform.active
-
-    for bone in bones_list:
-        name=bone.name
-
-        from_vertex_group = mmd_mesh_object.vertex_groups[name]
-        from_index = from_vertex_group.index
-
-        for vert in mmd_bm.verts:
-            deform_vert = vert[deform_layer]
-            if from_index not in deform_vert:
-                continue
-
-            deform_vert[to_index] = deform_vert.get(to_index, 0.0) + deform_vert[from_index]
-
-    mmd_bm.to_mesh(mmd_mesh)
-    mmd_bm.free()
+    from_vertex_groups=[mmd_mesh_object.vertex_groups[bone.name] for bone in bones_list]
+    weight_merge.merge_weights(mmd_mesh_object,from_vertex_groups,hide_vertex_group)
 
     if 'mmd_hide_skirt' not in mmd_mesh_object.modifiers.keys():
 
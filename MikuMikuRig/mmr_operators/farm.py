@@ -0,0 +1,447 @@
+import os
+import sys
+import json
+import time
+import struct
+import shutil
+import argparse
+import tempfile
+import traceback
+import subprocess
+
+try:
+    from . import synthetic
+except ImportError:
+    sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+    import synthetic
+
+#多进程后台批处理
+#调度端在普通python中运行,按任务清单启动多个blender -b工作进程,
+#每个工作进程只打开一次角色文件,依次处理分配给它的(骨骼,动作,选项)任务
+#multi-process headless farm, the scheduler runs in plain python and starts
+#a pool of blender -b workers, each worker opens a character file once and
+#works through its queue of (rig, clip, options) jobs
+#
+#python farm.py manifest.json [--workers N] [--blender PATH] [--dry-run]
+#python farm.py --selftest [--blender PATH]
+#
+#清单格式 / manifest format:
+#{
+#    "output_dir": "farm_output",
+#    "workers": 4,
+#    "jobs": [
+#        {"rig": "chars/miku.blend", "object": "miku_Rig", "type": "import", "clip": "dance.vmd",
+#         "options": {"native_reader": true}, "properties": {"fade_in_out": 5}},
+#        {"rig": "chars/miku.blend", "object": "miku_Rig", "type": "export", "clip": "walk.fbx",
+#         "output": "walk.vmd", "options": {"scale": 0.08}}
+#    ]
+#}
+#options是导入/导出操作器的属性,properties是场景mmr_property的属性
+#options are operator properties, properties are scene.mmr_property values
+
+synthetic_rig_prefix='synthetic:'
+
+#估算任务耗时,用动作的帧数近似
+#estimate the cost of a job from the length of its clip
+def estimate_clip_cost(clip_path):
+    if not clip_path or not os.path.exists(clip_path):
+        return 1.0
+    ext=os.path.splitext(clip_path)[1].lower()
+    try:
+        if ext=='.vmd':
+            with open(clip_path,'rb') as f:
+                signature=f.read(30)
+                name_len=20 if signature.startswith(b'Vocaloid Motion Data 0002') else 10
+                f.seek(30+name_len)
+                return float(struct.unpack('<I',f.read(4))[0])
+        if ext=='.bvh':
+            channel_count=0
+            with open(clip_path,'r') as f:
+                for line in f:
+                    words=line.split()
+                    if not words:
+                        continue
+                    if words[0]=='CHANNELS':
+                        channel_count+=int(words[1])
+                    elif words[0]=='Frames:':
+                        return float(int(words[1])*max(channel_count,1))/10
+    except (OSError,ValueError,struct.error):
+        pass
+    return os.path.getsize(clip_path)/1000.0
+
+def get_job_cost(job):
+    if 'cost' in job:
+        return float(job['cost'])
+    return estimate_clip_cost(job.get('clip'))
+
+#最长任务优先分配给当前负载最小的进程,同一角色的任务尽量留在同一进程
+#longest job first onto the least loaded worker, a worker that already
+#holds the job's rig is preferred when the rig load cost is not saved elsewhere
+def plan_jobs(jobs,worker_count,rig_load_cost=0.0):
+    worker_count=max(1,min(worker_count,len(jobs)))
+    queue_list=[[] for i in range(worker_count)]
+    load_list=[0.0]*worker_count
+    rig_set_list=[set() for i in range(worker_count)]
+    for job in sorted(jobs,key=lambda job:-job['cost']):
+        best=None
+        best_load=None
+        for i in range(worker_count):
+            load=load_list[i]+job['cost']
+            if job['rig'] not in rig_set_list[i]:
+                load+=rig_load_cost
+            if best==None or load<best_load:
+                best=i
+                best_load=load
+        queue_list[best].append(job)
+        load_list[best]=best_load
+        rig_set_list[best].add(job['rig'])
+    #同一角色的任务排在一起,角色文件只打开一次
+    #group a worker's jobs by rig so each rig file is opened once
+    for queue in queue_list:
+        rig_order={}
+        for job in queue:
+            rig_order.setdefault(job['rig'],len(rig_order))
+        queue.sort(key=lambda job:rig_order[job['rig']])
+    return queue_list,load_list
+
+def read_manifest(manifest_path):
+    with open(manifest_path,'r',encoding='utf-8') as f:
+        manifest=json.load(f)
+    base_dir=os.path.dirname(os.path.abspath(manifest_path))
+    output_dir=os.path.join(base_dir,manifest.get('output_dir','farm_output'))
+
+    def resolve(path):
+        if path==None or path.startswith(synthetic_rig_prefix):
+            return path
+        return os.path.normpath(os.path.join(base_dir,path))
+
+    jobs=[]
+    for i,job in enumerate(manifest['jobs']):
+        job=dict(job)
+        job.setdefault('id','job_%04d'%i)
+        job.setdefault('type','import')
+        job['rig']=resolve(job['rig'])
+        job['clip']=resolve(job.get('clip'))
+        rig_name=os.path.splitext(os.path.basename(job['rig'].replace(synthetic_rig_prefix,'')))[0]
+        clip_name=os.path.splitext(os.path.basename(job['clip'] or job['id']))[0]
+        ext='.vmd' if job['type']=='export' else '.blend'
+        if 'output' in job:
+            job['output']=os.path.normpath(os.path.join(output_dir,job['output']))
+        else:
+            job['output']=os.path.join(output_dir,rig_name,clip_name+ext)
+        job['cost']=get_job_cost(job)
+        jobs.append(job)
+    return manifest,jobs,output_dir
+
+def find_blender(blender=None):
+    if blender:
+        return blender
+    if os.environ.get('BLENDER'):
+        return os.environ['BLENDER']
+    return shutil.which('blender') or 'blender'
+
+#启动工作进程并等待,返回所有任务的状态
+#start the workers, wait for them and gather every job status
+def run_farm(manifest_path,worker_count=None,blender=None,dry_run=False):
+    manifest,jobs,output_dir=read_manifest(manifest_path)
+    if worker_count==None:
+        worker_count=manifest.get('workers',os.cpu_count() or 1)
+    queue_list,load_list=plan_jobs(jobs,worker_count,manifest.get('rig_load_cost',0.0))
+
+    for i,queue in enumerate(queue_list):
+        print('worker %d: %d jobs, cost %.1f, rigs %d'%(i,len(queue),load_list[i],len(set(job['rig'] for job in queue))))
+    if dry_run:
+        return [],0
+
+    status_dir=os.path.join(output_dir,'status')
+    log_dir=os.path.join(output_dir,'log')
+    os.makedirs(status_dir,exist_ok=True)
+    os.makedirs(log_dir,exist_ok=True)
+    for job in jobs:
+        status_path=os.path.join(status_dir,job['id']+'.json')
+        if os.path.exists(status_path):
+            os.remove(status_path)
+
+    blender=find_blender(blender or manifest.get('blender'))
+    start_time=time.perf_counter()
+    process_list=[]
+    for i,queue in enumerate(queue_list):
+        queue_path=os.path.join(log_dir,'queue_%d.json'%i)
+        with open(queue_path,'w',encoding='utf-8') as f:
+            json.dump({'status_dir':status_dir,'jobs':queue},f,indent=4,ensure_ascii=False)
+        log_file=open(os.path.join(log_dir,'worker_%d.log'%i),'w')
+        command=[blender,'-b','--python-exit-code','1','--python',os.path.abspath(__file__),'--','--worker',queue_path]
+        process=subprocess.Popen(command,stdout=log_file,stderr=subprocess.STDOUT)
+        process_list.append((process,log_file,queue))
+
+    status_list=[]
+    for process,log_file,queue in process_list:
+        return_code=process.wait()
+        log_file.close()
+        for job in queue:
+            status_path=os.path.join(status_dir,job['id']+'.json')
+            if os.path.exists(status_path):
+                with open(status_path,'r',encoding='utf-8') as f:
+                    status=json.load(f)
+            else:
+                #工作进程崩溃,没有写入状态
+                #the worker died before writing this job's status
+                status={'id':job['id'],'status':'failed','rig':job['rig'],'clip':job['clip'],
+                    'output':job['output'],'error':'worker exited with code %d'%return_code}
+                with open(status_path,'w',encoding='utf-8') as f:
+                    json.dump(status,f,indent=4,ensure_ascii=False)
+            status_list.append(status)
+
+    fail_number=len([status for status in status_list if status['status']!='done'])
+    summary={
+        'jobs':len(status_list),
+        'failed':fail_number,
+        'workers':len(queue_list),
+        'seconds':time.perf_counter()-start_time,
+        'status':status_list,
+    }
+    with open(os.path.join(output_dir,'farm_summary.json'),'w',encoding='utf-8') as f:
+        json.dump(summary,f,indent=4,ensure_ascii=False)
+    print('%d jobs, %d failed, %.1fs'%(summary['jobs'],fail_number,summary['seconds']))
+    return status_list,fail_number
+
+#以下在blender工作进程中运行
+#everything below runs inside a blender worker
+
+#导入插件,已经启用时直接使用
+#import the add-on package, registering it only when it is not enabled yet
+def load_addon():
+    import bpy
+    import importlib
+    package_dir=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    package_name=os.path.basename(package_dir)
+    if package_name not in sys.modules:
+        sys.path.insert(0,os.path.dirname(package_dir))
+    addon=importlib.import_module(package_name)
+    if not hasattr(bpy.types.Scene,'mmr_property'):
+        addon.register()
+    return addon
+
+#操作器属性的默认值,任务中的options覆盖默认值
+#operator defaults, overridden by the job options
+class JobOptions:
+    def __init__(self,operator_class,options,filepath):
+        for name,prop in getattr(operator_class,'__annotations__',{}).items():
+            keywords=getattr(prop,'keywords',None)
+            if keywords and 'default' in keywords:
+                setattr(self,name,keywords['default'])
+        for name,value in options.items():
+            setattr(self,name,value)
+        self.filepath=filepath
+
+#用于自测的简单骨骼,骨骼名称与类型都是rigify名称
+#simple test rig whose bone names and bone types are rigify names
+def build_synthetic_rig(name):
+    import bpy
+    bpy.ops.wm.read_homefile(use_empty=True)
+    arm_data=bpy.data.armatures.new(name)
+    arm=bpy.data.objects.new(name+'_Rig',arm_data)
+    bpy.context.collection.objects.link(arm)
+    bpy.context.view_layer.objects.active=arm
+    arm.select_set(True)
+    bpy.ops.object.mode_set(mode='EDIT')
+    edit_bones=arm_data.edit_bones
+    for bone_name,parent,head,tail in synthetic.rigify_skeleton:
+        edit_bone=edit_bones.new(bone_name)
+        edit_bone.head=head
+        edit_bone.tail=tail
+        if parent:
+            edit_bone.parent=edit_bones[parent]
+    bpy.ops.object.mode_set(mode='OBJECT')
+    for pose_bone in arm.pose.bones:
+        pose_bone.mmr_bone.bone_type=pose_bone.name
+        pose_bone.rotation_mode='QUATERNION'
+    return arm
+
+def open_rig(job):
+    import bpy
+    if job['rig'].startswith(synthetic_rig_prefix):
+        return build_synthetic_rig(job['rig'][len(synthetic_rig_prefix):])
+    bpy.ops.wm.open_mainfile(filepath=job['rig'])
+    return None
+
+def get_rig_object(job,rig_object):
+    import bpy
+    if job.get('object'):
+        return bpy.data.objects[job['object']]
+    if rig_object:
+        return rig_object
+    for obj in bpy.data.objects:
+        if obj.type=='ARMATURE' and obj.name.endswith('_Rig'):
+            return obj
+    raise ValueError('no rig object in '+job['rig'])
+
+#记录任务前的数据,任务后删除新建的数据,同一个文件可以继续处理下一个任务
+#snapshot before a job and remove what it created afterwards, so the same
+#loaded file can serve the next job
+def snapshot(rig):
+    import bpy
+    animation_data=rig.animation_data
+    return {
+        'objects':set(bpy.data.objects),
+        'actions':set(bpy.data.actions),
+        'tracks':set(animation_data.nla_tracks) if animation_data else set(),
+        'action':animation_data.action if animation_data else None,
+        'frame':bpy.context.scene.frame_current,
+    }
+
+def restore(rig,state):
+    import bpy
+    if bpy.context.object and bpy.context.object.mode!='OBJECT':
+        bpy.ops.object.mode_set(mode='OBJECT')
+    if rig.animation_data:
+        for track in list(rig.animation_data.nla_tracks):
+            if track not in state['tracks']:
+                rig.animation_data.nla_tracks.remove(track)
+        rig.animation_data.action=state['action']
+    for obj in list(bpy.data.objects):
+        if obj not in state['objects']:
+            bpy.data.objects.remove(obj,do_unlink=True)
+    for action in list(bpy.data.actions):
+        if action not in state['actions']:
+            bpy.data.actions.remove(action)
+    bpy.context.scene.frame_current=state['frame']
+
+def run_job(addon,job,rig):
+    import bpy
+    retarget=addon.mmr_operators.retarget
+    alert=addon.mmr_operators.alert
+    context=bpy.context
+    mmr_property=context.scene.mmr_property
+    for name,value in job.get('properties',{}).items():
+        setattr(mmr_property,name,value)
+
+    if context.object and context.object.mode!='OBJECT':
+        bpy.ops.object.mode_set(mode='OBJECT')
+    bpy.ops.object.select_all(action='DESELECT')
+    context.view_layer.objects.active=rig
+    rig.select_set(True)
+    rig.animation_data_create()
+    os.makedirs(os.path.dirname(job['output']),exist_ok=True)
+
+    options=job.get('options',{})
+    clip=job.get('clip')
+    succeed=True
+    with alert.capture_alert() as messages:
+        if clip:
+            if clip.lower().endswith('.vmd'):
+                OT=JobOptions(retarget.OT_Import_Vmd,options,clip)
+                succeed=retarget.load_vmd(OT,context)
+            else:
+                OT=JobOptions(retarget.OT_Import_Mixamo,options,clip)
+                succeed=retarget.retarget_mixmao(OT,context)
+            context.view_layer.objects.active=rig
+            rig.select_set(True)
+        if succeed==True and job['type']=='export':
+            #导出时动作必须是当前动作
+            #export reads the active action, move the imported strip there
+            if rig.animation_data.action==None and len(rig.animation_data.nla_tracks)>0:
+                track=rig.animation_data.nla_tracks[-1]
+                if len(track.strips)>0:
+                    rig.animation_data.action=track.strips[-1].action
+            OT=JobOptions(retarget.OT_Export_Vmd,options,job['output'])
+            succeed=retarget.export_vmd(OT,context)
+    if succeed!=True:
+        raise RuntimeError(messages[-1][1] if messages else 'job failed')
+    if job['type']=='import':
+        bpy.ops.wm.save_as_mainfile(filepath=job['output'],copy=True)
+    return [message for title,message in messages]
+
+def run_worker(queue_path):
+    import bpy
+    with open(queue_path,'r',encoding='utf-8') as f:
+        queue=json.load(f)
+    status_dir=queue['status_dir']
+    addon=load_addon()
+
+    current_rig=None
+    rig_object=None
+    for job in queue['jobs']:
+        start_time=time.perf_counter()
+        status={'id':job['id'],'rig':job['rig'],'clip':job.get('clip'),'output':job['output'],'cost':job['cost']}
+        try:
+            if job['rig']!=current_rig:
+                load_time=time.perf_counter()
+                rig_object=open_rig(job)
+                current_rig=job['rig']
+                status['rig_load_seconds']=time.perf_counter()-load_time
+            rig=get_rig_object(job,rig_object)
+            state=snapshot(rig)
+            try:
+                status['messages']=run_job(addon,job,rig)
+            finally:
+                restore(rig,state)
+            status['status']='done'
+        except Exception as e:
+            traceback.print_exc()
+            status['status']='failed'
+            status['error']=repr(e)
+        status['seconds']=time.perf_counter()-start_time
+        with open(os.path.join(status_dir,job['id']+'.json'),'w',encoding='utf-8') as f:
+            json.dump(status,f,indent=4,ensure_ascii=False)
+        print(job['id'],status['status'],'%.2fs'%status['seconds'])
+        sys.stdout.flush()
+
+#自测:生成合成骨骼和不同长度的BVH动作,在两个工作进程上运行
+#self test: synthetic rigs and BVH clips of different lengths on two workers
+def run_selftest(blender=None,keep=False):
+    test_dir=tempfile.mkdtemp(prefix='mmr_farm_')
+    frame_counts=[240,30,120,15,60,180]
+    jobs=[]
+    for i,frame_count in enumerate(frame_counts):
+        clip_path=os.path.join(test_dir,'clip_%d.bvh'%i)
+        synthetic.write_bvh(clip_path,frame_count)
+        jobs.append({
+            'rig':synthetic_rig_prefix+('rig_a' if i%2==0 else 'rig_b'),
+            'clip':os.path.basename(clip_path),
+            'properties':{'retarget_preset_name':'mixamo','import_as_NLA_strip':True},
+        })
+    manifest_path=os.path.join(test_dir,'manifest.json')
+    with open(manifest_path,'w',encoding='utf-8') as f:
+        json.dump({'output_dir':'output','workers':2,'jobs':jobs},f,indent=4)
+
+    status_list,fail_number=run_farm(manifest_path,blender=blender)
+    for status in status_list:
+        if status['status']=='done' and not os.path.exists(status['output']):
+            status['status']='failed'
+            fail_number+=1
+        print(status['id'],status['status'],status.get('error',''))
+    if fail_number==0 and not keep:
+        shutil.rmtree(test_dir,ignore_errors=True)
+    else:
+        print('test files kept in '+test_dir)
+    return fail_number==0
+
+def main(argv):
+    #blender把"--"之后的参数留给脚本
+    #blender passes the arguments after "--" to the script
+    if '--' in argv:
+        argv=argv[argv.index('--')+1:]
+    parser=argparse.ArgumentParser(description='MikuMikuRig batch farm')
+    parser.add_argument('manifest',nargs='?')
+    parser.add_argument('--workers',type=int)
+    parser.add_argument('--blender')
+    parser.add_argument('--dry-run',action='store_true')
+    parser.add_argument('--selftest',action='store_true')
+    parser.add_argument('--keep',action='store_true')
+    parser.add_argument('--worker')
+    args=parser.parse_args(argv)
+
+    if args.worker:
+        run_worker(args.worker)
+        return 0
+    if args.selftest:
+        return 0 if run_selftest(args.blender,args.keep) else 1
+    if not args.manifest:
+        parser.print_help()
+        return 2
+    status_list,fail_number=run_farm(args.manifest,args.workers,args.blender,args.dry_run)
+    return 1 if fail_number else 0
+
+if __name__=='__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,188 @@
+import numpy as np
+
+#关键帧枚举值,与blender内部数值一致
+#enum values of keyframe properties, same as blender's internal values
+interpolation_enum={'CONSTANT':0,'LINEAR':1,'BEZIER':2}
+handle_type_enum={'FREE':0,'AUTO':1,'VECTOR':2,'ALIGNED':3,'AUTO_CLAMPED':4}
+
+#批量写入枚举属性,不支持foreach时逐帧写入
+#bulk write an enum attribute, fall back to per-key setattr
+def foreach_set_enum(keyframe_points,attr_name,values,enum_dict):
+    values=np.asarray(values,dtype=np.int32)
+    try:
+        keyframe_points.foreach_set(attr_name,values)
+    except (TypeError,RuntimeError):
+        name_dict={value:name for name,value in enum_dict.items()}
+        for keyframe,value in zip(keyframe_points,values.tolist()):
+            setattr(keyframe,attr_name,name_dict[value])
+
+def foreach_get_enum(keyframe_points,attr_name,enum_dict):
+    values=np.empty(len(keyframe_points),dtype=np.int32)
+    try:
+        keyframe_points.foreach_get(attr_name,values)
+    except (TypeError,RuntimeError):
+        for i,keyframe in enumerate(keyframe_points):
+            values[i]=enum_dict[getattr(keyframe,attr_name)]
+    return values
+
+#新建曲线,已存在则删除后重建并保留组
+#create fcurve, replacing an existing one but keeping its group
+def new_fcurve(fcurves,path,index=0,group_name=None):
+    fcurve=fcurves.find(path,index=index)
+    if fcurve:
+        if group_name is None and fcurve.group:
+            group_name=fcurve.group.name
+        fcurves.remove(fcurve)
+    if group_name:
+        return fcurves.new(path,index=index,action_group=group_name)
+    return fcurves.new(path,index=index)
+
+#一次写入整条曲线的关键帧
+#write all keyframes of a curve in one add() + foreach_set
+def set_keyframes(fcurve,frames,values,interpolation='LINEAR'):
+    frames=np.asarray(frames)
+    keyframe_len=len(frames)
+    keyframe_points=fcurve.keyframe_points
+    keyframe_points.add(keyframe_len)
+    co=np.empty((keyframe_len,2),dtype=np.float32)
+    co[:,0]=frames
+    co[:,1]=values
+    keyframe_points.foreach_set('co',co.ravel())
+    if interpolation!='BEZIER':
+        foreach_set_enum(keyframe_points,'interpolation',np.full(keyframe_len,interpolation_enum[interpolation]),interpolation_enum)
+    fcurve.update()
+
+#写入带自由控制柄的贝塞尔曲线
+#bezier每行是(x1,y1,x2,y2),描述上一帧到这一帧的归一化控制柄
+#write bezier keys with free handles, each row of bezier (x1,y1,x2,y2)
+#is the normalized curve from the previous key to this one
+def set_bezier_keyframes(fcurve,frames,values,bezier):
+    frames=np.asarray(frames,dtype=np.float64)
+    values=np.asarray(values,dtype=np.float64)
+    bezier=np.asarray(bezier,dtype=np.float64)
+    keyframe_len=len(frames)
+    keyframe_points=fcurve.keyframe_points
+    keyframe_points.add(keyframe_len)
+
+    co=np.column_stack((frames,values))
+    handle_left=co.copy()
+    handle_right=co.copy()
+    if keyframe_len>1:
+        d=co[1:]-co[:-1]
+        handle_right[:-1]=co[:-1]+d*bezier[1:,0:2]
+        handle_left[1:]=co[:-1]+d*bezier[1:,2:4]
+
+    keyframe_points.foreach_set('co',co.astype(np.float32).ravel())
+    foreach_set_enum(keyframe_points,'handle_left_type',np.full(keyframe_len,handle_type_enum['FREE']),handle_type_enum)
+    foreach_set_enum(keyframe_points,'handle_right_type',np.full(keyframe_len,handle_type_enum['FREE']),handle_type_enum)
+    keyframe_points.foreach_set('handle_left',handle_left.astype(np.float32).ravel())
+    keyframe_points.foreach_set('handle_right',handle_right.astype(np.float32).ravel())
+    fcurve.update()
+
+#批量复制关键帧,包括控制柄和枚举属性,追加到目标曲线末尾
+#bulk copy keyframes with their handles and enum fields, appended to fcurve_to
+def copy_keyframes(fcurve_from,fcurve_to):
+    keyframe_points1=fcurve_from.keyframe_points
+    keyframe_points2=fcurve_to.keyframe_points
+    keyframe_len=len(keyframe_points1)
+    if keyframe_len==0:
+        return fcurve_to
+    start=len(keyframe_points2)
+    keyframe_points2.add(keyframe_len)
+
+    enum_list=[
+        ('interpolation',interpolation_enum),
+        ('handle_left_type',handle_type_enum),
+        ('handle_right_type',handle_type_enum),
+    ]
+    vector_list=['co','handle_left','handle_right']
+    enum_data={name:foreach_get_enum(keyframe_points1,name,enum_dict) for name,enum_dict in enum_list}
+    vector_data={}
+    for name in vector_list:
+        vector_data[name]=np.empty(keyframe_len*2,dtype=np.float32)
+        keyframe_points1.foreach_get(name,vector_data[name])
+
+    #目标曲线原本有关键帧时先取出再整体写回
+    #keys already on the target are read back and written together with the new ones
+    if start>0:
+        for name,enum_dict in enum_list:
+            values=foreach_get_enum(keyframe_points2,name,enum_dict)
+            values[start:]=enum_data[name]
+            enum_data[name]=values
+        for name in vector_list:
+            values=np.empty((start+keyframe_len)*2,dtype=np.float32)
+            keyframe_points2.foreach_get(name,values)
+            values[start*2:]=vector_data[name]
+            vector_data[name]=values
+
+    #先写控制柄类型,再写坐标和控制柄,避免控制柄被重新计算
+    #handle types go first so the copied handles are not recalculated
+    for name,enum_dict in enum_list:
+        foreach_set_enum(keyframe_points2,name,enum_data[name],enum_dict)
+    for name in vector_list:
+        keyframe_points2.foreach_set(name,vector_data[name])
+    fcurve_to.update()
+    return fcurve_to
+
+#只保留key_frames中的帧,整条曲线一次重建
+#bezier_R/bezier_L与key_frames对齐,每行是(x,y)归一化控制柄,nan表示没有控制柄
+#keep only the frames in key_frames and rebuild the curve with one add(),
+#bezier_R/bezier_L are aligned with key_frames, each row is a normalized (x,y)
+#handle relative to the previous key, nan rows mean no handle
+def prune_keyframes(fcurves,fcurve,key_frames,bezier_R,bezier_L):
+    keyframe_points=fcurve.keyframe_points
+    co=np.empty(len(keyframe_points)*2,dtype=np.float32)
+    keyframe_points.foreach_get('co',co)
+    co=co.reshape(-1,2).astype(np.float64)
+    frames=co[:,0].astype(np.int64)
+    keep=np.isin(frames,key_frames)
+    co=co[keep]
+    frames=frames[keep]
+    keyframe_len=len(co)
+
+    fcurve=new_fcurve(fcurves,fcurve.data_path,fcurve.array_index)
+    keyframe_points=fcurve.keyframe_points
+    keyframe_points.add(keyframe_len)
+
+    key_index=np.searchsorted(key_frames,frames)
+    right=bezier_R[key_index]
+    left=bezier_L[key_index]
+    interpolation=np.full(keyframe_len,interpolation_enum['BEZIER'])
+    handle_left_type=np.full(keyframe_len,handle_type_enum['AUTO_CLAMPED'])
+    handle_right_type=np.full(keyframe_len,handle_type_enum['AUTO_CLAMPED'])
+    handle_left=co.copy()
+    handle_right=co.copy()
+    if keyframe_len>1:
+        d=co[1:]-co[:-1]
+        #有右控制柄的段为贝塞尔,否则为线性
+        #segments with a right handle are bezier, the others linear
+        has_right=~np.isnan(right[:-1,0])
+        interpolation[:-1]=np.where(has_right,interpolation_enum['BEZIER'],interpolation_enum['LINEAR'])
+        handle_right_type[:-1][has_right]=handle_type_enum['FREE']
+        handle_right[:-1][has_right]=(co[:-1]+right[:-1]*d)[has_right]
+        has_left=~np.isnan(left[1:,0])
+        handle_left_type[1:][has_left]=handle_type_enum['FREE']
+        handle_left[1:][has_left]=(co[:-1]+left[1:]*d)[has_left]
+
+    keyframe_points.foreach_set('co',co.astype(np.float32).ravel())
+    foreach_set_enum(keyframe_points,'interpolation',interpolation,interpolation_enum)
+    foreach_set_enum(keyframe_points,'handle_left_type',handle_left_type,handle_type_enum)
+    foreach_set_enum(keyframe_points,'handle_right_type',handle_right_type,handle_type_enum)
+    keyframe_points.foreach_set('handle_left',handle_left.astype(np.float32).ravel())
+    keyframe_points.foreach_set('handle_right',handle_right.astype(np.float32).ravel())
+    fcurve.update()
+    return fcurve
+
+#写入关键帧和绝对坐标的自由控制柄,所有段为贝塞尔插值
+#write keys with free handles given in absolute coordinates, every segment is bezier
+def set_handle_keyframes(fcurve,co,handle_left,handle_right):
+    keyframe_len=len(co)
+    keyframe_points=fcurve.keyframe_points
+    keyframe_points.add(keyframe_len)
+    keyframe_points.foreach_set('co',np.asarray(co,dtype=np.float32).ravel())
+    foreach_set_enum(keyframe_points,'interpolation',np.full(keyframe_len,interpolation_enum['BEZIER']),interpolation_enum)
+    foreach_set_enum(keyframe_points,'handle_left_type',np.full(keyframe_len,handle_type_enum['FREE']),handle_type_enum)
+    foreach_set_enum(keyframe_points,'handle_right_type',np.full(keyframe_len,handle_type_enum['FREE']),handle_type_enum)
+    keyframe_points.foreach_set('handle_left',np.asarray(handle_left,dtype=np.float32).ravel())
+    keyframe_points.foreach_set('handle_right',np.asarray(handle_right,dtype=np.float32).ravel())
+    fcurve.update()
@@ -0,0 +1,475 @@
+import bpy
+import re
+import math
+import unicodedata
+from bpy.types import Operator
+from . import preset
+from .alert import alert_error
+
+#骨骼类型自动推断
+#名称证据来自preset.json中所有预设,拓扑证据来自骨架结构:
+#腿是从地面向上的对称链,手是有多根手指分叉的骨骼,脊椎按高度排列
+#两种证据合并为每个骨骼类型的候选和置信度,只有低置信度的骨骼需要手动指定
+#automatic bone type inference
+#name evidence comes from every preset in preset.json, topology evidence from
+#the skeleton: legs are mirrored chains reaching the ground, hands fan out
+#into fingers and the spine is ordered by height. Both are merged into
+#candidates with a confidence, so only low confidence bones need a human
+
+#名称证据的分数
+#scores of the name evidence
+exact_name_score=0.9
+pattern_name_score=0.7
+#拓扑证据的分数
+#scores of the topology evidence
+chain_score=0.7
+finger_score=0.7
+detail_score=0.5
+
+side_pattern_list=[
+    (re.compile(r'^(left|l)(?=[^a-z])'),'L'),(re.compile(r'^(right|r)(?=[^a-z])'),'R'),
+    (re.compile(r'(?<=[^a-z])(left|l)$'),'L'),(re.compile(r'(?<=[^a-z])(right|r)$'),'R'),
+    (re.compile(r'(?<=[^a-z])(l)(?=[^a-z])'),'L'),(re.compile(r'(?<=[^a-z])(r)(?=[^a-z])'),'R'),
+    (re.compile(r'left'),'L'),(re.compile(r'right'),'R'),
+    (re.compile(r'^左'),'L'),(re.compile(r'^右'),'R'),
+]
+
+#统一全角半角和大小写,去掉mixamorig:之类的前缀
+#fold width and case, drop prefixes such as mixamorig:
+def fold_name(name):
+    name=unicodedata.normalize('NFKC',name).lower()
+    return name.split(':')[-1]
+
+def strip_name(name):
+    return re.sub(r'[\s._\-]+','',name)
+
+#拆出左右标记,返回(左右,去掉左右后的名称)
+#split off the side marker, returns (side, name without the side)
+def split_side(name):
+    name=fold_name(name)
+    for pattern,side in side_pattern_list:
+        match=pattern.search(name)
+        if match:
+            return side,strip_name(name[:match.start()]+'_'+name[match.end():])
+    return None,strip_name(name)
+
+def split_type_side(bone_type):
+    for suffix in ('.L','.R','_L','_R'):
+        if bone_type.endswith(suffix):
+            return suffix[-1],bone_type[:-1]
+    return None,bone_type
+
+def set_type_side(type_base,side):
+    return type_base+side
+
+#名称表:精确名称和去掉左右后的名称分别对应骨骼类型
+#name table: exact names and side free names both map to bone types
+def build_name_table(preset_dict_dict):
+    exact_dict={}
+    vote_dict={}
+    for preset_type,preset_dict in preset_dict_dict.items():
+        for preset_name,preset_data in preset_dict.items():
+            for bone_name,value in preset_data.items():
+                bone_type,invert=value
+                if not preset.is_bone_type(bone_type):
+                    continue
+                exact_dict[bone_name]=(bone_type,invert)
+                name_side,name_base=split_side(bone_name)
+                type_side,type_base=split_type_side(bone_type)
+                if name_side!=type_side and type_side!=None:
+                    continue
+                key=(name_base,type_side!=None)
+                votes=vote_dict.setdefault(key,{})
+                votes[(type_base,invert)]=votes.get((type_base,invert),0)+1
+    pattern_dict={}
+    for key,votes in vote_dict.items():
+        pattern_dict[key]=max(votes.items(),key=lambda item:item[1])[0]
+    return exact_dict,pattern_dict
+
+class Skeleton:
+    def __init__(self,bone_list):
+        self.names=[bone[0] for bone in bone_list]
+        index_dict={name:i for i,name in enumerate(self.names)}
+        self.parents=[index_dict.get(bone[1]) for bone in bone_list]
+        self.heads=[tuple(bone[2]) for bone in bone_list]
+        self.tails=[tuple(bone[3]) for bone in bone_list]
+        self.children=[[] for name in self.names]
+        for i,parent in enumerate(self.parents):
+            if parent!=None:
+                self.children[parent].append(i)
+        self.lengths=[distance(head,tail) for head,tail in zip(self.heads,self.tails)]
+        z_list=[point[2] for point in self.heads+self.tails] or [0]
+        self.floor=min(z_list)
+        self.height=max(max(z_list)-self.floor,1e-6)
+        self.descendants=[0]*len(self.names)
+        for i in reversed(self.depth_order()):
+            if self.parents[i]!=None:
+                self.descendants[self.parents[i]]+=self.descendants[i]+1
+
+    def depth_order(self):
+        order=[i for i,parent in enumerate(self.parents) if parent==None]
+        for i in order:
+            order.extend(self.children[i])
+        return order
+
+    def ancestors(self,i):
+        path=[]
+        while i!=None:
+            path.append(i)
+            i=self.parents[i]
+        return path
+
+    def common_ancestor(self,a,b):
+        ancestor_set=set(self.ancestors(a))
+        for i in self.ancestors(b):
+            if i in ancestor_set:
+                return i
+        return None
+
+    def side(self,i):
+        x=self.heads[i][0]+self.tails[i][0]
+        if abs(x)<0.01*self.height:
+            return None
+        return 'L' if x>0 else 'R'
+
+    def mirror_error(self,a,b):
+        head_a=self.heads[a]
+        head_b=self.heads[b]
+        return (abs(head_a[0]+head_b[0])+abs(head_a[1]-head_b[1])+abs(head_a[2]-head_b[2]))/self.height
+
+    #沿后代最多的子骨骼向下的链
+    #the chain following the child with the most descendants
+    def main_chain(self,i):
+        chain=[i]
+        while self.children[i]:
+            i=max(self.children[i],key=lambda child:(self.descendants[child],self.lengths[child]))
+            chain.append(i)
+        return chain
+
+def distance(a,b):
+    return math.sqrt(sum((a[k]-b[k])**2 for k in range(3)))
+
+def sub(a,b):
+    return tuple(a[k]-b[k] for k in range(3))
+
+def dot(a,b):
+    return sum(a[k]*b[k] for k in range(3))
+
+class Evidence:
+    def __init__(self):
+        self.score_dict={}
+
+    #同一骨骼类型和骨骼的证据按独立事件合并
+    #evidence for the same (type, bone) is combined as independent
+    def add(self,bone_type,i,score,invert=False,source=''):
+        key=(bone_type,i)
+        old=self.score_dict.get(key)
+        if old==None:
+            self.score_dict[key]=[score,invert,score,{source}]
+            return
+        #反转取分数最高的证据
+        #invert follows the strongest single piece of evidence
+        if score>old[2]:
+            old[1]=invert
+            old[2]=score
+        old[0]=1-(1-old[0])*(1-score)
+        old[3].add(source)
+
+def add_name_evidence(skeleton,evidence,exact_dict,pattern_dict):
+    for i,name in enumerate(skeleton.names):
+        if name in exact_dict:
+            bone_type,invert=exact_dict[name]
+            evidence.add(bone_type,i,exact_name_score,invert,'name')
+            continue
+        name_side,name_base=split_side(name)
+        if name_base=='':
+            continue
+        side=name_side or skeleton.side(i)
+        if side and (name_base,True) in pattern_dict:
+            type_base,invert=pattern_dict[(name_base,True)]
+            score=pattern_name_score if name_side else pattern_name_score*0.8
+            evidence.add(set_type_side(type_base,side),i,score,invert,'name')
+        elif (name_base,False) in pattern_dict:
+            bone_type,invert=pattern_dict[(name_base,False)]
+            evidence.add(bone_type,i,pattern_name_score,invert,'name')
+
+#从祖先c(不含)向下到骨骼i的链
+#the chain from below ancestor c down to bone i
+def get_chain(skeleton,c,i):
+    path=skeleton.ancestors(i)
+    return list(reversed(path[:path.index(c)]))
+
+def get_span(skeleton,chain):
+    end=chain[-1]
+    return skeleton.heads[chain[0]][2]-min(skeleton.heads[end][2],skeleton.tails[end][2])
+
+#腿:两条对称并到达地面的链,取竖直跨度最大的一对
+#legs: the mirrored pair of chains reaching the ground with the largest height span
+def find_legs(skeleton):
+    height=skeleton.height
+    foot_list=[i for i in range(len(skeleton.names)) if not skeleton.children[i]
+        and min(skeleton.heads[i][2],skeleton.tails[i][2])<skeleton.floor+0.2*height]
+    left_list=[i for i in foot_list if skeleton.side(i)=='L']
+    right_list=[i for i in foot_list if skeleton.side(i)=='R']
+    best=None
+    for a in left_list:
+        for b in right_list:
+            if skeleton.mirror_error(a,b)>0.05:
+                continue
+            c=skeleton.common_ancestor(a,b)
+            if c==None:
+                continue
+            chain_a=get_chain(skeleton,c,a)
+            chain_b=get_chain(skeleton,c,b)
+            span=get_span(skeleton,chain_a)
+            #两条链的跨度必须相近,排除一侧腿和另一侧IK骨骼的组合
+            #both spans must match, which rules out a leg paired with the other side's IK bone
+            if abs(span-get_span(skeleton,chain_b))>0.1*height:
+                continue
+            if best==None or span>best[0]:
+                best=(span,c,chain_a,chain_b)
+    if best==None or best[0]<0.25*height:
+        return None
+    return best[1],{'L':best[2],'R':best[3]}
+
+def add_leg_evidence(skeleton,evidence,legs):
+    pelvis,chain_dict=legs
+    height=skeleton.height
+    invert=skeleton.tails[pelvis][2]<skeleton.heads[pelvis][2]
+    evidence.add('spine',pelvis,chain_score,invert,'topology')
+    for side,chain in chain_dict.items():
+        long_list=[i for i in chain if skeleton.lengths[i]>=0.12*height]
+        if len(long_list)<2:
+            continue
+        thigh,shin=long_list[0],long_list[1]
+        evidence.add('thigh.'+side,thigh,chain_score,False,'topology')
+        evidence.add('shin.'+side,shin,chain_score,False,'topology')
+        rest=chain[chain.index(shin)+1:]
+        if len(rest)>0:
+            evidence.add('foot.'+side,rest[0],chain_score,False,'topology')
+        if len(rest)>1:
+            evidence.add('toe.'+side,rest[1],detail_score,False,'topology')
+
+#手:有至少三根手指链分叉且离中线最远的骨骼
+#hands: the bone farthest from the center line that fans out into at least three finger chains
+def find_hands(skeleton):
+    height=skeleton.height
+    hand_dict={}
+    for i in range(len(skeleton.names)):
+        side=skeleton.side(i)
+        if side==None or abs(skeleton.heads[i][0])<0.1*height:
+            continue
+        finger_list=[child for child in skeleton.children[i] if skeleton.descendants[child]>=1 and skeleton.side(child)==side]
+        if len(finger_list)<3:
+            continue
+        if side not in hand_dict or abs(skeleton.heads[i][0])>abs(skeleton.heads[hand_dict[side]][0]):
+            hand_dict[side]=i
+    return hand_dict
+
+def add_finger_evidence(skeleton,evidence,hand,side):
+    hand_head=skeleton.heads[hand]
+    axis=sub(skeleton.tails[hand],hand_head)
+    root_list=[child for child in skeleton.children[hand] if skeleton.descendants[child]>=1]
+    #离手腕最近的是拇指,其余按从前(-Y)到后排列
+    #the root closest to the wrist is the thumb, the rest go front (-Y) to back
+    root_list.sort(key=lambda i:dot(sub(skeleton.heads[i],hand_head),axis))
+    root_list=root_list[:5]
+    thumb=root_list[0]
+    finger_list=sorted(root_list[1:],key=lambda i:skeleton.heads[i][1])
+    name_list=['f_index','f_middle','f_ring','f_pinky'][:len(finger_list)]
+    score=finger_score if len(finger_list)==4 else detail_score
+    for finger_name,root in [('thumb',thumb)]+list(zip(name_list,finger_list)):
+        for number,i in enumerate(skeleton.main_chain(root)[:3]):
+            evidence.add('%s.%02d.%s'%(finger_name,number+1,side),i,score,False,'topology')
+
+#从手向上:小臂,大臂,肩膀,之后是胸部
+#up from the hand: forearm, upper arm, shoulder, then the chest
+def add_arm_evidence(skeleton,evidence,hand,side):
+    height=skeleton.height
+    evidence.add('hand.'+side,hand,finger_score,False,'topology')
+    path=skeleton.ancestors(hand)[1:]
+    long_list=[i for i in path if skeleton.lengths[i]>=0.06*height]
+    if len(long_list)<2:
+        return None
+    forearm,upper_arm=long_list[0],long_list[1]
+    evidence.add('forearm.'+side,forearm,chain_score,False,'topology')
+    evidence.add('upper_arm.'+side,upper_arm,chain_score,False,'topology')
+    add_twist_evidence(skeleton,evidence,upper_arm,forearm,'ArmTwist_'+side)
+    add_twist_evidence(skeleton,evidence,forearm,hand,'HandTwist_'+side)
+
+    chest=skeleton.parents[upper_arm]
+    if chest==None:
+        return None
+    tail=skeleton.tails[chest]
+    if distance(tail,skeleton.heads[upper_arm])<0.05*height and abs(tail[0])>0.03*height:
+        evidence.add('shoulder.'+side,chest,chain_score,False,'topology')
+        chest=skeleton.parents[chest]
+    return chest
+
+#捩骨:大臂或小臂上除下一节以外,头部落在骨骼中段的子骨骼
+#twist bones: a child other than the next segment whose head lies inside the bone
+def add_twist_evidence(skeleton,evidence,bone,next_bone,bone_type):
+    head=skeleton.heads[bone]
+    axis=sub(skeleton.tails[bone],head)
+    length_2=max(dot(axis,axis),1e-12)
+    for child in skeleton.children[bone]:
+        if child==next_bone:
+            continue
+        t=dot(sub(skeleton.heads[child],head),axis)/length_2
+        if 0.2<t<0.9:
+            evidence.add(bone_type,child,detail_score,False,'topology')
+            return
+
+#上半身:骨盆和胸部的共同祖先到胸部的路径,颈和头沿胸部向上
+#upper body: the path from the common ancestor of pelvis and chest up to the
+#chest, neck and head continue upwards from the chest
+def add_spine_evidence(skeleton,evidence,pelvis,chest):
+    height=skeleton.height
+    if pelvis!=None:
+        c=skeleton.common_ancestor(pelvis,chest)
+        path=skeleton.ancestors(chest)
+        if c in path:
+            path=list(reversed(path[:path.index(c)]))
+            if c!=pelvis:
+                path=[i for i in path if i!=pelvis]
+            if len(path)>=1:
+                evidence.add('spine.003',path[-1],chain_score,False,'topology')
+            if len(path)>=2:
+                evidence.add('spine.001',path[0],chain_score,False,'topology')
+            if len(path)>=3:
+                evidence.add('spine.002',path[len(path)//2],detail_score,False,'topology')
+        #骨盆之上的根骨骼
+        #the root bone above the pelvis
+        root=skeleton.ancestors(pelvis)[-1]
+        if root!=pelvis and skeleton.heads[root][2]<skeleton.floor+0.1*height:
+            evidence.add('Root',root,detail_score,False,'topology')
+
+    up_list=[child for child in skeleton.children[chest] if skeleton.side(child)==None
+        and skeleton.tails[child][2]>skeleton.heads[child][2]]
+    if not up_list:
+        return
+    neck=max(up_list,key=lambda i:(skeleton.descendants[i],skeleton.tails[i][2]))
+    up_children=[child for child in skeleton.children[neck] if skeleton.side(child)==None
+        and skeleton.tails[child][2]>skeleton.heads[child][2]]
+    if up_children:
+        head=max(up_children,key=lambda i:(skeleton.descendants[i],skeleton.tails[i][2]))
+        evidence.add('spine.004',neck,chain_score,False,'topology')
+    else:
+        head=neck
+    evidence.add('spine.006',head,chain_score,False,'topology')
+    add_eye_evidence(skeleton,evidence,head)
+
+#眼睛:头部下一对前方的对称骨骼
+#eyes: a mirrored pair in front under the head
+def add_eye_evidence(skeleton,evidence,head):
+    head_y=skeleton.heads[head][1]
+    front_list=[i for i in skeleton.children[head] if skeleton.side(i) and skeleton.heads[i][1]<head_y]
+    best=None
+    for a in front_list:
+        for b in front_list:
+            if skeleton.side(a)=='L' and skeleton.side(b)=='R':
+                error=skeleton.mirror_error(a,b)
+                if error<0.02 and (best==None or error<best[0]):
+                    best=(error,a,b)
+    if best:
+        evidence.add('eye.L',best[1],detail_score,False,'topology')
+        evidence.add('eye.R',best[2],detail_score,False,'topology')
+
+def add_topology_evidence(skeleton,evidence):
+    legs=find_legs(skeleton)
+    pelvis=None
+    if legs:
+        pelvis=legs[0]
+        add_leg_evidence(skeleton,evidence,legs)
+    chest_list=[]
+    for side,hand in find_hands(skeleton).items():
+        add_finger_evidence(skeleton,evidence,hand,side)
+        chest=add_arm_evidence(skeleton,evidence,hand,side)
+        if chest!=None:
+            chest_list.append(chest)
+    if chest_list:
+        chest=chest_list[0]
+        if len(chest_list)==2:
+            chest=skeleton.common_ancestor(chest_list[0],chest_list[1])
+        if chest!=None:
+            add_spine_evidence(skeleton,evidence,pelvis,chest)
+
+#每个类型取合并分数最高的骨骼,置信度扣除第二候选的一半,
+#再按置信度从高到低分配,每根骨骼只用一次
+#every type takes its best combined candidate, the confidence loses half of
+#the runner up, then types are assigned by confidence with each bone used once
+def resolve(skeleton,evidence):
+    type_dict={}
+    for (bone_type,i),(score,invert,best_score,source_set) in evidence.score_dict.items():
+        type_dict.setdefault(bone_type,[]).append((score,i,invert,'+'.join(sorted(source_set))))
+    candidate_list=[]
+    for bone_type,candidates in type_dict.items():
+        candidates.sort(key=lambda item:-item[0])
+        for score,i,invert,source in candidates:
+            runner_up=max([item[0] for item in candidates if item[1]!=i],default=0)
+            candidate_list.append((max(score-0.5*runner_up,0),bone_type,i,invert,source))
+    candidate_list.sort(key=lambda item:-item[0])
+    result={}
+    used_set=set()
+    for confidence,bone_type,i,invert,source in candidate_list:
+        if bone_type in result or i in used_set:
+            continue
+        result[bone_type]={'bone':skeleton.names[i],'invert':bool(invert),'confidence':round(confidence,3),'source':source}
+        used_set.add(i)
+    return result
+
+#bone_list:(名称,父级名称,头,尾),Z向上,角色面向-Y,左侧为+X
+#bone_list: (name, parent name, head, tail), Z up, facing -Y, left is +X
+def infer_bone_types(bone_list,name_table):
+    skeleton=Skeleton(bone_list)
+    evidence=Evidence()
+    exact_dict,pattern_dict=name_table
+    add_name_evidence(skeleton,evidence,exact_dict,pattern_dict)
+    add_topology_evidence(skeleton,evidence)
+    return resolve(skeleton,evidence)
+
+def get_bone_list(obj):
+    matrix=obj.matrix_world.to_3x3()
+    bone_list=[]
+    for bone in obj.data.bones:
+        bone_list.append((bone.name,bone.parent.name if bone.parent else None,tuple(matrix@bone.head_local),tuple(matrix@bone.tail_local)))
+    return bone_list
+
+def infer_arm(obj):
+    name_table=build_name_table(preset.preset_dict_dict)
+    return infer_bone_types(get_bone_list(obj),name_table)
+
+class OT_Infer_Bone_Type(Operator):
+    bl_idname = "mmr.infer_bone_type" # python 提示
+    bl_label = "Infer Bone Type"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    threshold:bpy.props.FloatProperty(default=0.5,min=0,max=1,description="低于此置信度的骨骼需要手动检查")
+
+    def execute(self,context):
+        obj=context.view_layer.objects.active
+        if obj==None or obj.type!='ARMATURE':
+            alert_error("提示","所选对象不是骨骼！")
+            return{"CANCELLED"}
+        result=infer_arm(obj)
+        preset.set_bone_type(obj.pose,{data['bone']:[bone_type,data['invert']] for bone_type,data in result.items()})
+
+        #选中低置信度的骨骼供手动检查
+        #select the low confidence bones for a manual check
+        low_list=[bone_type for bone_type,data in result.items() if data['confidence']<self.threshold]
+        missing_list=[bone_type for bone_type in preset.rigify_bone_type_list if preset.is_bone_type(bone_type) and bone_type not in result]
+        if context.mode!='POSE':
+            bpy.ops.object.mode_set(mode = 'POSE')
+        for bone in obj.data.bones:
+            bone.select=False
+        for bone_type in low_list:
+            obj.data.bones[result[bone_type]['bone']].select=True
+        message='已推断%d个骨骼类型'%len(result)
+        if low_list:
+            message+=',低置信度:'+' '.join(low_list)
+        if missing_list:
+            message+=',缺失:'+' '.join(missing_list)
+        alert_error("提示",message)
+        return{"FINISHED"}
+
+Class_list=[OT_Infer_Bone_Type]
@@ -0,0 +1,354 @@
+import numpy as np
+from . import vector_math
+from . import vmd
+from . import fcurve_utils
+
+#MMD骨骼的解析求解
+#不再逐帧播放场景烘焙,而是用NumPy一次计算所有帧的前向运动学,IK和约束
+#analytic evaluation of the MMD leg rig, forward kinematics, IK and
+#constraints are computed for all frames at once instead of stepping the scene
+
+identity_quaternion=np.array((1,0,0,0),dtype=np.float64)
+y_axis=np.array((0,1,0),dtype=np.float64)
+x_axis=np.array((1,0,0),dtype=np.float64)
+copy_constraint_types={'COPY_TRANSFORMS','COPY_ROTATION','COPY_LOCATION'}
+
+#三次贝塞尔缓动,先二分求参数t再求y
+#cubic bezier easing, bisect x(t)=u then evaluate y(t)
+def bezier_ease(u,x1,y1,x2,y2,iterations=20):
+    shape=np.broadcast(u,x1).shape
+    u=np.broadcast_to(u,shape)
+    low=np.zeros(shape)
+    high=np.ones(shape)
+    for i in range(iterations):
+        t=(low+high)*0.5
+        s=1-t
+        x=3*s*s*t*x1+3*s*t*t*x2+t*t*t
+        smaller=x<u
+        low=np.where(smaller,t,low)
+        high=np.where(smaller,high,t)
+    t=(low+high)*0.5
+    s=1-t
+    return 3*s*s*t*y1+3*s*t*t*y2+t*t*t
+
+#按帧采样一条VMD轨道,结果与导入后的曲线求值一致
+#sample a VMD track on every frame, matching the imported fcurves
+def sample_bone_track(track,pose_bone,frames):
+    key_frames=track['frame'].astype(np.float64)+1
+    locations,quaternions,axis_list=vmd.convert_bone_track(track,pose_bone)
+    interpolation=vmd.get_interpolation(track)
+
+    last=len(key_frames)-1
+    seg=np.clip(np.searchsorted(key_frames,frames,side='right')-1,0,last)
+    nxt=np.minimum(seg+1,last)
+    span=key_frames[nxt]-key_frames[seg]
+    u=(frames-key_frames[seg])/np.where(span>0,span,1)
+    u=np.clip(np.where(span>0,u,0),0,1)
+
+    bezier=interpolation[nxt]
+    eased=bezier_ease(u[:,None],bezier[:,0],bezier[:,1],bezier[:,2],bezier[:,3])
+
+    loc=locations[seg]+(locations[nxt]-locations[seg])*eased[:,axis_list]
+    q=quaternions[seg]+(quaternions[nxt]-quaternions[seg])*eased[:,3:4]
+    return loc,vector_math.quaternion_normalize(q)
+
+#绕骨骼X轴的转角,膝盖只有这一个自由度
+#angle around the local X axis, the only free axis of a knee
+def x_angle(q):
+    return 2*np.arctan2(q[...,1],q[...,0])
+
+def wrap_angle(angle):
+    return (angle+np.pi)%(2*np.pi)-np.pi
+
+class ArmaturePose:
+
+    def __init__(self,arm,frames):
+        self.arm=arm
+        self.frames=np.asarray(frames,dtype=np.float64)
+        frame_len=len(self.frames)
+        bones=arm.data.bones
+        self.names=[bone.name for bone in bones]
+        self.index={name:i for i,name in enumerate(self.names)}
+        self.pose_bones=[arm.pose.bones[name] for name in self.names]
+        self.parent=[self.index[bone.parent.name] if bone.parent else -1 for bone in bones]
+        self.length=np.array([bone.length for bone in bones])
+
+        depth=[]
+        for i in range(len(self.names)):
+            d=0
+            p=self.parent[i]
+            while p!=-1:
+                d+=1
+                p=self.parent[p]
+            depth.append(d)
+        self.order=sorted(range(len(self.names)),key=lambda i:depth[i])
+        self.depth=depth
+        self.children=[[] for i in self.names]
+        for i in self.order:
+            if self.parent[i]!=-1:
+                self.children[self.parent[i]].append(i)
+
+        #父骨骼坐标系下的静置变换
+        #rest transform relative to the parent
+        rest_q=np.array([tuple(bone.matrix_local.to_quaternion()) for bone in bones],dtype=np.float64).reshape(-1,4)
+        head=np.array([tuple(bone.head_local) for bone in bones],dtype=np.float64).reshape(-1,3)
+        self.rest_q=rest_q
+        self.rel_q=rest_q.copy()
+        self.rel_t=head.copy()
+        for i,p in enumerate(self.parent):
+            if p!=-1:
+                parent_inv=vector_math.quaternion_conjugate(rest_q[p])
+                self.rel_q[i]=vector_math.quaternion_multiply(parent_inv,rest_q[i])
+                self.rel_t[i]=vector_math.quaternion_rotate(parent_inv,head[i]-head[p])
+
+        #没有动作的骨骼保持当前姿态
+        #bones without motion keep their current pose
+        self.basis_q=[]
+        self.basis_t=[]
+        for pose_bone in self.pose_bones:
+            basis=pose_bone.matrix_basis
+            self.basis_q.append(np.broadcast_to(np.array(tuple(basis.to_quaternion())),(frame_len,4)))
+            self.basis_t.append(np.broadcast_to(np.array(tuple(basis.translation)),(frame_len,3)))
+        self.world_q=[None]*len(self.names)
+        self.world_t=[None]*len(self.names)
+
+    def set_motion(self,motion):
+        for i,pose_bone in enumerate(self.pose_bones):
+            name_j=vmd.get_name_j(pose_bone)
+            if name_j in motion.bone_tracks:
+                track=motion.bone_track(name_j)
+                self.basis_t[i],self.basis_q[i]=sample_bone_track(track,pose_bone,self.frames)
+
+    #付与(肩P到肩C等),按mmd_tools的骨骼属性叠加目标骨骼的局部变换
+    #additional transform (shoulder P/C cancel, twist), read from mmd_tools' bone properties
+    def apply_additional_transform(self):
+        source_q=list(self.basis_q)
+        source_t=list(self.basis_t)
+        for i,pose_bone in enumerate(self.pose_bones):
+            mmd_bone=getattr(pose_bone,'mmd_bone',None)
+            if mmd_bone is None:
+                continue
+            has_rotation=mmd_bone.has_additional_rotation
+            has_location=mmd_bone.has_additional_location
+            target_name=mmd_bone.additional_transform_bone
+            if not (has_rotation or has_location) or target_name not in self.index:
+                continue
+            j=self.index[target_name]
+            influence=mmd_bone.additional_transform_influence
+            #目标骨骼轴向转换到自身轴向
+            #express the target's local frame in this bone's frame
+            q_frame=vector_math.quaternion_multiply(vector_math.quaternion_conjugate(self.rest_q[i]),self.rest_q[j])
+            if has_rotation:
+                q=source_q[j]
+                if influence<0:
+                    q=vector_math.quaternion_conjugate(q)
+                q=vector_math.quaternion_slerp(identity_quaternion,q,np.full(len(q),abs(influence)))
+                q=vector_math.quaternion_multiply(vector_math.quaternion_multiply(q_frame,q),vector_math.quaternion_conjugate(q_frame))
+                self.basis_q[i]=vector_math.quaternion_multiply(q,self.basis_q[i])
+            if has_location:
+                t=vector_math.quaternion_rotate(q_frame,source_t[j])*influence
+                self.basis_t[i]=self.basis_t[i]+t
+
+    def parent_world(self,i):
+        p=self.parent[i]
+        if p==-1:
+            return identity_quaternion,np.zeros(3)
+        return self.world_q[p],self.world_t[p]
+
+    #前向运动学,只更新i及其子骨骼,i为None时更新全部
+    #forward kinematics for bone i and its children, or every bone
+    def update(self,i=None):
+        if i is None:
+            stack=self.order
+        else:
+            stack=[]
+            pending=[i]
+            while pending:
+                b=pending.pop()
+                stack.append(b)
+                pending.extend(self.children[b])
+            stack.sort(key=lambda b:self.depth[b])
+        for b in stack:
+            parent_q,parent_t=self.parent_world(b)
+            q_local=vector_math.quaternion_multiply(parent_q,self.rel_q[b])
+            self.world_q[b]=vector_math.quaternion_multiply(q_local,self.basis_q[b])
+            self.world_t[b]=parent_t+vector_math.quaternion_rotate(parent_q,self.rel_t[b]+vector_math.quaternion_rotate(self.rel_q[b],self.basis_t[b]))
+
+    def tail(self,i):
+        return self.world_t[i]+vector_math.quaternion_rotate(self.world_q[i],y_axis*self.length[i])
+
+    #由世界变换反求局部变换
+    #local basis from a pose space transform
+    def get_basis(self,i,world_q,world_t):
+        parent_q,parent_t=self.parent_world(i)
+        q_local=vector_math.quaternion_multiply(parent_q,self.rel_q[i])
+        basis_q=vector_math.quaternion_multiply(vector_math.quaternion_conjugate(q_local),world_q)
+        offset=vector_math.quaternion_rotate(vector_math.quaternion_conjugate(parent_q),world_t-parent_t)-self.rel_t[i]
+        basis_t=vector_math.quaternion_rotate(vector_math.quaternion_conjugate(self.rel_q[i]),offset)
+        return basis_q,basis_t
+
+    def set_world(self,i,world_q,world_t=None):
+        if world_t is None:
+            world_t=self.world_t[i]
+        self.basis_q[i],self.basis_t[i]=self.get_basis(i,world_q,world_t)
+        self.update(i)
+
+    #让骨骼绕头部转动,使effector指向target
+    #swing bone i around its head so that effector points at target
+    def swing(self,i,effector,target,fallback_axis):
+        head=self.world_t[i]
+        delta=vector_math.quaternion_rotation_difference(effector-head,target-head,fallback_axis)
+        self.set_world(i,vector_math.quaternion_multiply(delta,self.world_q[i]))
+
+    def get_x_limit(self,i):
+        pose_bone=self.pose_bones[i]
+        for c in pose_bone.constraints:
+            if c.type=='LIMIT_ROTATION' and not c.mute and c.use_limit_x:
+                return c.min_x,c.max_x
+        if pose_bone.use_ik_limit_x:
+            return pose_bone.ik_min_x,pose_bone.ik_max_x
+        return None
+
+    #两骨骼IK(足ＩＫ):膝盖按余弦定理绕X轴弯曲,再整体摆向目标
+    #two bone IK (leg IK), bend the knee on its X axis by the law of cosines,
+    #then swing the thigh onto the target
+    def solve_two_bone(self,upper,lower,target):
+        root=self.world_t[upper]
+        knee=self.world_t[lower]
+        axis=vector_math.quaternion_rotate(self.world_q[lower],x_axis)
+        u=knee-root
+        v=self.tail(lower)-knee
+        u_par=np.sum(u*axis,axis=-1)
+        v_par=np.sum(v*axis,axis=-1)
+        u_perp=u-u_par[:,None]*axis
+        v_perp=v-v_par[:,None]*axis
+        a=np.linalg.norm(u_perp,axis=-1)
+        b=np.linalg.norm(v_perp,axis=-1)
+        d2=np.sum((target-root)**2,axis=-1)
+        cos_psi=(d2-(u_par+v_par)**2-a*a-b*b)/np.maximum(2*a*b,1e-12)
+        psi=np.arccos(np.clip(cos_psi,-1,1))
+        phi=np.arctan2(np.sum(axis*np.cross(u_perp,v_perp),axis=-1),np.sum(u_perp*v_perp,axis=-1))
+
+        #两个弯曲方向,优先选满足限制且转动较小的
+        #two bend directions, prefer the one inside the limits with the smaller turn
+        current=x_angle(self.basis_q[lower])
+        candidates=np.stack((wrap_angle(psi-phi),wrap_angle(-psi-phi)))
+        limit=self.get_x_limit(lower)
+        if limit:
+            total=current+candidates
+            clamped=np.clip(total,limit[0],limit[1])
+            cost=np.abs(clamped-total)*10+np.abs(clamped-current)
+            candidates=clamped-current
+        else:
+            cost=np.abs(candidates)
+        theta=np.where(cost[0]<=cost[1],candidates[0],candidates[1])
+
+        self.basis_q[lower]=vector_math.quaternion_multiply(self.basis_q[lower],vector_math.axis_quaternion(theta,0))
+        self.update(lower)
+        self.swing(upper,self.tail(lower),target,axis)
+
+    #其他链长用CCD
+    #other chain lengths fall back to CCD
+    def solve_ccd(self,chain,owner,target,iterations):
+        for i in range(iterations):
+            for b in chain:
+                axis=vector_math.quaternion_rotate(self.world_q[b],x_axis)
+                self.swing(b,self.tail(owner),target,axis)
+
+    def solve_ik(self):
+        ik_list=[]
+        for i,pose_bone in enumerate(self.pose_bones):
+            for c in pose_bone.constraints:
+                if c.type!='IK' or c.mute or c.influence==0:
+                    continue
+                if c.target!=self.arm or c.subtarget not in self.index:
+                    continue
+                ik_list.append((i,c))
+        #先解父级的IK,脚踝的つま先ＩＫ在足ＩＫ之后
+        #parents first, so toe IK runs after leg IK
+        ik_list.sort(key=lambda item:self.depth[item[0]])
+
+        for owner,c in ik_list:
+            chain=[]
+            b=owner
+            while b!=-1 and (c.chain_count==0 or len(chain)<c.chain_count):
+                chain.append(b)
+                b=self.parent[b]
+            target=self.world_t[self.index[c.subtarget]]
+            pose_bone=self.pose_bones[owner]
+            if len(chain)==1:
+                axis=vector_math.quaternion_rotate(self.world_q[owner],x_axis)
+                self.swing(owner,self.tail(owner),target,axis)
+            elif len(chain)==2 and pose_bone.lock_ik_y and pose_bone.lock_ik_z:
+                self.solve_two_bone(chain[1],chain[0],target)
+            else:
+                self.solve_ccd(chain,owner,target,min(c.iterations,50))
+
+    #烘焙骨骼的复制约束,mmd_tools自身的付与约束已在前面处理
+    #copy constraints of the baked bones, mmd_tools' own constraints are handled above
+    def apply_copy_constraints(self,names):
+        bone_set=set()
+        for name in names:
+            b=self.index[name]
+            while b!=-1:
+                bone_set.add(b)
+                b=self.parent[b]
+        for i in self.order:
+            if i not in bone_set:
+                continue
+            for c in self.pose_bones[i].constraints:
+                if c.type not in copy_constraint_types or c.mute or c.influence==0:
+                    continue
+                if c.name.startswith('mmd_') or c.target!=self.arm or c.subtarget not in self.index:
+                    continue
+                j=self.index[c.subtarget]
+                weight=np.full(len(self.frames),c.influence)
+                if c.owner_space=='LOCAL' and c.target_space=='LOCAL':
+                    if c.type!='COPY_LOCATION':
+                        self.basis_q[i]=vector_math.quaternion_slerp(self.basis_q[i],self.basis_q[j],weight)
+                    if c.type!='COPY_ROTATION':
+                        self.basis_t[i]=self.basis_t[i]+(self.basis_t[j]-self.basis_t[i])*c.influence
+                    self.update(i)
+                    continue
+                world_q=self.world_q[i]
+                world_t=self.world_t[i]
+                if c.type!='COPY_LOCATION':
+                    world_q=vector_math.quaternion_slerp(world_q,self.world_q[j],weight)
+                if c.type!='COPY_ROTATION':
+                    target_t=self.world_t[j]
+                    head_tail=getattr(c,'head_tail',0)
+                    if head_tail:
+                        target_t=target_t+(self.tail(j)-target_t)*head_tail
+                    world_t=world_t+(target_t-world_t)*c.influence
+                self.set_world(i,world_q,world_t)
+
+    #写入烘焙曲线,与nla.bake一样每帧一个关键帧
+    #write baked curves, one key per frame like nla.bake
+    def write_bones(self,action,names):
+        fcurves=action.fcurves
+        for name in names:
+            i=self.index[name]
+            pose_bone=self.pose_bones[i]
+            basis_q=vector_math.quaternion_make_continuous(self.basis_q[i])
+            basis_t=np.asarray(self.basis_t[i])
+            path=pose_bone.path_from_id('location')
+            for index in range(3):
+                fcurve=fcurve_utils.new_fcurve(fcurves,path,index,name)
+                fcurve_utils.set_keyframes(fcurve,self.frames,basis_t[:,index],'BEZIER')
+            path=pose_bone.path_from_id('rotation_quaternion')
+            for index in range(4):
+                fcurve=fcurve_utils.new_fcurve(fcurves,path,index,name)
+                fcurve_utils.set_keyframes(fcurve,self.frames,basis_q[:,index],'BEZIER')
+
+#代替MMD_leg场景的nla.bake
+#replaces nla.bake of the MMD_leg scene
+def bake_motion(motion,arm,bake_name_list,frame_start,frame_end):
+    frames=np.arange(frame_start,frame_end+1,dtype=np.float64)
+    pose=ArmaturePose(arm,frames)
+    pose.set_motion(motion)
+    pose.apply_additional_transform()
+    pose.update()
+    pose.solve_ik()
+    pose.apply_copy_constraints(bake_name_list)
+    pose.write_bones(arm.animation_data.action,bake_name_list)
+    return pose
@@ -1,11 +1,10 @@
 import bpy
 import bmesh
 from bpy.types import Operator
-
-def alert_error(title,message):
-    def draw(self,context):
-        self.layout.label(text=str(message))
-    bpy.context.window_manager.popup_menu(draw,title=title,icon='ERROR')
+from .alert import alert_error
+from . import physics_graph
+from . import weight_merge
+from . import cloth_topology
 
 def convert_rigid_body_to_cloth(context):
 
@@ -33,20 +32,16 @@ def convert_rigid_body_to_cloth(context):
                     alert_error("提示","所选物体中没有MMD刚体")
                     return(False)
 
+    mmd_parent=select_rigid_body[0].parent.parent
+    #整个模型的物理图只建立一次
+    #the physics graph of the model is built once
+    graph=physics_graph.PhysicsGraph(mmd_parent)
+
     if mmr_property.auto_select_rigid_body:
-        bpy.ops.object.select_all(action='DESELECT')
-        bpy.context.view_layer.objects.active=select_rigid_body[0]
-        bpy.ops.mmd_tools.rigid_body_select(properties={'collision_group_number'})
-        rigid_bodys=[]
-        for obj in bpy.context.selected_objects:
-            if hasattr(obj,'mmd_rigid'):
-                if obj.mmd_rigid.name != ''and obj.mmd_rigid.type != '0':
-                    rigid_bodys.append(obj)
+        rigid_bodys=graph.get_group(select_rigid_body[0])
     else:
         rigid_bodys=select_rigid_body
 
-    mmd_parent=select_rigid_body[0].parent.parent
-
     if mmr_property.auto_select_mesh:
         for obj in mmd_parent.children:
             if obj.type=="ARMATURE":
@@ -64,6 +59,25 @@ def convert_rigid_body_to_cloth(context):
             
     mmd_arm=mmd_mesh_object.parent
 
+    #按关节相连的部分拆分成多个布料,各自有钉固顶点组和修改器
+    #one cloth per part connected by joints, each with its own pin groups and modifiers
+    if mmr_property.split_cloth:
+        body_lists=graph.get_components(rigid_bodys)
+    else:
+        body_lists=[rigid_bodys]
+
+    summary=[]
+    for body_list in body_lists:
+        cloth_obj=build_cloth(context,graph,body_list,mmd_parent,mmd_arm,mmd_mesh_object)
+        summary.append('%s: %d刚体, %d顶点'%(cloth_obj.name,len(body_list),len(cloth_obj.data.vertices)))
+    if mmr_property.split_cloth:
+        alert_error("提示","生成%d个布料\n"%len(body_lists)+'\n'.join(summary))
+
+#把一组刚体转换为一个布料物体
+#convert one list of rigid bodies into one cloth object
+def build_cloth(context,graph,rigid_bodys,mmd_parent,mmd_arm,mmd_mesh_object):
+
+    mmr_property=context.scene.mmr_property
     rigid_bodys_count=len(rigid_bodys)
     joints=[]
     side_joints=[]
@@ -81,23 +95,19 @@ def convert_rigid_body_to_cloth(context):
             radius=r.mmd_rigid.size[0]
         mean_radius+=radius
 
-        bone=mmd_arm.pose.bones[r.mmd_rigid.bone]
+        bone=mmd_arm.pose.bones[graph.get_bone_name(r)]
         verts.append(r.location)
         bones_list.append(bone)
 
     mean_radius/=rigid_bodys_count
 
-    for obj in bpy.context.view_layer.objects:
-        if hasattr(obj,'rigid_body_constraint'):
-            if obj.rigid_body_constraint!=None:
-                if obj.rigid_body_constraint.object1 in rigid_bodys and obj.rigid_body_constraint.object2 in rigid_bodys:
-                    joints.append(obj)
-                    index1=rigid_bodys.index(obj.rigid_body_constraint.object1)
-                    index2=rigid_bodys.index(obj.rigid_body_constraint.object2)
-                    edge_index.append([index1,index2])
-                    edges.append([index1,index2])
-                elif obj.rigid_body_constraint.object1 in rigid_bodys or obj.rigid_body_constraint.object2 in rigid_bodys:
-                    side_joints.append(obj)
+    #只查询与所选刚体相连的关节
+    #only the joints touching the selected bodies are visited
+    joint_list,side_joint_list=graph.split_joints(rigid_bodys)
+    for obj,index1,index2 in joint_list:
+        joints.append(obj)
+        edge_index.append([index1,index2])
+        edges.append([index1,index2])
     
 
     mesh=bpy.data.meshes.new('mmd_cloth')
@@ -110,15 +120,11 @@ def convert_rigid_body_to_cloth(context):
     #add pin vertex groups
     pin_vertex_group=cloth_obj.vertex_groups.new(name='mmd_cloth_pin')
     skin_vertex_groups_index=[pin_vertex_group.index]
-    for obj in side_joints:
-        if obj.rigid_body_constraint.object1 in rigid_bodys:
-            side_rigid_body=obj.rigid_body_constraint.object1
-            pin_rigid_body=obj.rigid_body_constraint.object2
-        else:
-            side_rigid_body=obj.rigid_body_constraint.object2
-            pin_rigid_body=obj.rigid_body_constraint.object1
+    local_index={obj:i for i,obj in enumerate(rigid_bodys)}
+    for obj,side_rigid_body,pin_rigid_body in side_joint_list:
+        side_joints.append(obj)
         
-        index1=rigid_bodys.index(side_rigid_body)
+        index1=local_index[side_rigid_body]
         pin_index=[index1]
 
         pin_bone_name=pin_rigid_body.mmd_rigid.bone
@@ -147,14 +153,7 @@ def convert_rigid_body_to_cloth(context):
 
         #删除多余边
         #remove extra edge
-        for e in bm.edges:
-            true_edge=False
-            for i in edge_index:
-                if e.verts[0].index in i and e.verts[1].index in i:
-                    true_edge=True
-                    break
-            if true_edge==False:
-                bm.edges.remove(e)
+        cloth_topology.remove_fill_edges(bm,edge_index)
         bm.faces.ensure_lookup_table()
 
     #尝试标记出头发,飘带
@@ -170,75 +169,26 @@ def convert_rigid_body_to_cloth(context):
     bm.clear()
     bm.from_mesh(mesh)'''
 
-    ribbon_verts=[v for v in bm.verts if v.is_wire]
-    if mmr_property.extend_ribbon:
-        boundary_verts=set(ribbon_verts)
-        boundary_verts2=[]
-        while len(boundary_verts) != 0:
-            boundary_verts2.clear()
-            for v in boundary_verts:
-                for e in v.link_edges:
-                    for v2 in e.verts:
-                        if v2 not in ribbon_verts:
-                            ribbon_verts.append(v2)
-                            boundary_verts2.append(v2)
-            boundary_verts=set(boundary_verts2)
-            boundary_verts2.clear()
-
-    all_ribbon=True
-    for f in bm.faces:
-        ribbon_face=False
-        for v in f.verts:
-            if v in ribbon_verts:
-                ribbon_face=True
-        if ribbon_face==False:
-            all_ribbon=False
+    ribbon_verts=cloth_topology.get_ribbon_verts(bm,mmr_property.extend_ribbon)
+    all_ribbon=cloth_topology.is_all_ribbon(bm,ribbon_verts)
 
     #标记出特殊边和点
     #These are special edge and vertex
 
-    up_edges=[]
-    down_edges=[]
-    side_edges=[]
-    up_verts=[]
-    down_verts=[]
-    side_verts=[]
-
     #标出头部，尾部，飘带顶点
     #try mark head,tail,ribbon vertex
     bm.verts.ensure_lookup_table()
     bm.edges.ensure_lookup_table()
+    up_verts,down_verts=cloth_topology.classify_verts(bm,bones_list)
     for i in range(len(bm.verts)):
         v=bm.verts[i]
         bone=bones_list[i]
-        if bone.bone.use_connect==False and v.is_boundary:
-            up_verts.append(v)
-        elif bone.parent not in bones_list:
-            up_verts.append(v)
-        elif len(bone.children)==0:
-            down_verts.append(v)
-        elif bone.children[0] not in bones_list:
-            down_verts.append(v)
         if v in ribbon_verts and mmr_property.cloth_convert_mod=='Auto' or mmr_property.cloth_convert_mod=='Bone Constrain':
             v.co=bone.tail
 
     #标出头部，尾部，飘带边
     #try mark head,tail,ribbon edge
-    for i in range(len(bm.edges)):
-        e=bm.edges[i]
-        vert1=e.verts[0]
-        vert2=e.verts[1]
-        if e.is_boundary:
-            if vert1 in  up_verts and vert2 in up_verts:
-                up_edges.append(e)
-            elif vert1 in down_verts and vert2 in down_verts:
-                down_edges.append(e)
-            else:
-                side_edges.append(e)
-                if e.verts[0] not in side_verts:
-                    side_verts.append(e.verts[0])
-                if e.verts[1] not in side_verts:
-                    side_verts.append(e.verts[1])
+    up_edges,down_edges,side_edges,side_verts=cloth_topology.classify_edges(bm,up_verts,down_verts)
 
     #延长头部顶点 
     #extend root vertex
@@ -266,8 +216,8 @@ def convert_rigid_body_to_cloth(context):
 
         new_up_verts[v.index]=new_vert
         if v in side_verts:
-            side_verts.append(new_vert)
-            side_edges.append(new_edge)
+            side_verts.add(new_vert)
+            side_edges.add(new_edge)
 
     #延长尾部顶点
     #extend tail vertex
@@ -285,8 +235,8 @@ def convert_rigid_body_to_cloth(context):
             new_edge=bm.edges.new([v,new_vert])
             new_down_verts[v.index]=new_vert
             if v in side_verts:
-                side_verts.append(new_vert)
-                side_edges.append(new_edge)
+                side_verts.add(new_vert)
+                side_edges.add(new_edge)
 
     for e in up_edges:
         vert1=e.verts[0]
@@ -419,12 +369,6 @@ def convert_rigid_body_to_cloth(context):
     #准备阶段
     # preparation
     unnecessary_vertex_groups: type.List[bpy.types.VertexGroup] = []
-    mmd_mesh: bpy.types.Mesh = mmd_mesh_object.data
-    mmd_bm: bmesh.types.BMesh = bmesh.new()
-    mmd_bm.from_mesh(mmd_mesh)
-
-    mmd_bm.verts.layers.deform.verify()
-    deform_layer = mmd_bm.verts.layers.deform.active
 
     for i in range(rigid_bodys_count):
         v=bm.verts[i]
@@ -442,22 +386,13 @@ def convert_rigid_body_to_cloth(context):
             con.rest_length = bone.length
         else:
             from_vertex_group = mmd_mesh_object.vertex_groups[name]
-            from_index = from_vertex_group.index
             unnecessary_vertex_groups.append(from_vertex_group)
-
-            vert: bmesh.types.BMVert
-            for vert in mmd_bm.verts:
-                deform_vert: bmesh.types.BMDeformVert = vert[deform_layer]
-                if from_index not in deform_vert:
-                    continue
-
-                to_index = deform_vertex_group.index
-                deform_vert[to_index] = deform_vert.get(to_index, 0.0) + deform_vert[from_index]
     
         bpy.data.objects.remove(obj)
 
-    mmd_bm.to_mesh(mmd_mesh)
-    mmd_bm.free()
+    #所有刚体的骨骼顶点组一次合并到形变顶点组
+    #fold the bone groups of all bodies into the deform group in one pass
+    weight_merge.merge_weights(mmd_mesh_object,unnecessary_vertex_groups,deform_vertex_group)
     for vertex_group in unnecessary_vertex_groups:
         mmd_mesh_object.vertex_groups.remove(vertex_group)
 
@@ -469,6 +404,7 @@ def convert_rigid_body_to_cloth(context):
         bpy.ops.object.surfacedeform_bind(modifier=mod.name)
 
     bm.free()
+    return cloth_obj
 
 class OT_Convert_Rigid_Body_To_Cloth(Operator):
     bl_idname = "mmr.convert_rigid_body_to_cloth" # python 提示
@@ -0,0 +1,128 @@
+import bpy
+
+#物理图索引:遍历一次物体,建立刚体,关节,碰撞组和骨骼的哈希表,
+#布料转换和隐藏裙子直接查询,不再对刚体列表做in和index查找
+#physics graph index: one pass over the objects builds hash maps for the
+#rigid bodies, joints, collision groups and bones of a model, so the cloth
+#conversion and hide_skirt query them instead of scanning body lists
+
+def is_rigid_body(obj):
+    if obj.type!='MESH' or not hasattr(obj,'mmd_rigid'):
+        return False
+    return obj.mmd_rigid.name!='' and obj.mmd_rigid.type!='0'
+
+def is_joint(obj):
+    return getattr(obj,'rigid_body_constraint',None)!=None
+
+#刚体的模型根物体,刚体的父级是rigidbodies空物体
+#model root of a rigid body, its parent is the rigidbodies empty
+def get_model_root(obj):
+    if obj.parent==None:
+        return None
+    return obj.parent.parent
+
+class PhysicsGraph:
+
+    def __init__(self,root,objects=None):
+        self.root=root
+        #刚体:序号
+        #rigid body: index
+        self.body_index={}
+        self.bodies=[]
+        self.body_bone=[]
+        #碰撞组:刚体序号列表
+        #collision group: body indices
+        self.group_bodies={}
+        #关节:(刚体1序号,刚体2序号),不属于模型的一端为-1
+        #joint: (body1 index, body2 index), -1 for an end outside the model
+        self.joint_bodies={}
+        #刚体序号:关节列表
+        #body index: joints
+        self.body_joints={}
+
+        if objects==None:
+            objects=bpy.context.view_layer.objects
+        joint_list=[]
+        for obj in objects:
+            if is_rigid_body(obj):
+                if get_model_root(obj)==root:
+                    index=len(self.bodies)
+                    self.body_index[obj]=index
+                    self.bodies.append(obj)
+                    self.body_bone.append(obj.mmd_rigid.bone)
+                    self.group_bodies.setdefault(obj.mmd_rigid.collision_group_number,[]).append(index)
+            elif is_joint(obj):
+                joint_list.append(obj)
+
+        for obj in joint_list:
+            constraint=obj.rigid_body_constraint
+            index1=self.body_index.get(constraint.object1,-1)
+            index2=self.body_index.get(constraint.object2,-1)
+            if index1<0 and index2<0:
+                continue
+            self.joint_bodies[obj]=(index1,index2)
+            for index in (index1,index2):
+                if index>=0:
+                    self.body_joints.setdefault(index,[]).append(obj)
+        self.joint_order={obj:i for i,obj in enumerate(self.joint_bodies)}
+
+    #不属于模型的刚体直接读取
+    #bodies outside the model are read directly
+    def get_bone_name(self,body):
+        index=self.body_index.get(body)
+        if index==None:
+            return body.mmd_rigid.bone
+        return self.body_bone[index]
+
+    #与所给刚体碰撞组相同的刚体,与mmd_tools按碰撞组选择一致
+    #bodies in the collision group of the given body, as mmd_tools selects them
+    def get_group(self,body):
+        group_number=body.mmd_rigid.collision_group_number
+        return [self.bodies[index] for index in self.group_bodies.get(group_number,[])]
+
+    #把与所给刚体相连的关节分为内部关节和边缘关节
+    #内部关节返回(关节,序号1,序号2),序号为在body_list中的位置
+    #边缘关节返回(关节,内侧刚体,外侧刚体)
+    #split the joints touching the given bodies into inner joints, returned as
+    #(joint, index1, index2) with indices into body_list, and side joints,
+    #returned as (joint, inner body, outer body)
+    def split_joints(self,body_list):
+        local_index={body:i for i,body in enumerate(body_list)}
+        joint_set=set()
+        for body in body_list:
+            joint_set.update(self.body_joints.get(self.body_index.get(body,-1),()))
+
+        joints=[]
+        side_joints=[]
+        for obj in sorted(joint_set,key=self.joint_order.__getitem__):
+            constraint=obj.rigid_body_constraint
+            index1=local_index.get(constraint.object1,-1)
+            index2=local_index.get(constraint.object2,-1)
+            if index1>=0 and index2>=0:
+                joints.append((obj,index1,index2))
+            elif index1>=0:
+                side_joints.append((obj,constraint.object1,constraint.object2))
+            else:
+                side_joints.append((obj,constraint.object2,constraint.object1))
+        return joints,side_joints
+
+    #按内部关节把刚体分成相连的部分,每部分保持body_list中的顺序
+    #split the bodies into parts connected by inner joints, each part keeps
+    #the order of body_list
+    def get_components(self,body_list):
+        parent=list(range(len(body_list)))
+        def find(i):
+            while parent[i]!=i:
+                parent[i]=parent[parent[i]]
+                i=parent[i]
+            return i
+        joints,side_joints=self.split_joints(body_list)
+        for obj,index1,index2 in joints:
+            root1=find(index1)
+            root2=find(index2)
+            if root1!=root2:
+                parent[max(root1,root2)]=min(root1,root2)
+        component_dict={}
+        for i,body in enumerate(body_list):
+            component_dict.setdefault(find(i),[]).append(body)
+        return list(component_dict.values())
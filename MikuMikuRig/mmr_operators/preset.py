@@ -2,6 +2,7 @@ from types import prepare_class
 import bpy
 import os
 import json
+import zlib
 from . import rig
 from bpy.props import BoolProperty,IntProperty,FloatProperty,EnumProperty,StringProperty
 
@@ -78,9 +79,79 @@ bone_translate_dict_C={
 built_in_rig_dict_list=['None','MMD_JP','MMD_EN','VRoid']
 built_in_retarget_dict_list=['None','mixamo','Rigify','FBX动捕','BVH动捕']
 
+#骨骼类型索引:骨骼类型到骨骼名的字典以JSON保存在骨架物体上,
+#用骨骼数和骨骼名的校验值判断是否过期,避免每次都遍历所有姿态骨骼
+#bone type index: the bone type to bone name dictionary is kept as JSON on the
+#armature object and checked against a bone count/name checksum, so lookups
+#do not scan every pose bone through RNA
+index_property_name='mmr_bone_type_index'
+
+def get_bone_hash(obj):
+    names=obj.data.bones.keys()
+    return '%d:%08x'%(len(names),zlib.crc32('\0'.join(names).encode('utf-8')))
+
+def is_bone_type(bone_type):
+    return bone_type not in ('','None')
+
+def write_bone_type_index(obj,bone_type_dict,bone_hash=None):
+    obj[index_property_name]=json.dumps({'hash':bone_hash or get_bone_hash(obj),'types':bone_type_dict})
+
+def read_bone_type_index(obj):
+    try:
+        return json.loads(obj.get(index_property_name,''))
+    except ValueError:
+        return None
+
+#类型相同的多根骨骼取最后一根,与原来的遍历结果一致
+#the last bone wins when several bones share a type, as the old scans did
+def build_bone_type_dict(obj):
+    bone_type_dict={}
+    for bone in obj.pose.bones:
+        bone_type=bone.mmr_bone.bone_type
+        if is_bone_type(bone_type):
+            bone_type_dict[bone_type]=bone.name
+    return bone_type_dict
+
+#返回骨骼类型到骨骼名的字典,过期时重建
+#returns the bone type to bone name dictionary, rebuilt when stale
+def get_bone_type_dict(obj):
+    bone_hash=get_bone_hash(obj)
+    index=read_bone_type_index(obj)
+    if index and index['hash']==bone_hash:
+        return index['types']
+    bone_type_dict=build_bone_type_dict(obj)
+    write_bone_type_index(obj,bone_type_dict,bone_hash)
+    return bone_type_dict
+
+#修改单根骨骼的类型时同步更新索引
+#keep the index in step when a single bone type is changed
+def update_bone_type(self,context):
+    obj=self.id_data
+    index=read_bone_type_index(obj)
+    if index==None:
+        return
+    #self的路径为pose.bones["name"].mmr_bone
+    #the path of self is pose.bones["name"].mmr_bone
+    try:
+        bone_name=obj.path_resolve(self.path_from_id().rsplit('.',1)[0]).name
+    except ValueError:
+        return
+    #骨骼原来的类型可能还有其他骨骼在用,新类型也可能已有骨骼,
+    #这两种情况下索引无法判断哪根骨骼生效,从骨骼重建
+    #another bone may still carry the old type, or already carry the new one,
+    #the index cannot tell which bone wins then, so it is rebuilt from the bones
+    old_type_list=[bone_type for bone_type,name in index['types'].items() if name==bone_name]
+    if old_type_list or self.bone_type in index['types']:
+        write_bone_type_index(obj,build_bone_type_dict(obj),index['hash'])
+        return
+    bone_type_dict=dict(index['types'])
+    if is_bone_type(self.bone_type):
+        bone_type_dict[self.bone_type]=bone_name
+    write_bone_type_index(obj,bone_type_dict,index['hash'])
+
 #mmr骨骼属性类
 class MMR_bone(bpy.types.PropertyGroup):
-    bone_type:StringProperty(description=('Choose the bone type you want to use'))
+    bone_type:StringProperty(description=('Choose the bone type you want to use'),update=update_bone_type)
     invert:BoolProperty(default=False)
     mass:FloatProperty(default=0,description="bone mass",min=0)
 
@@ -142,15 +213,24 @@ def get_preset(pose):
     return(preset)
 
 def set_bone_type(pose,preset):
+    obj=pose.id_data
+    #先删除索引,逐根赋值时不再更新,最后整体写入
+    #drop the index first so the per bone updates skip it, then write it once
+    if index_property_name in obj:
+        del obj[index_property_name]
+    bone_type_dict={}
     posebones=pose.bones
     for bone in posebones:
         if bone.name in preset:
             bone_type,invert=preset[bone.name]
             bone.mmr_bone.invert=invert
             bone.mmr_bone.bone_type=bone_type
+            if is_bone_type(bone_type):
+                bone_type_dict[bone_type]=bone.name
         else:
             bone.mmr_bone.bone_type=''
             bone.mmr_bone.invert=False
+    write_bone_type_index(obj,bone_type_dict)
     
 def read_json(preset_type):
     global preset_dict_dict
@@ -544,6 +624,7 @@ class MMR_Arm_Panel(Mmr_Panel_Base):
             ot=layout.operator("mmr.rig_preset",text='Generate Rig Without Preset')
             ot.read=False
             layout.operator("mmr.qa_start",text='Start Quick Assign')
+            layout.operator("mmr.infer_bone_type",text='Infer Bone Type')
             layout.prop(mmr_property, "extra_options1", toggle=True,text='Extra Options')
             if mmr_property.extra_options1:
                 layout.prop(mmr_property,'bent_IK_bone',text="Bent IK bone")
@@ -608,6 +689,7 @@ class MMR_Retarget_Panel(Mmr_Panel_Base):
         #row.prop(mmr_property, 'IKFK_leg',expand=True)
         layout.operator("mmr.import_mixamo",text="Import FBX/BVH")
         layout.operator("mmr.import_vmd",text="Import VMD")
+        layout.operator("mmr.batch_import_motion",text="Batch Import Motion")
         layout.operator("mmr.export_vmd",text="Bake and export VMD animation")
         layout.prop(mmr_property, "extra_options2", toggle=True,text='Extra Options')
         if mmr_property.extra_options2:
@@ -617,6 +699,12 @@ class MMR_Retarget_Panel(Mmr_Panel_Base):
                 layout.prop(mmr_property,'action_scale',text="Animation scale")
             layout.prop(mmr_property,'lock_location',text="Lock animation location")
             layout.prop(mmr_property,'import_as_NLA_strip',text="Import as NLA strip")
+            layout.prop(mmr_property,'decimate_action',text="Decimate FBX/BVH keyframes")
+            if mmr_property.decimate_action:
+                layout.prop(mmr_property,'decimate_rotation',text="Rotation tolerance")
+                layout.prop(mmr_property,'decimate_translation',text="Translation tolerance")
+                layout.prop(mmr_property,'decimate_per_bone',text="Share keys per bone")
+            layout.operator("mmr.decimate_action",text="Decimate Action")
 Class_list=[
     MMR_Bone_Panel,MMR_Arm_Panel,OT_Add_Preset,OT_Delete_Preset,OT_Read_Preset,OT_Overwrite_Preset,OT_Rig_Preset,
     OT_QA_Start,OT_QA_End,OT_QA_Assign,OT_QA_Assign_Invert,OT_QA_Skip,MMR_Retarget_Panel,
@@ -1,88 +1,65 @@
 import bpy
 import bpy_extras
 import os
+import time
+import traceback
+import contextlib
 from bpy.types import Operator
 from . import preset
+from .alert import alert_error,capture_alert
+from . import vector_math
+from . import vmd
+from . import mmd_ik
+from . import fcurve_utils
+from . import retarget_cache
+from . import template
+from . import decimate
+from . import bvh
 from mathutils import Matrix,Vector,Quaternion,Euler
+import numpy as np
 
-def alert_error(title,message):
-    def draw(self,context):
-        self.layout.label(text=str(message))
-    bpy.context.window_manager.popup_menu(draw,title=title,icon='ERROR')
+#目标骨骼的状态,与导入的动作无关,批量导入时只计算一次
+#target side state, independent of the clip, computed once per batch
+def get_retarget_target(rigify_arm):
+    to_dict=preset.get_bone_type_dict(rigify_arm)
 
-def retarget_mixmao(OT,context):
-
-    scene=context.scene
-    mmr_property=scene.mmr_property
-    rigify_arm=context.view_layer.objects.active
-    #把路径转成小写
-    mixamo_path=OT.filepath.lower ()
-    lock_location=mmr_property.lock_location
-    fade_in_out=mmr_property.fade_in_out
-    action_scale=mmr_property.action_scale
-    auto_action_scale=mmr_property.auto_action_scale
-    IKFK_arm=mmr_property.IKFK_arm
-    IKFK_leg=mmr_property.IKFK_leg
-    debug=mmr_property.debug
-
-    if rigify_arm.type!='ARMATURE':
-        alert_error('警告','所选物体不是骨骼')
-        return(False)
-    if mixamo_path==None:
-        return(False)
-
-    #获得文件路径
-    #get file path
-    #my_dir = os.path.dirname(os.path.realpath(__file__))
-    #retarget_blend_file = os.path.join(my_dir, "mixamo_retarget_arm_ik.blend")
-    fname,fename=os.path.split(mixamo_path)
-    action_name=str(os.path.splitext(fename)[0])
-
-    #导入FBX或BVH文件
-    #import mixamo file
-    bpy.ops.object.mode_set(mode = 'OBJECT')
-    bpy.ops.object.select_all(action='DESELECT')
-    if mixamo_path.endswith(".fbx"):
-        bpy.ops.import_scene.fbx(filepath=mixamo_path,directory =fname)
-    elif mixamo_path.endswith(".bvh"):
-        bpy.ops.import_anim.bvh(filepath=mixamo_path, rotate_mode='QUATERNION')
-    else:
-        alert_error('警告','文件格式错误')
-        return(False)
-    for obj in bpy.data.objects:
-        if obj.select==True:
-            if obj.type=='ARMATURE':
-                mixamo_arm=obj
-            else:
-                bpy.data.objects.remove(obj,do_unlink=True)
-    mixamo_action=mixamo_arm.animation_data.action
-    rigify_action=mixamo_action.copy()
-    frame_range=mixamo_action.frame_range
-    rigify_action.name=action_name
+    mat_wb=rigify_arm.matrix_world.to_3x3()
+    q_wb=mat_wb.to_quaternion()
+    q_b_dict={}
+    for to_name in to_dict.values():
+        q_b_dict[to_name]=rigify_arm.data.bones[to_name].matrix_local.to_quaternion()
+
+    return {'to_dict':to_dict,'mat_wb':mat_wb,'q_wb':q_wb,'q_b_dict':q_b_dict}
+
+#重定向需要的源骨骼数据,原生读取BVH时由bvh.BvhMotion提供同样的数据
+#source side data of the retarget, bvh.BvhMotion provides the same layout
+#when the BVH is read natively
+def get_retarget_source(mixamo_arm):
+    from_dict=preset.get_bone_type_dict(mixamo_arm)
+    source={'from_dict':from_dict,'matrix_world':mixamo_arm.matrix_world.copy(),'matrix_local':{},'head_local':{},'matrix':{},'head':{}}
+    pose_bones=mixamo_arm.pose.bones
+    for from_name in from_dict.values():
+        pose_bone=pose_bones[from_name]
+        source['matrix_local'][from_name]=pose_bone.bone.matrix_local.copy()
+        source['head_local'][from_name]=pose_bone.bone.head_local.copy()
+        source['matrix'][from_name]=pose_bone.matrix.copy()
+        source['head'][from_name]=pose_bone.head.copy()
+    return source
+
+#解算每根骨骼的左乘和右乘四元数,结果只与静止姿态和预设有关,可以缓存
+#solve the left and right quaternions of every matched bone, the result only
+#depends on the rest poses and the preset so it can be cached
+def solve_retarget(source,rigify_arm,target,first_frame_as_rest_pose):
 
-    old_frame=context.scene.frame_current
-    context.scene.frame_current=int(frame_range[0])
-    
-    #写入MMR预设
-    fbx_preset=preset.preset_dict_dict['retarget'][mmr_property.retarget_preset_name]
-    preset.set_bone_type(mixamo_arm.pose,fbx_preset)
     #生成字典
-    from_dict={}
-    to_dict={}
+    from_dict=source['from_dict']
+    to_dict=target['to_dict']
     #from_to_dict={}
     type_from_to_list=[]
-    match_bone_number=0
-    for bone in mixamo_arm.pose.bones:
-        if bone.mmr_bone.bone_type !='None':
-            from_dict[bone.mmr_bone.bone_type]=bone.name
-    for bone in rigify_arm.pose.bones:
-        if bone.mmr_bone.bone_type !='None':
-            to_dict[bone.mmr_bone.bone_type]=bone.name
     for bone_type,from_name in from_dict.items():
         if bone_type in to_dict:
             to_name=to_dict[bone_type]
             type_from_to_list.append((bone_type,from_name,to_name))
-            match_bone_number+=1
 
     #检测关键骨骼是否存在
     from_necessary_bone_type_list=['thigh.L','thigh.R','upper_arm.L','upper_arm.R','forearm.L','forearm.R']
@@ -90,55 +67,35 @@ def retarget_mixmao(OT,context):
     for bone_type in from_necessary_bone_type_list:
         if bone_type not in from_dict:
             alert_error('警告','导入骨骼缺失关键骨骼类型'+str(bone_type))
-            return(False)
+            return None
     for bone_type in to_necessary_bone_type_list:
         if bone_type not in to_dict:
             alert_error('警告','所选骨骼缺失关键骨骼类型'+str(bone_type))
-            return(False)
+            return None
 
     #计算物体矩阵
     #物体矩阵a
-    mat_wa4=mixamo_arm.matrix_world
+    mat_wa4=source['matrix_world']
     mat_wa=mat_wa4.to_3x3()
 
     q_wa=mat_wa.to_quaternion()
     q_wai=q_wa.inverted()
     #物体矩阵b
-    mat_wb=rigify_arm.matrix_world.to_3x3()
+    mat_wb=target['mat_wb']
 
-    q_wb=mat_wb.to_quaternion()
+    q_wb=target['q_wb']
     q_wbi=q_wb.inverted()
 
-    #自动动作缩放
-    #auto action scale
-    action_scale_finel=1
-    if auto_action_scale:
-        head_a=mixamo_arm.pose.bones[from_dict['thigh.L']].bone.head_local
-        head_a= q_wa @ head_a
-        head_a+=mixamo_arm.location
-        head_b=rigify_arm.pose.bones[to_dict['thigh.L']].bone.head_local
-        head_b= q_wb @ head_b
-        action_scale_finel=abs(head_b[2]/head_a[2])
-    else:
-        action_scale_finel=action_scale
-        
-
-    #调整世界矩阵缩放
-    #mat_s=Matrix([(action_scale_finel,0,0),(0,action_scale_finel,0),(0,0,action_scale_finel)])
-    #mat_wa=mat_s @ mat_wa
-    print('scale='+str(action_scale_finel))
-
     q_wab=q_wai @ q_wb
     q_wba=q_wbi @ q_wa
 
-    pose_bones_a=mixamo_arm.pose.bones
     pose_bones_b=rigify_arm.pose.bones
 
     #生成手臂角度差
-    if OT.first_frame_as_rest_pose:
-        v_a_arm=pose_bones_a[from_dict['upper_arm.L']].head-pose_bones_a[from_dict['forearm.L']].head
+    if first_frame_as_rest_pose:
+        v_a_arm=source['head'][from_dict['upper_arm.L']]-source['head'][from_dict['forearm.L']]
     else:
-        v_a_arm=pose_bones_a[from_dict['upper_arm.L']].bone.head_local-pose_bones_a[from_dict['forearm.L']].bone.head_local
+        v_a_arm=source['head_local'][from_dict['upper_arm.L']]-source['head_local'][from_dict['forearm.L']]
     v_b_arm=pose_bones_b[to_dict['upper_arm.L']].bone.head_local-pose_bones_b[to_dict['forearm.L']].bone.head_local
     v_a_arm=mat_wa @ v_a_arm
     v_b_arm=mat_wb @ v_b_arm
@@ -190,6 +147,239 @@ def retarget_mixmao(OT,context):
     }
     translation_set={'spine'}
 
+    #开始遍历列表
+    bone_list=[]
+    for bone_type , from_name , to_name in type_from_to_list:
+
+        mat_a=source['matrix_local'][from_name]
+
+        #计算骨骼四元数
+        q_a=mat_a.to_quaternion()
+        q_ai=q_a.inverted()
+        q_b=target['q_b_dict'][to_name]
+        q_bi=q_b.inverted()
+
+        #计算右乘四元数
+        q_r:Quaternion
+
+        if first_frame_as_rest_pose:
+            q_r=source['matrix'][from_name].to_quaternion().inverted()
+        else:
+            q_r=q_ai
+
+        if bone_type in rotate_wab_l_set:
+            q_r @= q_warb_l
+        elif bone_type in rotate_wab_r_set:
+            q_r @= q_warb_r
+        else:
+            q_r @= q_wab
+
+        q_r @= q_b
+
+        #计算左乘四元数
+        q_l:Quaternion
+
+        q_l=q_bi
+
+        if bone_type in rotate_wba_l_set:
+            q_l @= q_wbra_l
+        elif bone_type in rotate_wba_r_set:
+            q_l @= q_wbra_r
+        else:
+            q_l @= q_wba
+
+        q_l @= q_a
+
+        #mat_R=mat_R.to_4x4()
+        #mat_L=mat_L.to_4x4()
+
+        translation=False
+        if bone_type in translation_set:
+            translation=True
+
+        bone_list.append([bone_type,from_name,to_name,translation,list(q_l),list(q_r)])
+
+    return {'from_dict':from_dict,'bone_list':bone_list}
+
+#只导入骨骼和动画时的FBX选项:不搜索贴图,不读取自定义法线,细分和自定义属性
+#FBX options of the animation only import: no image search, custom normals,
+#subdivision or custom properties
+fbx_animation_options={
+    'use_anim':True,
+    'use_image_search':False,
+    'use_custom_normals':False,
+    'use_subsurf':False,
+    'use_custom_props':False,
+}
+#导入可能新建的数据块类型
+#kinds of datablocks an import may create
+import_data_list=['objects','meshes','materials','images','textures','node_groups','actions','armatures','cameras','lights','curves']
+
+def get_data_snapshot():
+    return {name:set(getattr(bpy.data,name)) for name in import_data_list}
+
+#导入后新建的数据块
+#datablocks created since the snapshot
+def get_new_data(snapshot):
+    new_list=[]
+    for name in import_data_list:
+        old_set=snapshot[name]
+        new_list+=[data for data in getattr(bpy.data,name) if data not in old_set]
+    return new_list
+
+#在导入的数据中找到带动画的骨骼,删除其他所有导入的数据,返回骨骼和保留的数据
+#find the animated armature among the imported datablocks, remove everything
+#else the import created, returns the armature and the kept datablocks
+def keep_imported_armature(imported_list):
+    mixamo_arm=None
+    for data in imported_list:
+        if isinstance(data,bpy.types.Object) and data.type=='ARMATURE':
+            if mixamo_arm==None or (data.animation_data and data.animation_data.action):
+                mixamo_arm=data
+    keep_list=[]
+    if mixamo_arm!=None:
+        keep_list=[mixamo_arm,mixamo_arm.data]
+        if mixamo_arm.animation_data and mixamo_arm.animation_data.action:
+            keep_list.append(mixamo_arm.animation_data.action)
+    bpy.data.batch_remove([data for data in imported_list if data not in keep_list])
+    return mixamo_arm,keep_list
+
+def retarget_mixmao(OT,context,target=None,nla_track=None,frame_start=None):
+
+    scene=context.scene
+    mmr_property=scene.mmr_property
+    rigify_arm=context.view_layer.objects.active
+    #把路径转成小写
+    mixamo_path=OT.filepath.lower ()
+    lock_location=mmr_property.lock_location
+    fade_in_out=mmr_property.fade_in_out
+    action_scale=mmr_property.action_scale
+    auto_action_scale=mmr_property.auto_action_scale
+    IKFK_arm=mmr_property.IKFK_arm
+    IKFK_leg=mmr_property.IKFK_leg
+    debug=mmr_property.debug
+
+    if rigify_arm.type!='ARMATURE':
+        alert_error('警告','所选物体不是骨骼')
+        return(False)
+    if mixamo_path==None:
+        return(False)
+
+    #获得文件路径
+    #get file path
+    #my_dir = os.path.dirname(os.path.realpath(__file__))
+    #retarget_blend_file = os.path.join(my_dir, "mixamo_retarget_arm_ik.blend")
+    fname,fename=os.path.split(mixamo_path)
+    action_name=str(os.path.splitext(fename)[0])
+
+    #导入FBX或BVH文件
+    #import mixamo file
+    bpy.ops.object.mode_set(mode = 'OBJECT')
+    bpy.ops.object.select_all(action='DESELECT')
+    mixamo_arm=None
+    bvh_motion=None
+    snapshot=get_data_snapshot()
+    if mixamo_path.endswith(".fbx"):
+        #只导入骨骼和动画,网格等导入后立即删除
+        #animation only import, meshes and the rest are removed right after
+        if getattr(OT,'animation_only',True):
+            bpy.ops.import_scene.fbx(filepath=mixamo_path,directory =fname,**fbx_animation_options)
+        else:
+            bpy.ops.import_scene.fbx(filepath=mixamo_path,directory =fname)
+    elif mixamo_path.endswith(".bvh"):
+        #原生读取BVH,不创建临时骨骼和动作
+        #native BVH reader, no temporary armature and action
+        if getattr(OT,'native_reader',False):
+            try:
+                bvh_motion=bvh.BvhMotion(OT.filepath)
+            except (OSError,ValueError) as e:
+                alert_error('警告','BVH文件读取失败:'+str(e))
+                return(False)
+        else:
+            bpy.ops.import_anim.bvh(filepath=mixamo_path, rotate_mode='QUATERNION')
+    else:
+        alert_error('警告','文件格式错误')
+        return(False)
+    fbx_preset=preset.preset_dict_dict['retarget'][mmr_property.retarget_preset_name]
+    if bvh_motion:
+        rigify_action=bpy.data.actions.new(action_name)
+        frame_range=bvh_motion.get_frame_range()
+    else:
+        #只删除这次导入新建的数据,不扫描场景中的物体
+        #remove only what this import created instead of scanning the scene
+        mixamo_arm,imported_list=keep_imported_armature(get_new_data(snapshot))
+        if mixamo_arm==None or len(imported_list)<3:
+            bpy.data.batch_remove(imported_list)
+            alert_error('警告','文件中没有带动画的骨骼')
+            return(False)
+        mixamo_action=mixamo_arm.animation_data.action
+        rigify_action=mixamo_action.copy()
+        frame_range=mixamo_action.frame_range
+        rigify_action.name=action_name
+
+    old_frame=context.scene.frame_current
+    context.scene.frame_current=int(frame_range[0])
+    
+    #写入MMR预设
+    if bvh_motion:
+        source=bvh_motion.get_retarget_source(fbx_preset,OT.first_frame_as_rest_pose)
+    else:
+        preset.set_bone_type(mixamo_arm.pose,fbx_preset)
+        source=get_retarget_source(mixamo_arm)
+    #生成字典
+    if target==None:
+        target=get_retarget_target(rigify_arm)
+    to_dict=target['to_dict']
+
+    #重定向解算,缓存命中时直接变换曲线
+    #solve the retarget, a cache hit skips straight to the curve transform
+    solution=None
+    if OT.use_cache:
+        cache_key=retarget_cache.get_key(source,rigify_arm,mmr_property.retarget_preset_name,fbx_preset,OT.first_frame_as_rest_pose)
+        solution=retarget_cache.load(rigify_arm,cache_key)
+    if solution==None:
+        solution=solve_retarget(source,rigify_arm,target,OT.first_frame_as_rest_pose)
+        if solution==None:
+            return(False)
+        if OT.use_cache:
+            retarget_cache.save(rigify_arm,cache_key,solution)
+    from_dict=solution['from_dict']
+    match_bone_number=len(solution['bone_list'])
+
+    #计算物体矩阵
+    #物体矩阵a
+    mat_wa4=source['matrix_world']
+    mat_wa=mat_wa4.to_3x3()
+
+    q_wa=mat_wa.to_quaternion()
+    q_wai=q_wa.inverted()
+    #物体矩阵b
+    q_wb=target['q_wb']
+    q_wbi=q_wb.inverted()
+
+    #自动动作缩放
+    #auto action scale
+    action_scale_finel=1
+    if auto_action_scale:
+        head_a=source['head_local'][from_dict['thigh.L']]
+        head_a= q_wa @ head_a
+        head_a+=mat_wa4.to_translation()
+        head_b=rigify_arm.pose.bones[to_dict['thigh.L']].bone.head_local
+        head_b= q_wb @ head_b
+        action_scale_finel=abs(head_b[2]/head_a[2])
+    else:
+        action_scale_finel=action_scale
+        
+
+    #调整世界矩阵缩放
+    #mat_s=Matrix([(action_scale_finel,0,0),(0,action_scale_finel,0),(0,0,action_scale_finel)])
+    #mat_wa=mat_s @ mat_wa
+    print('scale='+str(action_scale_finel))
+
+    q_wab=q_wai @ q_wb
+
+    pose_bones_b=rigify_arm.pose.bones
+
     fcurves_b=rigify_action.fcurves
 
     #清除曲线函数
@@ -251,7 +441,7 @@ def retarget_mixmao(OT,context):
             co_lists=[]
             path_from=obj_from.path_from_id(attr_name)
             path_to=obj_to.path_from_id(attr_name)
-            dimension=len(getattr(obj,attr_name))
+            dimension=len(getattr(obj_to,attr_name))
             #把关键帧数据提取为矩阵
             for i in range(dimension):
                 fcurve=fcurves_b.find(path_from,index=i)
@@ -276,6 +466,73 @@ def retarget_mixmao(OT,context):
                 kps.foreach_set('co',co_list)
                 fcurve.update()
 
+        #曲线转数组函数(批量模式)
+        #所有通道关键帧数量一致时才使用,否则返回False回退到逐帧模式
+        #fcurve to numpy array, returns False to fall back to the per-key path
+        def get_co_arrays(obj_from,obj_to,attr_name,dimension):
+            path_from=obj_from.path_from_id(attr_name)
+            path_to=obj_to.path_from_id(attr_name)
+            fcurve_list=[fcurves_b.find(path_from,index=i) for i in range(dimension)]
+            if any(fcurve is None for fcurve in fcurve_list):
+                return None
+            kps_len=len(fcurve_list[0].keyframe_points)
+            for fcurve in fcurve_list:
+                if len(fcurve.keyframe_points)!=kps_len:
+                    return False
+            co_arrays=np.empty((dimension,2*kps_len),dtype=np.float32)
+            for i,fcurve in enumerate(fcurve_list):
+                fcurve.data_path=path_to
+                fcurve.keyframe_points.foreach_get('co',co_arrays[i])
+            return co_arrays
+
+        #数组转曲线函数(批量模式)
+        def set_co_arrays(obj,attr_name,co_arrays):
+            path=obj.path_from_id(attr_name)
+            for i in range(len(co_arrays)):
+                fcurve=fcurves_b.find(path,index=i)
+                fcurve.keyframe_points.foreach_set('co',co_arrays[i])
+                fcurve.update()
+
+        #批量模式:整段动作一次矩阵运算
+        #batch mode: transform the whole clip in one vectorized pass
+        if OT.vectorized:
+            if translation:
+                l_co_arrays=get_co_arrays(obj_from,obj_to,'location',3)
+                if l_co_arrays is not False:
+                    if l_co_arrays is not None:
+                        locations=l_co_arrays[:,1::2].T.astype(np.float64)
+                        if translation_offset is not None:
+                            locations+=np.array(translation_offset)
+                        mat_l=np.array(q_l.to_matrix())
+                        locations=locations @ mat_l.T
+                        locations*=action_scale_finel
+                        l_co_arrays[:,1::2]=locations.T
+                        set_co_arrays(obj_to,'location',l_co_arrays)
+                    translation=False
+
+            mat_lr=vector_math.sandwich_matrix(q_l,q_r)
+            if rotation_mode=='QUATERNION':
+                q_co_arrays=get_co_arrays(obj_from,obj_to,'rotation_quaternion',4)
+                if q_co_arrays is None:
+                    return
+                if q_co_arrays is not False:
+                    quaternions=q_co_arrays[:,1::2].T.astype(np.float64)
+                    q_co_arrays[:,1::2]=(quaternions @ mat_lr.T).T
+                    set_co_arrays(obj_to,'rotation_quaternion',q_co_arrays)
+                    return
+            elif rotation_mode in {'XYZ','XZY','YXZ','YZX','ZXY','ZYX'}:
+                e_co_arrays=get_co_arrays(obj_from,obj_to,'rotation_euler',3)
+                if e_co_arrays is None:
+                    return
+                if e_co_arrays is not False:
+                    efc_to_qfc(obj_to)
+                    quaternions=vector_math.euler_to_quaternion(e_co_arrays[:,1::2].T,rotation_mode)
+                    q_co_arrays=np.empty((4,e_co_arrays.shape[1]),dtype=np.float32)
+                    q_co_arrays[:,0::2]=e_co_arrays[0,0::2]
+                    q_co_arrays[:,1::2]=(quaternions @ mat_lr.T).T
+                    set_co_arrays(obj_to,'rotation_quaternion',q_co_arrays)
+                    return
+
         #重定向平移曲线
         if translation:
             l_co_lists=get_co_lists(obj_from,obj_to,'location')
@@ -347,68 +604,49 @@ def retarget_mixmao(OT,context):
                 set_co_lists(obj_to,'rotation_quaternion',e_co_lists)
 
 
-    #开始遍历列表
-    for bone_type , from_name , to_name in type_from_to_list:
-
-        posebone_a=pose_bones_a[from_name]
-        posebone_b=pose_bones_b[to_name]
-
-        bone_a=posebone_a.bone
-        bone_b=posebone_b.bone
-
-        mat_a=bone_a.matrix_local
-        mat_b=bone_b.matrix_local
-        mat_ap=posebone_a.matrix
-
-        #计算骨骼四元数
-        q_a=mat_a.to_quaternion()
-        q_ai=q_a.inverted()
-        q_b=mat_b.to_quaternion()
-        q_bi=q_b.inverted()
-        q_ap=mat_ap.to_quaternion()
-        q_api=q_ap.inverted()
-
-        #计算右乘四元数
-        q_r:Quaternion
-
-        if OT.first_frame_as_rest_pose:
-            q_r=q_api
-        else:
-            q_r=q_ai
-
-        if bone_type in rotate_wab_l_set:
-            q_r @= q_warb_l
-        elif bone_type in rotate_wab_r_set:
-            q_r @= q_warb_r
-        else:
-            q_r @= q_wab
-
-        q_r @= q_b
-
-        #计算左乘四元数
-        q_l:Quaternion
-
-        q_l=q_bi
-
-        if bone_type in rotate_wba_l_set:
-            q_l @= q_wbra_l
-        elif bone_type in rotate_wba_r_set:
-            q_l @= q_wbra_r
-        else:
-            q_l @= q_wba
+    #原生读取的BVH直接把数组变换后写入目标曲线
+    #natively read BVH: transform the arrays and write the target curves directly
+    def retarget_arrays(bone_list):
+        frames=None
+        bone_dict={from_name:(to_name,translation,q_l,q_r) for bone_type,from_name,to_name,translation,q_l,q_r in bone_list}
+        for from_name,locations,quaternions in bvh_motion.iter_joints(list(bone_dict)):
+            to_name,translation,q_l,q_r=bone_dict[from_name]
+            obj_to=pose_bones_b[to_name]
+            obj_to.rotation_mode='QUATERNION'
+            value_list=[]
+            if translation and locations is not None:
+                mat_l=np.array(Quaternion(q_l).to_matrix())
+                value_list.append(('location',locations @ mat_l.T*action_scale_finel))
+            if quaternions is not None:
+                value_list.append(('rotation_quaternion',quaternions @ vector_math.sandwich_matrix(q_l,q_r).T))
+            for attr_name,values in value_list:
+                if frames is None:
+                    frames=bvh_motion.get_frames(len(values))
+                path=obj_to.path_from_id(attr_name)
+                for index in range(values.shape[1]):
+                    fcurve=fcurve_utils.new_fcurve(fcurves_b,path,index,to_name)
+                    fcurve_utils.set_keyframes(fcurve,frames,values[:,index],'BEZIER')
 
-        q_l @= q_a
-
-        #mat_R=mat_R.to_4x4()
-        #mat_L=mat_L.to_4x4()
-
-        translation=False
-        if bone_type in translation_set:
-            translation=True
-
-        retarget_fcurves(q_l,q_r,posebone_a,posebone_b,translation)
+    #开始遍历列表
+    if bvh_motion:
+        #动作数据在这里才分块读取,截断或格式错误的MOTION部分在读取时报错
+        #the motion block is only read here, chunk by chunk, so a truncated or
+        #malformed MOTION section fails at this point
+        try:
+            retarget_arrays(solution['bone_list'])
+        except (OSError,ValueError) as e:
+            bpy.data.actions.remove(rigify_action)
+            context.scene.frame_current=old_frame
+            alert_error('警告','BVH文件读取失败:'+str(e))
+            return(False)
+    else:
+        pose_bones_a=mixamo_arm.pose.bones
+        for bone_type,from_name,to_name,translation,q_l,q_r in solution['bone_list']:
+            retarget_fcurves(Quaternion(q_l),Quaternion(q_r),pose_bones_a[from_name],pose_bones_b[to_name],translation)
 
-    if 'spine' not in from_dict and 'spine' in to_dict:
+    #原生读取的BVH没有物体动画
+    #a natively read BVH has no object animation
+    if 'spine' not in from_dict and 'spine' in to_dict and mixamo_arm!=None:
         print('Action have no spine')
 
         x_finel,y_finel,z_finel=mat_wa4.to_translation()*action_scale_finel
@@ -482,17 +720,31 @@ def retarget_mixmao(OT,context):
     bpy.ops.object.select_all(action='DESELECT')
     bpy.context.view_layer.objects.active=rigify_arm
 
-    if mmr_property.import_as_NLA_strip:
-        target_track=rigify_arm.animation_data.nla_tracks.new()
-        target_track.name='mixamo_track'
-        target_strip=target_track.strips.new(action_name,bpy.context.scene.frame_current,rigify_action)
+    #精简逐帧烘焙的关键帧
+    #decimate the per-frame baked keys
+    decimate_info=''
+    if mmr_property.decimate_action:
+        decimate_info=','+decimate.report_message(decimate.decimate_with_property(rigify_action,mmr_property))
+
+    if mmr_property.import_as_NLA_strip or frame_start!=None:
+        target_track=nla_track
+        if target_track==None:
+            target_track=rigify_arm.animation_data.nla_tracks.new()
+            target_track.name='mixamo_track'
+        #批量导入时由调用者指定起始帧
+        #batch import places the strip at the given frame
+        if frame_start!=None:
+            target_strip=target_track.strips.new(action_name,int(frame_start),rigify_action)
+        else:
+            target_strip=target_track.strips.new(action_name,bpy.context.scene.frame_current,rigify_action)
         target_strip.blend_type = 'REPLACE'
         #target_strip.use_auto_blend = True
         target_strip.extrapolation = 'NOTHING'
         target_strip.blend_in = fade_in_out
         target_strip.blend_out = fade_in_out
-        target_strip.frame_start+=old_frame-1
-        target_strip.frame_end+=old_frame-1
+        if frame_start==None:
+            target_strip.frame_start+=old_frame-1
+            target_strip.frame_end+=old_frame-1
 
         #更改原动作混合模式为合并
         rigify_arm.animation_data.action_blend_type = 'COMBINE'
@@ -500,39 +752,22 @@ def retarget_mixmao(OT,context):
         rigify_arm.animation_data.action=rigify_action
 
     if debug==False:
-        bpy.data.objects.remove(mixamo_arm,do_unlink=True)
-        bpy.data.actions.remove(mixamo_action,do_unlink=True)
+        if mixamo_arm!=None:
+            bpy.data.batch_remove(imported_list)
         context.scene.frame_current=old_frame
 
 
     rigify_arm.select_set(True)
-    alert_error("提示","导入完成,匹配骨骼数:"+str(match_bone_number))
+    alert_error("提示","导入完成,匹配骨骼数:"+str(match_bone_number)+decimate_info)
     return(True)
     
-def load_vmd(OT,context):
+#复制的控制器骨骼,骨骼字典和动作缩放只与目标骨骼有关,批量导入时只生成一次
+#the duplicated controller rig, bone dict and action scale only depend on
+#the target rig, so a batch import prepares them once
+def prepare_vmd_target(context,rigify_arm):
 
-    scene=context.scene
-    mmr_property=scene.mmr_property
-    rigify_arm=context.view_layer.objects.active
-    vmd_path=OT.filepath
-    fade_in_out=mmr_property.fade_in_out
+    mmr_property=context.scene.mmr_property
     action_scale=mmr_property.action_scale
-    debug=mmr_property.debug
-
-    if rigify_arm.type!='ARMATURE':
-        alert_error("警告",'所选对象不是骨骼')
-        return(False)
-    if vmd_path==None:
-        alert_error("警告",'找不到VMD文件')
-        return(False)
-
-
-    fename=str(os.path.split(vmd_path))
-    print('path=')
-    print(fename)
-    action_name=str(os.path.splitext(fename)[0])
-    bpy.ops.object.mode_set(mode = 'OBJECT')
-    bpy.ops.object.select_all(action='DESELECT')
 
     #复制骨骼
     #duplicate armature
@@ -541,11 +776,6 @@ def load_vmd(OT,context):
     rigify_arm2.animation_data.action=None
     for track in rigify_arm2.animation_data.nla_tracks:
         rigify_arm2.animation_data.nla_tracks.remove(track)
-    bpy.context.view_layer.objects.active=rigify_arm2
-    rigify_arm2.select_set(True)
-    print(vmd_path)
-    old_frame_end=bpy.context.scene.frame_end
-    old_frame=context.scene.frame_current
 
     #指定mmd骨骼名称
     #生成字典
@@ -566,15 +796,11 @@ def load_vmd(OT,context):
     'f_ring.01.R':'右薬指１','f_ring.02.R':'右薬指２','f_ring.03.R':'右薬指３',
     'f_pinky.01.R':'右小指１','f_pinky.02.R':'右小指２','f_pinky.03.R':'右小指３'
     }
-    rigify_dict={}
-    for bone in rigify_arm2.pose.bones:
-        bone1=rigify_arm.pose.bones[bone.name]
-        bone_type=bone.mmr_bone.bone_type
-        if bone_type != 'None':
-            rigify_dict[bone.mmr_bone.bone_type]=bone.name
-            if bone_type in mmd_dict:
-                bone.mmd_bone.name_j=mmd_dict[bone_type]
-                bone1.rotation_mode = 'QUATERNION'
+    rigify_dict=preset.get_bone_type_dict(rigify_arm2)
+    for bone_type,name in rigify_dict.items():
+        if bone_type in mmd_dict:
+            rigify_arm2.pose.bones[name].mmd_bone.name_j=mmd_dict[bone_type]
+            rigify_arm.pose.bones[name].rotation_mode = 'QUATERNION'
 
     #自动缩放
     action_scale_finel=1
@@ -605,8 +831,110 @@ def load_vmd(OT,context):
     mat_3=mat_a.inverted() @ mat_2 @ mat_a
     bone_a.rotation_mode='QUATERNION'
     bone_a.rotation_quaternion=mat_3.to_quaternion()
-    
-    bpy.ops.mmd_tools.import_vmd(files= [{"name": vmd_path}],scale=action_scale_finel,use_pose_mode=True, margin=0)
+
+    return {'rigify_arm2':rigify_arm2,'rigify_dict':rigify_dict,'action_scale':action_scale_finel}
+
+#切换到临时场景,后台运行时没有窗口,用上下文覆盖代替
+#switch to a scratch scene, without a window (blender -b) a context override
+#stands in for the window scene
+@contextlib.contextmanager
+def scratch_scene(context,scene,obj):
+    if context.window:
+        old_scene=context.window.scene
+        context.window.scene=scene
+        try:
+            yield
+        finally:
+            context.window.scene=old_scene
+    else:
+        with context.temp_override(scene=scene,view_layer=scene.view_layers[0],active_object=obj,object=obj):
+            yield
+
+def load_vmd(OT,context,target=None,nla_track=None,frame_start=None):
+
+    scene=context.scene
+    mmr_property=scene.mmr_property
+    rigify_arm=context.view_layer.objects.active
+    vmd_path=OT.filepath
+    debug=mmr_property.debug
+
+    if rigify_arm.type!='ARMATURE':
+        alert_error("警告",'所选对象不是骨骼')
+        return(False)
+    if vmd_path==None:
+        alert_error("警告",'找不到VMD文件')
+        return(False)
+
+
+    fename=str(os.path.split(vmd_path))
+    print('path=')
+    print(fename)
+    action_name=str(os.path.splitext(fename)[0])
+    bpy.ops.object.mode_set(mode = 'OBJECT')
+    bpy.ops.object.select_all(action='DESELECT')
+
+    own_target=target==None
+    if own_target:
+        target=prepare_vmd_target(context,rigify_arm)
+        rigify_arm2=target['rigify_arm2']
+    else:
+        #批量导入时每个文件使用准备好的骨骼的新副本,
+        #不会沿用上一个文件留下的姿态,IKFK属性和约束影响
+        #batch import gives every file a fresh copy of the prepared rig, so no
+        #file converts against the pose, IK/FK properties or constraint
+        #influences the previous file left behind
+        rigify_arm2=target['rigify_arm2'].copy()
+        context.collection.objects.link(rigify_arm2)
+
+    #mmd骨骼只放在临时场景中,导入结束或出错时和场景一起删除,调试模式也不保留
+    #the mmd_leg rig only lives in a scratch scene and is removed with it when
+    #the import ends or fails, debug mode included
+    new_scene=bpy.data.scenes.new('MMR_scene')
+    mmd_arm=template.new_instance(context,"mmd_leg",new_scene.collection)
+    try:
+        return import_vmd_motion(OT,context,rigify_arm,dict(target,rigify_arm2=rigify_arm2),action_name,new_scene,mmd_arm,nla_track,frame_start)
+    finally:
+        template.remove(mmd_arm)
+        bpy.data.scenes.remove(new_scene,do_unlink=True)
+        if debug==False:
+            bpy.data.objects.remove(rigify_arm2,do_unlink=True)
+
+#把VMD动作转换到控制器骨骼,腿部IK在临时场景的mmd骨骼上求解
+#convert the VMD motion onto the controller rig, the leg IK is solved on the
+#mmd_leg rig in the scratch scene
+def import_vmd_motion(OT,context,rigify_arm,target,action_name,new_scene,mmd_arm,nla_track,frame_start):
+
+    mmr_property=context.scene.mmr_property
+    vmd_path=OT.filepath
+    fade_in_out=mmr_property.fade_in_out
+    action_scale=mmr_property.action_scale
+    rigify_arm2=target['rigify_arm2']
+    rigify_dict=target['rigify_dict']
+    action_scale_finel=target['action_scale']
+    rigify_arm2.animation_data.action=None
+    bpy.context.view_layer.objects.active=rigify_arm2
+    rigify_arm2.select_set(True)
+    print(vmd_path)
+    old_frame_end=bpy.context.scene.frame_end
+    old_frame=context.scene.frame_current
+
+    #原生读取VMD,只解析一次文件
+    #native VMD reader, the file is parsed only once
+    vmd_motion=None
+    if OT.native_reader:
+        #空文件,截断的文件或不是VMD的文件
+        #empty, truncated or non-VMD files
+        try:
+            vmd_motion=vmd.VmdMotion(vmd_path)
+        except (OSError,ValueError) as e:
+            bpy.context.view_layer.objects.active=rigify_arm
+            rigify_arm.select_set(True)
+            alert_error("警告",'无法读取VMD文件:'+str(e))
+            return(False)
+        vmd_action_name=os.path.splitext(os.path.basename(vmd_path))[0]
+        vmd.apply_bone_motion(vmd_motion,rigify_arm2,vmd_action_name,scale=action_scale_finel,use_pose_mode=True)
+    else:
+        bpy.ops.mmd_tools.import_vmd(files= [{"name": vmd_path}],scale=action_scale_finel,use_pose_mode=True, margin=0)
     
     vmd_action = rigify_arm2.animation_data.action
 
@@ -624,7 +952,6 @@ def load_vmd(OT,context):
             IK_bone1.rotation_mode = 'QUATERNION'
 
             fcurve_data_list=[('rotation_quaternion',4),('location',3)]
-            keyframe_data_list=['co','interpolation','handle_left','handle_left_type','handle_right','handle_right_type']
             for attr_name,attr_len in fcurve_data_list:
                 for index in range(attr_len):
 
@@ -635,19 +962,7 @@ def load_vmd(OT,context):
                     
                     if (fcurve1 != None):
                         fcurve2=fcurves.new(path2,index=index)
-
-                        keyframe_points1=fcurve1.keyframe_points
-                        keyframe_points2=fcurve2.keyframe_points
-
-                        keyframe_len=len(keyframe_points1)
-                        keyframe_points2.add(keyframe_len)
-
-                        for i,keyframe1 in enumerate(keyframe_points1):
-                            keyframe2=keyframe_points2[i]
-
-                            for keyframe_data in keyframe_data_list:
-                                attr=getattr(keyframe1,keyframe_data)
-                                setattr(keyframe2,keyframe_data,attr)
+                        fcurve_utils.copy_keyframes(fcurve1,fcurve2)
 
     
     copy_fcurve('thigh.L')
@@ -666,63 +981,64 @@ def load_vmd(OT,context):
     
 
     #导入mmd骨骼
-    old_scene=context.scene
-    new_scene=bpy.data.scenes.new('MMR_scene')
-    context.window.scene=new_scene
-
-    mmd_arm_name="mmd_leg"
-    my_dir = os.path.dirname(os.path.realpath(__file__))
-    mmd_leg_blend_file = os.path.join(my_dir, "MMD_leg.blend")
-    with bpy.data.libraries.load(mmd_leg_blend_file) as (data_from, data_to):
-        data_to.objects = [mmd_arm_name]
-
-    mmd_arm=data_to.objects[0]
-    context.collection.objects.link(mmd_arm)
-    bpy.ops.object.select_all(action='DESELECT')
-    bpy.context.view_layer.objects.active=mmd_arm
-    mmd_arm.select_set(True)
-
-    #匹配骨骼轴向
-    bpy.ops.object.mode_set(mode = 'EDIT')
-
-    def match_bone(from_type,to_name_list):
-        mat_rigify=rigify_arm.data.bones[rigify_dict[from_type]].matrix_local.copy()
-        for to_name in to_name_list:
-            to_bone=mmd_arm.data.edit_bones[to_name]
-            mat_mmd=to_bone.matrix
-            mat_rigify[0][3]=mat_mmd[0][3]
-            mat_rigify[1][3]=mat_mmd[1][3]
-            mat_rigify[2][3]=mat_mmd[2][3]
-            to_bone.matrix=mat_rigify
-
-    match_bone('LegIK_L',['foot.L.parent','foot.L'])
-    match_bone('LegIK_R',['foot.R.parent','foot.R'])
-    match_bone('shoulder.L',['shoulder.L','肩.L'])
-    match_bone('shoulder.R',['shoulder.R','肩.R'])
-    match_bone('upper_arm.L',['upper_arm.L','腕.L'])
-    match_bone('upper_arm.R',['upper_arm.R','腕.R'])
-    match_bone('forearm.L',['forearm.L','ひじ.L'])
-    match_bone('forearm.R',['forearm.R','ひじ.R'])
-    match_bone('hand.L',['hand.L','手首.L'])
-    match_bone('hand.R',['hand.R','手首.R'])
-    match_bone('spine',['腰','spine'])
-
-    mmd_arm.data.edit_bones["全ての親"].matrix=rigify_arm.data.bones[rigify_dict['Root']].matrix_local
-
-    bpy.ops.object.mode_set(mode = 'POSE')
-    bpy.ops.mmd_tools.import_vmd(files=[{"name": vmd_path}],scale=1, margin=0)
-    bpy.ops.pose.select_all(action='DESELECT')
-    bake_name_list=['foot.L','foot.R','shoulder.L','shoulder.R','upper_arm.L','upper_arm.R','forearm.L','forearm.R','hand.L','hand.R','spine']
-    for name in bake_name_list:
-        mmd_arm.data.bones[name].select=True
-
-    mmd_arm.animation_data_create()
-    vmd_action2=mmd_arm.animation_data.action
-    fcurves2=vmd_action2.fcurves
-    frame_range=vmd_action2.frame_range
-
-    bpy.ops.nla.bake(frame_start=int(frame_range[0]), frame_end=int(frame_range[1]), visual_keying=True, clear_constraints=True, use_current_action=True, bake_types={'POSE'})
-    context.window.scene=old_scene
+    #mmd骨骼在临时场景中匹配轴向和烘焙,解析求解不逐帧播放
+    #the mmd_leg rig is fitted and baked in the scratch scene, the analytic
+    #solve does not step frames
+    analytic_ik=vmd_motion!=None and OT.analytic_ik
+    with scratch_scene(context,new_scene,mmd_arm):
+        bpy.ops.object.select_all(action='DESELECT')
+        bpy.context.view_layer.objects.active=mmd_arm
+        mmd_arm.select_set(True)
+
+        #匹配骨骼轴向
+        bpy.ops.object.mode_set(mode = 'EDIT')
+
+        def match_bone(from_type,to_name_list):
+            mat_rigify=rigify_arm.data.bones[rigify_dict[from_type]].matrix_local.copy()
+            for to_name in to_name_list:
+                to_bone=mmd_arm.data.edit_bones[to_name]
+                mat_mmd=to_bone.matrix
+                mat_rigify[0][3]=mat_mmd[0][3]
+                mat_rigify[1][3]=mat_mmd[1][3]
+                mat_rigify[2][3]=mat_mmd[2][3]
+                to_bone.matrix=mat_rigify
+
+        match_bone('LegIK_L',['foot.L.parent','foot.L'])
+        match_bone('LegIK_R',['foot.R.parent','foot.R'])
+        match_bone('shoulder.L',['shoulder.L','肩.L'])
+        match_bone('shoulder.R',['shoulder.R','肩.R'])
+        match_bone('upper_arm.L',['upper_arm.L','腕.L'])
+        match_bone('upper_arm.R',['upper_arm.R','腕.R'])
+        match_bone('forearm.L',['forearm.L','ひじ.L'])
+        match_bone('forearm.R',['forearm.R','ひじ.R'])
+        match_bone('hand.L',['hand.L','手首.L'])
+        match_bone('hand.R',['hand.R','手首.R'])
+        match_bone('spine',['腰','spine'])
+
+        mmd_arm.data.edit_bones["全ての親"].matrix=rigify_arm.data.bones[rigify_dict['Root']].matrix_local
+
+        bpy.ops.object.mode_set(mode = 'POSE')
+        if vmd_motion:
+            vmd.apply_bone_motion(vmd_motion,mmd_arm,vmd_action_name,scale=1)
+        else:
+            bpy.ops.mmd_tools.import_vmd(files=[{"name": vmd_path}],scale=1, margin=0)
+        bpy.ops.pose.select_all(action='DESELECT')
+        bake_name_list=['foot.L','foot.R','shoulder.L','shoulder.R','upper_arm.L','upper_arm.R','forearm.L','forearm.R','hand.L','hand.R','spine']
+        for name in bake_name_list:
+            mmd_arm.data.bones[name].select=True
+
+        mmd_arm.animation_data_create()
+        vmd_action2=mmd_arm.animation_data.action
+        fcurves2=vmd_action2.fcurves
+        frame_range=vmd_action2.frame_range
+
+        if analytic_ik:
+            mmd_ik.bake_motion(vmd_motion,mmd_arm,bake_name_list,int(frame_range[0]),int(frame_range[1]))
+        else:
+            #后台运行时没有屏幕上下文,直接给出要烘焙的骨骼
+            #blender -b has no screen context, so the bones to bake are passed in
+            with context.temp_override(selected_pose_bones=[mmd_arm.pose.bones[name] for name in bake_name_list]):
+                bpy.ops.nla.bake(frame_start=int(frame_range[0]), frame_end=int(frame_range[1]), visual_keying=True, clear_constraints=True, use_current_action=True, bake_types={'POSE'})
     
     #检测IKFK动作
     #IKFK_leg=1-mmd_arm.pose.bones["ひざ.L"].constraints["IK"].mute
@@ -938,34 +1254,172 @@ def load_vmd(OT,context):
         copy_fcurve('hand.L',['手捩.L','手首.L'],'hand.L')
     if 'HandTwist_R' not in rigify_dict and 'hand.R' in rigify_dict:
         copy_fcurve('hand.R',['手捩.R','手首.R'],'hand.R')
-    
-    if mmr_property.import_as_NLA_strip:
-        target_track=rigify_arm.animation_data.nla_tracks.new()
-        target_track.name='vmd_track'
-        target_strip=target_track.strips.new(action_name,bpy.context.scene.frame_current,vmd_action)
+
+    #VMD动作保留原文件的稀疏关键帧和贝塞尔控制柄,不做精简,精简只用于逐帧烘焙的FBX/BVH动作
+    #a VMD action keeps the sparse keys and bezier handles of the file, it is
+    #not decimated, decimation is only for the per-frame baked FBX/BVH actions
+    if mmr_property.import_as_NLA_strip or frame_start!=None:
+        target_track=nla_track
+        if target_track==None:
+            target_track=rigify_arm.animation_data.nla_tracks.new()
+            target_track.name='vmd_track'
+        #批量导入时由调用者指定起始帧
+        #batch import places the strip at the given frame
+        if frame_start!=None:
+            target_strip=target_track.strips.new(action_name,int(frame_start),vmd_action)
+        else:
+            target_strip=target_track.strips.new(action_name,bpy.context.scene.frame_current,vmd_action)
         target_strip.blend_type = 'REPLACE'
         target_strip.use_auto_blend = False
         target_strip.extrapolation = 'NOTHING'
         target_strip.blend_in = fade_in_out
         target_strip.blend_out = fade_in_out
-        target_strip.frame_start+=old_frame
-        target_strip.frame_end+=old_frame
+        if frame_start==None:
+            target_strip.frame_start+=old_frame
+            target_strip.frame_end+=old_frame
 
         #更改原动作混合模式为合并
         rigify_arm.animation_data.action_blend_type = 'COMBINE'
     else:
         rigify_arm.animation_data.action=vmd_action
 
-    if debug==False:
-        bpy.data.objects.remove(rigify_arm2,do_unlink=True)
-        bpy.data.objects.remove(mmd_arm,do_unlink=True)
-        bpy.data.scenes.remove(new_scene,do_unlink=True)
     bpy.context.view_layer.objects.active=rigify_arm
     rigify_arm.select_set(True)
     alert_error("提示","导入完成")
 
     return(True)
 
+#收集控制器骨骼的关键帧和归一化的贝塞尔控制柄
+#key_frames是排序后的帧,bezier_L/bezier_R与其对齐,nan表示没有控制柄,同一帧取第一条曲线的值
+#gather the controller keyframes and their normalized bezier handles as
+#arrays, bezier_L/bezier_R are aligned with the sorted key_frames, nan rows
+#mean no handle and the first curve wins when several have the same frame
+def get_key_bezier_array(rigify_arm,fcurves,keyframe_bone_list):
+
+    frame_list=[]
+    left_list=[]
+    right_list=[]
+    for bone_name in keyframe_bone_list:
+        if bone_name not in rigify_arm.pose.bones:
+            continue
+        bone=rigify_arm.pose.bones[bone_name]
+        for attr_name in ('location','rotation_quaternion'):
+            fcurve=fcurves.find(bone.path_from_id(attr_name),index=0)
+            if fcurve==None or len(fcurve.keyframe_points)==0:
+                continue
+            keyframe_points=fcurve.keyframe_points
+            keyframe_len=len(keyframe_points)
+            data={}
+            for name in ('co','handle_left','handle_right'):
+                data[name]=np.empty(keyframe_len*2,dtype=np.float32)
+                keyframe_points.foreach_get(name,data[name])
+                data[name]=data[name].reshape(-1,2).astype(np.float64)
+            interpolation=fcurve_utils.foreach_get_enum(keyframe_points,'interpolation',fcurve_utils.interpolation_enum)
+            co=data['co']
+            x=co[:,0].astype(np.int64)
+            frame_list.append(x)
+
+            #反向计算mmd控制柄,防止除零
+            #mmd handles from the blender ones, skipping flat segments
+            d=co[1:]-co[:-1]
+            valid=(interpolation[:-1]==fcurve_utils.interpolation_enum['BEZIER'])&(d[:,1]!=0)&(d[:,0]!=0)
+            d=d[valid]
+            right_list.append((x[:-1][valid],(data['handle_right'][:-1][valid]-co[:-1][valid])/d))
+            left_list.append((x[1:][valid],(data['handle_left'][1:][valid]-co[:-1][valid])/d))
+
+    key_frames=np.unique(np.concatenate(frame_list)) if frame_list else np.empty(0,dtype=np.int64)
+    def first_handle(handle_list):
+        bezier=np.full((len(key_frames),2),np.nan)
+        if handle_list:
+            x=np.concatenate([item[0] for item in handle_list])
+            value=np.concatenate([item[1] for item in handle_list])
+            x,first=np.unique(x,return_index=True)
+            bezier[np.searchsorted(key_frames,x)]=value[first]
+        return bezier
+
+    return key_frames,first_handle(left_list),first_handle(right_list)
+
+#与get_key_bezier_array相同,返回帧集合和按帧索引的字典
+#same as get_key_bezier_array, as a frame set and dicts keyed by frame
+def get_key_bezier(rigify_arm,fcurves,keyframe_bone_list):
+    key_frames,bezier_L,bezier_R=get_key_bezier_array(rigify_arm,fcurves,keyframe_bone_list)
+    def to_dict(bezier):
+        return {frame:bezier[i] for i,frame in enumerate(key_frames.tolist()) if not np.isnan(bezier[i,0])}
+    return set(key_frames.tolist()),to_dict(bezier_L),to_dict(bezier_R)
+
+#直接写入VMD:逐帧求值MMD骨骼的视觉姿态,不复制骨骼,不烘焙,不经过mmd_tools
+#native VMD export: evaluate the visual pose of the MMD bones frame by frame
+#and stream it to the file, no armature copy, no bake and no mmd_tools
+def export_vmd_native(OT,context,rigify_arm,mmd_arm,mmd_blender_dict,keyframe_bone_dict,start_frame,end_frame):
+
+    scene=context.scene
+    scale=OT.scale
+    use_pose_mode=OT.use_pose_mode
+    old_frame=scene.frame_current
+
+    name_j_list=list(mmd_blender_dict.keys())
+    pose_bones=[mmd_arm.pose.bones[mmd_blender_dict[name_j]] for name_j in name_j_list]
+    raw_names=np.array([vmd.encode_name(name_j,15) for name_j in name_j_list])
+    mat=np.array([vmd.get_convert_matrix(pose_bone,use_pose_mode) for pose_bone in pose_bones])
+    basis=None
+    if use_pose_mode:
+        basis_location=np.array([tuple(pose_bone.location) for pose_bone in pose_bones])
+        basis_quaternion=np.array([tuple(pose_bone.matrix_basis.to_quaternion()) for pose_bone in pose_bones])
+
+    #只导出关键帧时,每根骨骼只在控制器有关键帧的帧写入
+    #with only_contain_keyframe a bone is written only on its controllers' keys
+    key_list=None
+    if OT.only_contain_keyframe:
+        fcurves=rigify_arm.animation_data.action.fcurves
+        key_list=[get_key_bezier(rigify_arm,fcurves,keyframe_bone_dict[name_j]) for name_j in name_j_list]
+    previous_frame=[None]*len(pose_bones)
+
+    model_name=mmd_arm.name
+    mmd_root=getattr(mmd_arm.parent,'mmd_root',None)
+    if mmd_root and mmd_root.name:
+        model_name=mmd_root.name
+
+    with vmd.VmdWriter(OT.filepath,model_name) as writer:
+        for frame in range(int(start_frame),int(end_frame)+1):
+            if key_list:
+                bone_index=[i for i,key in enumerate(key_list) if frame in key[0]]
+            else:
+                bone_index=list(range(len(pose_bones)))
+            if len(bone_index)==0:
+                continue
+            scene.frame_set(frame)
+
+            locations=np.empty((len(bone_index),3))
+            quaternions=np.empty((len(bone_index),4))
+            for k,i in enumerate(bone_index):
+                pose_bone=pose_bones[i]
+                matrix=mmd_arm.convert_space(pose_bone=pose_bone,matrix=pose_bone.matrix,from_space='POSE',to_space='LOCAL')
+                locations[k]=matrix.to_translation()
+                quaternions[k]=matrix.to_quaternion()
+            if use_pose_mode:
+                basis=(basis_location[bone_index],basis_quaternion[bone_index])
+            locations,rotations=vmd.convert_to_vmd(locations,quaternions,mat[bone_index],scale,basis)
+
+            bezier=np.tile(vmd.linear_bezier,(len(bone_index),1))
+            if key_list:
+                for k,i in enumerate(bone_index):
+                    keyframe_set,bezier_L_dict,bezier_R_dict=key_list[i]
+                    x0=previous_frame[i]
+                    if x0 in bezier_R_dict and frame in bezier_L_dict:
+                        bezier[k,0:2]=tuple(bezier_R_dict[x0])
+                        bezier[k,2:4]=tuple(bezier_L_dict[frame])
+                    previous_frame[i]=frame
+
+            #导出范围的第一帧对应VMD第0帧,每个blender帧对应不同的VMD帧
+            #从第1帧开始的动作与导入时的对应关系一致
+            #the first exported frame is VMD frame 0, so no two blender frames
+            #share a VMD frame, an action starting at frame 1 round trips with
+            #the importer
+            writer.write_bone_frames(raw_names[bone_index],np.full(len(bone_index),frame-int(start_frame)),locations,rotations,vmd.make_interpolation(bezier))
+
+    scene.frame_set(old_frame)
+    return(True)
+
 def export_vmd(OT,context):
 
     rigify_arm=context.view_layer.objects.active
@@ -1020,23 +1474,34 @@ def export_vmd(OT,context):
         alert_error("警告",'找不到骨骼')
         return(False)
 
-    mmd_arm2=mmd_arm.copy()
-    context.collection.objects.link(mmd_arm2)
-    bpy.ops.object.select_all(action='DESELECT')
-    bpy.context.view_layer.objects.active=mmd_arm2
-    mmd_arm2.select_set(True)
-    print(vmd_path)
-
+    rigify_action=rigify_arm.animation_data.action if rigify_arm.animation_data else None
     if set_action_range:
         start_frame1=start_frame
         end_frame1=end_frame
     else:
-        rigify_action=rigify_arm.animation_data.action
         if rigify_action ==None:
             return(False)
         start_frame1=rigify_action.frame_range[0]
         end_frame1=rigify_action.frame_range[1]
 
+    if OT.native_writer:
+        mmd_blender_dict={}
+        for bone in mmd_arm.pose.bones:
+            name_j=bone.mmd_bone.name_j
+            if name_j in mmd_rigify_dict:
+                mmd_blender_dict[name_j]=bone.name
+        if OT.only_contain_keyframe and rigify_action==None:
+            alert_error("警告",'控制器没有动作')
+            return(False)
+        return export_vmd_native(OT,context,rigify_arm,mmd_arm,mmd_blender_dict,mmd_rigify_dict,start_frame1,end_frame1)
+
+    mmd_arm2=mmd_arm.copy()
+    context.collection.objects.link(mmd_arm2)
+    bpy.ops.object.select_all(action='DESELECT')
+    bpy.context.view_layer.objects.active=mmd_arm2
+    mmd_arm2.select_set(True)
+    print(vmd_path)
+
     bpy.ops.object.mode_set(mode = 'POSE')
     bpy.ops.pose.select_all(action='SELECT')
 
@@ -1087,47 +1552,7 @@ def export_vmd(OT,context):
 
         mmd_bone=mmd_arm2.pose.bones[blender_name]
 
-        keyframe_data_list=['co','interpolation','handle_left','handle_left_type','handle_right','handle_right_type']
-
-        keyframe_set=set()
-        bezier_L_dict={}
-        bezier_R_dict={}
-        def gather_data(bone_name,attr_name):
-            bone=rigify_arm.pose.bones[bone_name]
-            path=bone.path_from_id(attr_name)
-            fcurve=fcurves1.find(path,index=0)
-            if fcurve:
-                keyframe_points=fcurve.keyframe_points
-                #先录入第一个关键帧的数据
-                kp0=keyframe_points[0]
-                x0=int(kp0.co[0])
-                keyframe_set.add(x0)
-                #反向计算mmd控制柄
-                for i in range(len(keyframe_points)-1):
-                    kp0=keyframe_points[i]
-                    kp1=keyframe_points[i+1]
-                    x0=int(kp0.co[0])
-                    x1=int(kp1.co[0])
-                    keyframe_set.add(x1)
-                    if kp0.interpolation=='BEZIER':
-                        d = (kp1.co - kp0.co)
-                        #防止除零
-                        if d[1]!=0:
-                            if x0 not in bezier_R_dict:
-                                bezier_R=kp0.handle_right-kp0.co
-                                bezier_R[0]/=d[0]
-                                bezier_R[1]/=d[1]
-                                bezier_R_dict[x0]=bezier_R
-
-                            if x1 not in bezier_L_dict:
-                                bezier_L=kp1.handle_left-kp0.co
-                                bezier_L[0]/=d[0]
-                                bezier_L[1]/=d[1]
-                                bezier_L_dict[x1]=bezier_L
-
-        for name in keyframe_bone_list:
-            gather_data(name,'location')
-            gather_data(name,'rotation_quaternion')
+        key_frames,bezier_L,bezier_R=get_key_bezier_array(rigify_arm,fcurves1,keyframe_bone_list)
 
         #清除烘焙的缩放曲线
         path=mmd_bone.path_from_id('scale')
@@ -1137,54 +1562,16 @@ def export_vmd(OT,context):
             if fcurve:
                 fcurves2.remove(fcurve)
 
-        
-        keyframe_points_set=set()
-        path=mmd_bone.path_from_id('rotation_quaternion')
-        for index in range(4):
-
-            fcurve=fcurves2.find(path,index=index)
-            if fcurve:
-                keyframe_points=fcurve.keyframe_points
-                keyframe_points_set.add(keyframe_points)
+        #只保留控制器有关键帧的帧,每条曲线整体重建
+        #keep only the controller keyframes, each curve is rebuilt in one pass
+        fcurve_data_list=[('rotation_quaternion',4),('location',3)]
+        for attr_name,attr_len in fcurve_data_list:
+            path=mmd_bone.path_from_id(attr_name)
+            for index in range(attr_len):
 
-        path=mmd_bone.path_from_id('location')
-        for index in range(3):
-
-            fcurve=fcurves2.find(path,index=index)
-            if fcurve:
-                keyframe_points=fcurve.keyframe_points
-                keyframe_points_set.add(keyframe_points)
-
-        for keyframe_points in keyframe_points_set:
-            i=0
-            keyframe_points_len=len(keyframe_points)
-            while i<keyframe_points_len:
-                keyframe=keyframe_points[i]
-                if int(keyframe.co[0]) not in keyframe_set:
-                    keyframe_points.remove(keyframe,fast=True)
-                    keyframe_points_len-=1
-                else:
-                    i+=1
-
-            fcurve.update()
-
-            for i in range(keyframe_points_len-1):
-                kp0=keyframe_points[i]
-                kp1=keyframe_points[i+1]
-                x0=int(kp0.co[0])
-                x1=int(kp1.co[0])
-                d = (kp1.co - kp0.co)
-                if x0 in bezier_R_dict:
-                    kp0.handle_right_type = 'FREE'
-                    kp0.interpolation = 'BEZIER'
-                    bezier=bezier_R_dict[x0]
-                    kp0.handle_right = kp0.co + bezier*d
-                else:
-                    kp0.interpolation = 'LINEAR'
-                if x1 in bezier_L_dict:
-                    kp1.handle_left_type = 'FREE'
-                    bezier=bezier_L_dict[x1]
-                    kp1.handle_left = kp0.co + bezier*d
+                fcurve=fcurves2.find(path,index=index)
+                if fcurve:
+                    fcurve_utils.prune_keyframes(fcurves2,fcurve,key_frames,bezier_R,bezier_L)
 
 
     if OT.only_contain_keyframe:
@@ -1198,6 +1585,135 @@ def export_vmd(OT,context):
 
     return(True)
 
+#批量导入时传给导入函数的参数,代替单个文件的操作器
+#per file arguments handed to the import functions instead of an operator
+class MotionJob:
+    def __init__(self,OT,filepath):
+        self.filepath=filepath
+        self.first_frame_as_rest_pose=OT.first_frame_as_rest_pose
+        self.vectorized=OT.vectorized
+        self.use_cache=OT.use_cache
+        self.native_reader=OT.native_reader
+        self.analytic_ik=OT.analytic_ik
+        self.animation_only=OT.animation_only
+
+motion_ext_set={'.fbx','.bvh','.vmd'}
+
+#批量导入动作,目标骨骼的状态只计算一次,逐个文件记录耗时和错误
+#batch motion import, target state is computed once, each file reports its
+#own time and error instead of stopping the batch
+def batch_import_motion(OT,context):
+
+    scene=context.scene
+    mmr_property=scene.mmr_property
+    rigify_arm=context.view_layer.objects.active
+    debug=mmr_property.debug
+
+    if rigify_arm==None or rigify_arm.type!='ARMATURE':
+        alert_error('警告','所选物体不是骨骼')
+        return(False)
+
+    path_list=[]
+    for file in OT.files:
+        path=os.path.join(OT.directory,file.name)
+        if os.path.splitext(path)[1].lower() in motion_ext_set and os.path.isfile(path):
+            path_list.append(path)
+    #没有选择文件时导入整个文件夹
+    #no file selected, import the whole directory
+    if len(path_list)==0 and os.path.isdir(OT.directory):
+        for name in sorted(os.listdir(OT.directory)):
+            path=os.path.join(OT.directory,name)
+            if os.path.splitext(name)[1].lower() in motion_ext_set and os.path.isfile(path):
+                path_list.append(path)
+    if len(path_list)==0:
+        alert_error('警告','没有找到动作文件')
+        return(False)
+
+    rigify_arm.animation_data_create()
+    nla_track=None
+    if OT.placement=='SEQUENCE':
+        nla_track=rigify_arm.animation_data.nla_tracks.new()
+        nla_track.name='batch_track'
+    frame_start=scene.frame_current
+
+    mixamo_target=None
+    vmd_target=None
+    result_list=[]
+    batch_time=time.perf_counter()
+
+    #出错或中断时也删除准备好的骨骼
+    #the prepared rig is removed even when the batch fails or is interrupted
+    try:
+        for path in path_list:
+            ext=os.path.splitext(path)[1].lower()
+            job=MotionJob(OT,path)
+            start_time=time.perf_counter()
+            error=None
+            snapshot=get_data_snapshot()
+            with capture_alert() as messages:
+                try:
+                    if ext=='.vmd':
+                        if vmd_target==None:
+                            vmd_target=prepare_vmd_target(context,rigify_arm)
+                        succeed=load_vmd(job,context,vmd_target,nla_track,frame_start)
+                    else:
+                        if mixamo_target==None:
+                            mixamo_target=get_retarget_target(rigify_arm)
+                        succeed=retarget_mixmao(job,context,mixamo_target,nla_track,frame_start)
+                except Exception as e:
+                    traceback.print_exc()
+                    succeed=False
+                    error=repr(e)
+            if succeed!=True and error==None:
+                error=messages[-1][1] if messages else 'unknown error'
+            #失败的文件导入的骨骼和写了一半的动作也删除,准备好的骨骼和带伪用户的模板留给后面的文件
+            #a failed file also loses its imported armature and half written
+            #action, the prepared rig and the fake user templates stay for the
+            #files after it
+            if succeed!=True and debug==False:
+                keep_list=[vmd_target['rigify_arm2']] if vmd_target else []
+                bpy.data.batch_remove([data for data in get_new_data(snapshot) if data not in keep_list and data.use_fake_user==False])
+
+            #恢复选择,下一个文件仍然以控制器骨骼为准
+            #restore the selection for the next file
+            if context.object and context.object.mode!='OBJECT':
+                bpy.ops.object.mode_set(mode='OBJECT')
+            bpy.ops.object.select_all(action='DESELECT')
+            context.view_layer.objects.active=rigify_arm
+            rigify_arm.select_set(True)
+
+            if succeed==True and nla_track!=None and len(nla_track.strips)>0:
+                frame_start=int(nla_track.strips[-1].frame_end)+OT.gap
+
+            elapsed=time.perf_counter()-start_time
+            result_list.append((os.path.basename(path),succeed==True,elapsed,error))
+    finally:
+        if vmd_target and debug==False:
+            bpy.data.objects.remove(vmd_target['rigify_arm2'],do_unlink=True)
+    rigify_arm.animation_data.action_blend_type = 'COMBINE'
+
+    #写入报告
+    #write the report
+    report_lines=[]
+    fail_number=0
+    for name,succeed,elapsed,error in result_list:
+        if succeed:
+            report_lines.append('%s\t%.2fs\tOK'%(name,elapsed))
+        else:
+            fail_number+=1
+            report_lines.append('%s\t%.2fs\tFAILED: %s'%(name,elapsed,error))
+    report_lines.append('total %d files, %d failed, %.2fs'%(len(result_list),fail_number,time.perf_counter()-batch_time))
+    text=bpy.data.texts.get('MMR_batch_report')
+    if text==None:
+        text=bpy.data.texts.new('MMR_batch_report')
+    text.clear()
+    text.write('\n'.join(report_lines)+'\n')
+    for line in report_lines:
+        print(line)
+
+    alert_error("提示","批量导入完成:%d/%d,详见文本MMR_batch_report"%(len(result_list)-fail_number,len(result_list)))
+    return(True)
+
 class OT_Import_Mixamo(Operator, bpy_extras.io_utils.ImportHelper):
     bl_idname = "mmr.import_mixamo" 
     bl_label = "Import mixamo action"
@@ -1211,6 +1727,30 @@ class OT_Import_Mixamo(Operator, bpy_extras.io_utils.ImportHelper):
         description="First Frame As Rest Pose",
         default=False
     )
+
+    vectorized: bpy.props.BoolProperty(
+        name="Vectorized Retarget",
+        description="Retarget whole curves with NumPy instead of key by key",
+        default=True
+    )
+
+    use_cache: bpy.props.BoolProperty(
+        name="Use Retarget Cache",
+        description="Reuse the retarget solution saved for the same source rig, target rig and preset",
+        default=True
+    )
+
+    native_reader: bpy.props.BoolProperty(
+        name="Native BVH Reader",
+        description="Read BVH files directly instead of importing a temporary armature",
+        default=True
+    )
+
+    animation_only: bpy.props.BoolProperty(
+        name="Animation Only FBX",
+        description="Skip image search, custom normals and custom properties and remove the imported meshes, materials and images right away",
+        default=True
+    )
     
     def execute(self,context):
         retarget_mixmao(self,context)
@@ -1223,11 +1763,97 @@ class OT_Import_Vmd(Operator, bpy_extras.io_utils.ImportHelper):
     default='*.vmd;', 
     options={'HIDDEN'} 
     )
+
+    native_reader: bpy.props.BoolProperty(
+        name="Native VMD Reader",
+        description="Read the VMD file directly instead of importing it twice with mmd_tools",
+        default=True
+    )
+
+    analytic_ik: bpy.props.BoolProperty(
+        name="Analytic IK",
+        description="Solve the MMD leg IK with NumPy instead of baking a scratch scene frame by frame",
+        default=True
+    )
     
     def execute(self,context):
         load_vmd(self,context)
         return{"FINISHED"}
 
+class OT_Batch_Import_Motion(Operator, bpy_extras.io_utils.ImportHelper):
+    bl_idname = "mmr.batch_import_motion" 
+    bl_label = "Batch import motion"
+    filter_glob: bpy.props.StringProperty( 
+    default='*.fbx;*.bvh;*.vmd;', 
+    options={'HIDDEN'} 
+    )
+
+    files: bpy.props.CollectionProperty(
+        type=bpy.types.OperatorFileListElement,
+        options={'HIDDEN','SKIP_SAVE'}
+    )
+
+    directory: bpy.props.StringProperty(
+        subtype='DIR_PATH',
+        options={'HIDDEN'}
+    )
+
+    placement: bpy.props.EnumProperty(
+        name="Placement",
+        items=[
+            ('SEQUENCE','Sequence','Place the clips one after another on one track'),
+            ('STACK','Stack','Place every clip on its own track at the current frame'),
+        ],
+        default='SEQUENCE'
+    )
+
+    gap: bpy.props.IntProperty(
+        name="Gap",
+        description="Frames between two clips",
+        default=0,
+        min=0
+    )
+
+    first_frame_as_rest_pose: bpy.props.BoolProperty(
+        name="First Frame As Rest Pose",
+        description="First Frame As Rest Pose",
+        default=False
+    )
+
+    vectorized: bpy.props.BoolProperty(
+        name="Vectorized Retarget",
+        description="Retarget whole curves with NumPy instead of key by key",
+        default=True
+    )
+
+    use_cache: bpy.props.BoolProperty(
+        name="Use Retarget Cache",
+        description="Reuse the retarget solution saved for the same source rig, target rig and preset",
+        default=True
+    )
+
+    native_reader: bpy.props.BoolProperty(
+        name="Native Reader",
+        description="Read VMD and BVH files directly instead of importing them with mmd_tools or the BVH importer",
+        default=True
+    )
+
+    animation_only: bpy.props.BoolProperty(
+        name="Animation Only FBX",
+        description="Skip image search, custom normals and custom properties and remove the imported meshes, materials and images right away",
+        default=True
+    )
+
+    analytic_ik: bpy.props.BoolProperty(
+        name="Analytic IK",
+        description="Solve the MMD leg IK with NumPy instead of baking a scratch scene frame by frame",
+        default=True
+    )
+    
+    def execute(self,context):
+        batch_import_motion(self,context)
+        return{"FINISHED"}
+
 class OT_Export_Vmd(Operator, bpy_extras.io_utils.ExportHelper):
     bl_idname = "mmr.export_vmd" 
     bl_label = "Export vmd action"
@@ -1274,8 +1900,14 @@ class OT_Export_Vmd(Operator, bpy_extras.io_utils.ExportHelper):
         default=False
     )
 
+    native_writer: bpy.props.BoolProperty(
+        name="Native VMD Writer",
+        description="Write the VMD file directly instead of baking a copy of the armature and exporting it with mmd_tools",
+        default=True
+    )
+
     def execute(self,context):
         export_vmd(self,context)
         return{"FINISHED"}
 
-Class_list=[OT_Import_Mixamo,OT_Import_Vmd,OT_Export_Vmd]
\ No newline at end of file
+Class_list=[OT_Import_Mixamo,OT_Import_Vmd,OT_Batch_Import_Motion,OT_Export_Vmd]
\ No newline at end of file
@@ -0,0 +1,130 @@
+import bpy
+import os
+import json
+import hashlib
+import numpy as np
+from . import preset
+
+#重定向解算缓存:每根骨骼的左乘右乘四元数和骨骼对应关系只与两套骨骼的静止姿态,
+#预设和是否以第一帧为静止姿态有关,算过一次就保存在控制器骨骼和磁盘上
+#retarget solution cache: the per bone left/right quaternions and the bone
+#mapping only depend on the two rest poses, the preset and first_frame_as_rest_pose,
+#so they are kept on the target rig and on disk once solved
+
+cache_name='retarget_cache.json'
+property_name='mmr_retarget_cache'
+#每个位置最多保存的解算数量
+#max solutions kept in each place
+max_rig_entry=8
+max_disk_entry=64
+
+disk_cache=None
+
+#磁盘缓存放在用户目录,插件目录可能只读,更新插件时也会被清空
+#作为扩展安装时使用扩展的用户目录,否则使用blender的用户数据目录,无法创建时返回空
+#disk caches live in the user directory since the add-on directory may be
+#read only and is wiped on update: the extension user directory when
+#installed as an extension, blender's user datafiles otherwise, empty when
+#it cannot be created
+def get_cache_dir():
+    package=__package__.rpartition('.')[0]
+    try:
+        return bpy.utils.extension_path_user(package,path='cache',create=True)
+    except ValueError:
+        return bpy.utils.user_resource('DATAFILES',path=os.path.join(package,'cache'),create=True)
+
+#矩阵取4位小数,去掉负零,避免浮点误差导致缓存失效
+#round to 4 decimals and drop negative zero so float noise keeps the key stable
+def hash_array(sha,array):
+    array=np.round(np.asarray(array,dtype=np.float64),4)+0.0
+    sha.update(array.tobytes())
+
+def hash_bones(sha,arm,use_pose):
+    bones=arm.data.bones
+    sha.update('\0'.join(bone.name for bone in bones).encode('utf-8'))
+    matrix=np.empty(len(bones)*16,dtype=np.float32)
+    bones.foreach_get('matrix_local',matrix)
+    hash_array(sha,matrix)
+    if use_pose:
+        pose_bones=arm.pose.bones
+        pose_bones.foreach_get('matrix',matrix)
+        hash_array(sha,matrix)
+    hash_array(sha,[tuple(row) for row in arm.matrix_world.to_3x3()])
+
+#源骨骼只有匹配到类型的骨骼参与解算
+#only the typed source bones take part in the solve
+def hash_source(sha,source,use_pose):
+    name_list=sorted(source['from_dict'].values())
+    sha.update('\0'.join(name_list).encode('utf-8'))
+    hash_array(sha,[[tuple(row) for row in source['matrix_local'][name]] for name in name_list])
+    if use_pose:
+        hash_array(sha,[[tuple(row) for row in source['matrix'][name]] for name in name_list])
+    hash_array(sha,[tuple(row) for row in source['matrix_world'].to_3x3()])
+
+#source为retarget.get_retarget_source或bvh.BvhMotion.get_retarget_source的结果
+#source comes from retarget.get_retarget_source or bvh.BvhMotion.get_retarget_source
+def get_key(source,rigify_arm,preset_name,preset_dict,first_frame_as_rest_pose):
+    sha=hashlib.sha1()
+    sha.update(json.dumps([preset_name,preset_dict,bool(first_frame_as_rest_pose)],sort_keys=True).encode('utf-8'))
+    hash_source(sha,source,first_frame_as_rest_pose)
+    sha.update(b'\1')
+    hash_bones(sha,rigify_arm,False)
+    sha.update(json.dumps(preset.get_bone_type_dict(rigify_arm),sort_keys=True).encode('utf-8'))
+    return sha.hexdigest()
+
+def read_disk():
+    global disk_cache
+    if disk_cache==None:
+        disk_cache={}
+        cache_dir=get_cache_dir()
+        cache_path=os.path.join(cache_dir,cache_name)
+        if cache_dir and os.path.exists(cache_path):
+            try:
+                with open(cache_path,'r',encoding='utf-8') as f:
+                    disk_cache=json.load(f)
+            except (OSError,ValueError):
+                disk_cache={}
+    return disk_cache
+
+def write_disk():
+    cache_dir=get_cache_dir()
+    if not cache_dir:
+        return
+    try:
+        with open(os.path.join(cache_dir,cache_name),'w',encoding='utf-8') as f:
+            json.dump(disk_cache,f)
+    except OSError as e:
+        print('retarget cache not saved: '+str(e))
+
+def read_rig(rigify_arm):
+    try:
+        return json.loads(rigify_arm.get(property_name,'{}'))
+    except ValueError:
+        return {}
+
+#超出数量时删除最早的解算
+#drop the oldest solutions when over the limit
+def put_entry(entry_dict,key,entry,max_entry):
+    entry_dict.pop(key,None)
+    entry_dict[key]=entry
+    while len(entry_dict)>max_entry:
+        del entry_dict[next(iter(entry_dict))]
+
+def load(rigify_arm,key):
+    entry=read_rig(rigify_arm).get(key)
+    if entry==None:
+        entry=read_disk().get(key)
+        #其他文件算过的解算也写入当前骨骼
+        #a solution found on disk is copied onto the rig as well
+        if entry!=None:
+            rig_dict=read_rig(rigify_arm)
+            put_entry(rig_dict,key,entry,max_rig_entry)
+            rigify_arm[property_name]=json.dumps(rig_dict)
+    return entry
+
+def save(rigify_arm,key,entry):
+    rig_dict=read_rig(rigify_arm)
+    put_entry(rig_dict,key,entry,max_rig_entry)
+    rigify_arm[property_name]=json.dumps(rig_dict)
+    put_entry(read_disk(),key,entry,max_disk_entry)
+    write_disk()
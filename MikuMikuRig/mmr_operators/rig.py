@@ -5,16 +5,15 @@ import mathutils
 from bpy.types import Operator
 from . import preset
 from . import extra
+from .alert import alert_error
+from . import trace
+from . import rig_cache
+from . import template
 
 def copy_bone_collections(source_bone: bpy.types.Bone, target_bone: bpy.types.Bone):
     for collection in source_bone.collections:
         collection.assign(target_bone)
 
-def alert_error(title,message):
-    def draw(self,context):
-        self.layout.label(text=str(message))
-    bpy.context.window_manager.popup_menu(draw,title=title,icon='ERROR')
-
 def check_arm():
     
     arm=bpy.context.view_layer.objects.active
@@ -123,17 +122,26 @@ def RIG2(context):
     global mmd_bones_list
     global rig_bones_list
 
-    area = bpy.context.area.type
-    context.area.type = 'VIEW_3D'
+    #后台运行时没有区域
+    #there is no area when blender runs in background
+    area=None
+    if context.area:
+        area = context.area.type
+        context.area.type = 'VIEW_3D'
+
+    #阶段计时
+    #stage tracing
+    tracer=trace.Tracer('RIG2',trace.is_enabled(context))
+    tracer.stage('prepare')
 
     mmd_arm=context.view_layer.objects.active
     extra.set_min_ik_loop(mmd_arm,10)
+    tracer.watch('mmd_arm',mmd_arm)
 
     scene=context.scene
     mmr_property=scene.mmr_property
 
     my_dir = os.path.dirname(os.path.realpath(__file__))
-    rigify_blend_file = os.path.join(my_dir, "MMR_Rig.blend")
 
     bpy.ops.object.mode_set(mode = 'OBJECT')
     bpy.ops.object.select_all(action='DESELECT')
@@ -144,22 +152,21 @@ def RIG2(context):
 
     #检查骨架
     if check_arm()==False:
+        tracer.finish('failed')
         return{False}
 
     #生成字典
     unconnect_bone=['spine']
     mmd_bones_list=mmd_arm.pose.bones.keys()
-    preset_dict={}
+    preset_dict=preset.get_bone_type_dict(mmd_arm)
     bpy.ops.object.mode_set(mode = 'EDIT')
-    for bone in mmd_arm.pose.bones:
-        name=bone.name
-        if bone.mmr_bone.bone_type !='None':
-            preset_dict[bone.mmr_bone.bone_type]=bone.name
-        if bone.mmr_bone.bone_type in unconnect_bone:
-            mmd_arm.data.edit_bones[name].use_connect = False
+    for bone_type in unconnect_bone:
+        if bone_type in preset_dict:
+            mmd_arm.data.edit_bones[preset_dict[bone_type]].use_connect = False
 
     bpy.ops.object.mode_set(mode = 'OBJECT')
 
+    tracer.stage('bend_bones')
     #添加骨骼弯曲
     def world_rotate(posebone_a,posebone_b,vector=(0,1,0),size=-0.2618):
 
@@ -184,16 +191,14 @@ def RIG2(context):
             world_rotate(posebone_a,posebone_b,order[2],order[3])
 
 
+    tracer.stage('load_library')
     #导入metarig骨骼
     #import metarig armature
     rigify_arm_name="MMR_Rig_relative3"
-    
-    with bpy.data.libraries.load(rigify_blend_file) as (data_from, data_to):
-        data_to.objects = [rigify_arm_name]
-
-    rigify_arm=data_to.objects[0]
-    context.collection.objects.link(rigify_arm)
+    rigify_arm=template.new_instance(context,rigify_arm_name)
+    tracer.watch('metarig',rigify_arm)
 
+    tracer.stage('detect_bend')
     #检测手指弯曲
     mmd_bones=mmd_arm.pose.bones
     rigify_bone=rigify_arm.pose.bones
@@ -233,6 +238,7 @@ def RIG2(context):
             bone=rigify_bone[name]
             bone.rigify_parameters.primary_rotation_axis='automatic'
 
+    tracer.stage('transform_apply')
     #自动缩放
     scale=(mmd_arm.pose.bones[preset_dict['spine.006']].head[2]*mmd_arm.scale[2])/(rigify_arm.pose.bones['spine.006'].head[2]*rigify_arm.scale[2])
     rigify_arm.scale*=scale
@@ -258,20 +264,21 @@ def RIG2(context):
     remain_bone=set(rigify_bones_list)
 
 
+    tracer.stage('match_bones')
     #新骨骼匹配方法
 
-    for bone in mmd_arm.pose.bones:
-        bone_type=bone.mmr_bone.bone_type
-        if bone_type!="None" and bone_type in rigify_bones_list:
+    for bone_type,name in preset_dict.items():
+        if bone_type in rigify_bones_list:
+            bone=mmd_bones[name]
             rigify_bone=rigify_arm.data.edit_bones[bone_type]
             if bone.mmr_bone.invert:
                 rigify_bone.tail=bone.head
             else:
                 rigify_bone.tail=bone.tail
 
-    for bone in mmd_arm.pose.bones:
-        bone_type=bone.mmr_bone.bone_type
-        if bone_type!="None" and bone_type in rigify_bones_list:
+    for bone_type,name in preset_dict.items():
+        if bone_type in rigify_bones_list:
+            bone=mmd_bones[name]
             rigify_bone=rigify_arm.data.edit_bones[bone_type]
             remain_bone.discard(bone_type)
             if bone.mmr_bone.invert: # 此处会导致骨骼消失
@@ -349,6 +356,7 @@ def RIG2(context):
             eye_R.name='eye.L'
             invert_eyes=True
 
+    tracer.stage('calculate_roll')
     #修正骨骼轴向
     positive_z_bone=[
         'shoulder.L','shoulder.R',
@@ -419,7 +427,9 @@ def RIG2(context):
 
     #生成控制器
     if mmr_property.debug:
-        bpy.context.area.type = area
+        if area:
+            bpy.context.area.type = area
+        tracer.finish('debug')
         return
 
     bpy.ops.object.mode_set(mode = 'OBJECT')
@@ -427,16 +437,31 @@ def RIG2(context):
     context.view_layer.objects.active=rigify_arm
     rigify_arm.select_set(True)
 
-    bpy.ops.armature.rigify_upgrade_layers()
-    # bpy.ops.pose.rigify_upgrade_face()
-
-    bpy.ops.pose.rigify_generate()
-    rig=context.view_layer.objects.active
+    #相同的metarig和选项直接使用缓存的骨骼
+    #reuse the cached rig for the same metarig and options
+    rig=None
+    if mmr_property.rig_cache:
+        tracer.stage('rig_cache')
+        cache_key=rig_cache.get_key(rigify_arm,mmr_property)
+        rig=rig_cache.load(context,cache_key)
+
+    if rig==None:
+        tracer.stage('rigify_upgrade_layers')
+        bpy.ops.armature.rigify_upgrade_layers()
+        # bpy.ops.pose.rigify_upgrade_face()
+
+        tracer.stage('rigify_generate')
+        bpy.ops.pose.rigify_generate()
+        rig=context.view_layer.objects.active
+        if mmr_property.rig_cache:
+            rig_cache.save(rig,cache_key)
+    tracer.watch('rig',rig)
 
     #删除无用骨架
-    bpy.data.objects.remove(rigify_arm,do_unlink=True)
+    template.remove(rigify_arm)
 
 
+    tracer.stage('adjust_controllers')
     #开始调整生成的控制器
     bpy.ops.object.select_all(action='DESELECT')
     bpy.context.view_layer.objects.active=mmd_arm
@@ -534,6 +559,7 @@ def RIG2(context):
         #rig.pose.bones['MCH-torso.parent'].mmd_bone.name_j='グルーブ'
         pass
 
+    tracer.stage('add_constraint')
     #添加约束
     #add constraint
 
@@ -701,6 +727,7 @@ def RIG2(context):
         c2.subtarget='ORG-forearm.R'
         mmd_arm.data.bones[preset_dict['ArmTwist_R']].hide=False'''
 
+    tracer.stage('write_preset')
     #写入MMR骨骼预设
     rigify_preset=preset.preset_dict_dict['retarget']['Rigify']
     preset.set_bone_type(rig.pose,rigify_preset)
@@ -708,6 +735,7 @@ def RIG2(context):
     bpy.ops.object.mode_set(mode = 'OBJECT')
     bpy.ops.object.select_all(action='DESELECT')
 
+    tracer.stage('collections_and_locks')
     #隐藏原骨架，把新骨架设为永远在前
     #hide old armature
     rig.show_in_front = True
@@ -792,8 +820,10 @@ def RIG2(context):
     bpy.context.view_layer.objects.active=rig
     rig.select_set(True)
     bpy.context.scene.tool_settings.transform_pivot_point = 'INDIVIDUAL_ORIGINS'
-    bpy.context.area.type = area
+    if area:
+        bpy.context.area.type = area
     logging.info("完成"+'匹配骨骼数:'+str(match_bone_nunber))
+    tracer.finish()
     alert_error("提示","完成"+'匹配骨骼数:'+str(match_bone_nunber))
     return(True)
 
@@ -0,0 +1,165 @@
+import bpy
+import os
+import json
+import hashlib
+import numpy as np
+from .retarget_cache import hash_array,get_cache_dir
+
+#生成骨骼缓存:rigify生成的结果只与匹配后的metarig和生成选项有关,
+#同一模型重复生成或共用骨架的多套服装时直接追加上次生成的骨骼
+#generated rig cache: the rigify result only depends on the fitted metarig and
+#the generate options, so re-rigging the same model (or outfits sharing one
+#skeleton) appends the previously generated rig instead of regenerating it
+
+my_dir = os.path.dirname(os.path.realpath(__file__))
+rigify_blend_file = os.path.join(my_dir, "MMR_Rig.blend")
+#缓存目录的最大大小,超出时删除最久未使用的骨骼
+#max size of the cache directory, least recently used rigs are removed beyond it
+max_cache_size=256*1024*1024
+option_list=['auto_shoulder','upper_body_controller','pole_target']
+
+#骨骼缓存和重定向缓存放在同一个用户目录下,无法创建时返回空
+#rigs are cached in the same user directory as the retarget cache, empty
+#when it cannot be created
+def get_rig_dir():
+    cache_dir=get_cache_dir()
+    if not cache_dir:
+        return ''
+    return os.path.join(cache_dir,'rig')
+
+def get_path(key):
+    return os.path.join(get_rig_dir(),key+'.blend')
+
+#在metarig完成匹配,删除拇指和设置轴向之后调用
+#called after the metarig is fitted, thumbs are removed and axes are chosen
+def get_key(rigify_arm,mmr_property):
+    sha=hashlib.sha1()
+    version=[bpy.app.version_string]
+    if os.path.exists(rigify_blend_file):
+        stat=os.stat(rigify_blend_file)
+        version+=[stat.st_size,int(stat.st_mtime)]
+    options={name:bool(getattr(mmr_property,name)) for name in option_list}
+    sha.update(json.dumps([version,options],sort_keys=True).encode('utf-8'))
+
+    bones=rigify_arm.data.bones
+    sha.update('\0'.join(bone.name+'\1'+(bone.parent.name if bone.parent else '')+'\1'+str(bone.use_connect) for bone in bones).encode('utf-8'))
+    #matrix_local包含了骨骼的扭转
+    #matrix_local also carries the roll
+    for name,size in (('head_local',3),('tail_local',3),('matrix_local',16)):
+        array=np.empty(len(bones)*size,dtype=np.float32)
+        bones.foreach_get(name,array)
+        hash_array(sha,array)
+    hash_array(sha,[tuple(row) for row in rigify_arm.matrix_world])
+
+    rigify_list=[]
+    for pose_bone in rigify_arm.pose.bones:
+        rigify_list.append([pose_bone.name,pose_bone.rigify_type,pose_bone.rigify_parameters.primary_rotation_axis])
+    sha.update(json.dumps(rigify_list).encode('utf-8'))
+    return sha.hexdigest()
+
+#删除最久未使用的缓存直到总大小低于上限
+#remove the least recently used rigs until the total size is under the limit
+def evict(keep_path=None):
+    rig_dir=get_rig_dir()
+    file_list=[]
+    for name in os.listdir(rig_dir):
+        if name.endswith('.blend'):
+            path=os.path.join(rig_dir,name)
+            stat=os.stat(path)
+            file_list.append([stat.st_mtime,stat.st_size,path])
+    file_list.sort()
+    total=sum(size for mtime,size,path in file_list)
+    for mtime,size,path in file_list:
+        if total<=max_cache_size:
+            break
+        if path==keep_path:
+            continue
+        try:
+            os.remove(path)
+            total-=size
+        except OSError:
+            pass
+
+#保存生成的骨骼和控制器形状集合
+#save the generated rig with its widget collections
+def save(rig,key):
+    widget_collections=set()
+    for pose_bone in rig.pose.bones:
+        if pose_bone.custom_shape:
+            widget_collections.update(pose_bone.custom_shape.users_collection)
+    id_set={rig,*widget_collections}
+    #rigify把界面脚本挂在生成的骨骼物体上(rig['rig_ui'])
+    #rigify attaches the UI script to the generated rig object as rig['rig_ui']
+    script=rig.get('rig_ui')
+    if isinstance(script,bpy.types.Text):
+        id_set.add(script)
+    if not get_rig_dir():
+        return
+    path=get_path(key)
+    temp_path=path+'.tmp'
+    try:
+        os.makedirs(get_rig_dir(),exist_ok=True)
+        bpy.data.libraries.write(temp_path,id_set,fake_user=True,compress=True)
+        os.replace(temp_path,path)
+        evict(path)
+    except (OSError,RuntimeError) as e:
+        print('rig cache not saved: '+str(e))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+#命中时追加骨骼并设为活动物体,未命中返回None
+#append the cached rig and make it active on a hit, None on a miss
+def load(context,key):
+    if not get_rig_dir():
+        return None
+    path=get_path(key)
+    if not os.path.exists(path):
+        return None
+    try:
+        with bpy.data.libraries.load(path) as (data_from, data_to):
+            data_to.objects = data_from.objects
+            data_to.collections = data_from.collections
+            data_to.texts = data_from.texts
+    except (OSError,RuntimeError) as e:
+        print('rig cache not loaded: '+str(e))
+        return None
+    rig=None
+    for obj in data_to.objects:
+        obj.use_fake_user=False
+        if obj.type=='ARMATURE':
+            rig=obj
+    if rig==None:
+        return None
+    context.collection.objects.link(rig)
+    rig.data.use_fake_user=False
+
+    #控制器形状集合和rigify一样隐藏
+    #widget collections are hidden as rigify does
+    for collection in data_to.collections:
+        collection.use_fake_user=False
+        if collection.name not in context.collection.children:
+            context.collection.children.link(collection)
+        collection.hide_viewport=True
+        collection.hide_render=True
+
+    #rigify生成的界面脚本作为注册的文本模块重新注册,与重新打开文件时blender注册它的方式相同
+    #the UI text rigify generated is registered again as a registered text
+    #module, the same way blender registers it when the file is reopened
+    for text in data_to.texts:
+        text.use_fake_user=False
+    script=rig.get('rig_ui')
+    if not isinstance(script,bpy.types.Text) and len(data_to.texts)>0:
+        script=data_to.texts[0]
+        rig['rig_ui']=script
+    if isinstance(script,bpy.types.Text):
+        script.use_module=True
+        script.as_module()
+
+    bpy.ops.object.select_all(action='DESELECT')
+    context.view_layer.objects.active=rig
+    rig.select_set(True)
+
+    #更新访问时间用于淘汰
+    #touch the file for eviction
+    os.utime(path)
+    return rig
@@ -0,0 +1,247 @@
+import math
+import struct
+
+#生成测试用的动作文件,不依赖bpy,可以在普通python中运行
+#writers for synthetic test clips, no bpy needed so they also run outside blender
+
+#mixamo命名的最小人形骨架:(名称,父级,偏移)
+#minimal mixamo named humanoid: (name,parent,offset in centimeters, Y up)
+bvh_skeleton=[
+    ('mixamorig:Hips',None,(0,100,0)),
+    ('mixamorig:Spine','mixamorig:Hips',(0,10,0)),
+    ('mixamorig:Spine1','mixamorig:Spine',(0,12,0)),
+    ('mixamorig:Spine2','mixamorig:Spine1',(0,12,0)),
+    ('mixamorig:Neck','mixamorig:Spine2',(0,15,0)),
+    ('mixamorig:Head','mixamorig:Neck',(0,10,0)),
+    ('mixamorig:LeftShoulder','mixamorig:Spine2',(6,12,0)),
+    ('mixamorig:LeftArm','mixamorig:LeftShoulder',(12,0,0)),
+    ('mixamorig:LeftForeArm','mixamorig:LeftArm',(27,0,0)),
+    ('mixamorig:LeftHand','mixamorig:LeftForeArm',(26,0,0)),
+    ('mixamorig:RightShoulder','mixamorig:Spine2',(-6,12,0)),
+    ('mixamorig:RightArm','mixamorig:RightShoulder',(-12,0,0)),
+    ('mixamorig:RightForeArm','mixamorig:RightArm',(-27,0,0)),
+    ('mixamorig:RightHand','mixamorig:RightForeArm',(-26,0,0)),
+    ('mixamorig:LeftUpLeg','mixamorig:Hips',(9,-5,0)),
+    ('mixamorig:LeftLeg','mixamorig:LeftUpLeg',(0,-42,0)),
+    ('mixamorig:LeftFoot','mixamorig:LeftLeg',(0,-42,0)),
+    ('mixamorig:LeftToeBase','mixamorig:LeftFoot',(0,-8,12)),
+    ('mixamorig:RightUpLeg','mixamorig:Hips',(-9,-5,0)),
+    ('mixamorig:RightLeg','mixamorig:RightUpLeg',(0,-42,0)),
+    ('mixamorig:RightFoot','mixamorig:RightLeg',(0,-42,0)),
+    ('mixamorig:RightToeBase','mixamorig:RightFoot',(0,-8,12)),
+]
+
+#与上面骨架对应的rigify骨骼:(名称,父级,头,尾),单位米,Z向上
+#rigify named target skeleton matching the one above: (name,parent,head,tail), meters, Z up
+rigify_skeleton=[
+    ('spine',None,(0,0,1.0),(0,0,1.1)),
+    ('spine.001','spine',(0,0,1.1),(0,0,1.22)),
+    ('spine.002','spine.001',(0,0,1.22),(0,0,1.34)),
+    ('spine.003','spine.002',(0,0,1.34),(0,0,1.49)),
+    ('spine.004','spine.003',(0,0,1.49),(0,0,1.59)),
+    ('spine.006','spine.004',(0,0,1.59),(0,0,1.8)),
+    ('shoulder.L','spine.003',(0.06,0,1.46),(0.18,0,1.46)),
+    ('upper_arm.L','shoulder.L',(0.18,0,1.46),(0.45,0,1.46)),
+    ('forearm.L','upper_arm.L',(0.45,0,1.46),(0.71,0,1.46)),
+    ('hand.L','forearm.L',(0.71,0,1.46),(0.8,0,1.46)),
+    ('shoulder.R','spine.003',(-0.06,0,1.46),(-0.18,0,1.46)),
+    ('upper_arm.R','shoulder.R',(-0.18,0,1.46),(-0.45,0,1.46)),
+    ('forearm.R','upper_arm.R',(-0.45,0,1.46),(-0.71,0,1.46)),
+    ('hand.R','forearm.R',(-0.71,0,1.46),(-0.8,0,1.46)),
+    ('thigh.L','spine',(0.09,0,0.95),(0.09,0,0.53)),
+    ('shin.L','thigh.L',(0.09,0,0.53),(0.09,0,0.11)),
+    ('foot.L','shin.L',(0.09,0,0.11),(0.09,-0.12,0.03)),
+    ('thigh.R','spine',(-0.09,0,0.95),(-0.09,0,0.53)),
+    ('shin.R','thigh.R',(-0.09,0,0.53),(-0.09,0,0.11)),
+    ('foot.R','shin.R',(-0.09,0,0.11),(-0.09,-0.12,0.03)),
+]
+
+#写入BVH,每个关节绕三轴做不同频率的正弦摆动
+#write a BVH where every joint swings on sine waves of different frequencies
+def write_bvh(filepath,frame_count,fps=30,skeleton=bvh_skeleton):
+    children={}
+    for name,parent,offset in skeleton:
+        children.setdefault(parent,[]).append((name,offset))
+
+    lines=['HIERARCHY']
+    joint_order=[]
+    def write_joint(name,offset,depth):
+        indent='\t'*depth
+        if depth==0:
+            lines.append('ROOT '+name)
+        else:
+            lines.append(indent+'JOINT '+name)
+        lines.append(indent+'{')
+        lines.append(indent+'\tOFFSET %.4f %.4f %.4f'%offset)
+        if depth==0:
+            lines.append(indent+'\tCHANNELS 6 Xposition Yposition Zposition Zrotation Xrotation Yrotation')
+        else:
+            lines.append(indent+'\tCHANNELS 3 Zrotation Xrotation Yrotation')
+        joint_order.append(name)
+        if name in children:
+            for child_name,child_offset in children[name]:
+                write_joint(child_name,child_offset,depth+1)
+        else:
+            lines.append(indent+'\tEnd Site')
+            lines.append(indent+'\t{')
+            lines.append(indent+'\t\tOFFSET 0.0000 5.0000 0.0000')
+            lines.append(indent+'\t}')
+        lines.append(indent+'}')
+    for name,offset in children[None]:
+        write_joint(name,offset,0)
+
+    lines.append('MOTION')
+    lines.append('Frames: %d'%frame_count)
+    lines.append('Frame Time: %.6f'%(1.0/fps))
+    for frame in range(frame_count):
+        t=frame/fps
+        values=[]
+        for i,name in enumerate(joint_order):
+            if i==0:
+                values+=[10*math.sin(t),100+2*math.sin(2*t),20*t]
+            values+=[
+                15*math.sin(t*(1+0.1*i)),
+                20*math.sin(t*(0.7+0.05*i)+1),
+                10*math.sin(t*(0.5+0.03*i)+2),
+            ]
+        lines.append(' '.join('%.4f'%value for value in values))
+
+    with open(filepath,'w') as f:
+        f.write('\n'.join(lines)+'\n')
+    return filepath
+
+vmd_bone_names=[
+    'センター','グルーブ','上半身','上半身2','首','頭',
+    '左肩','左腕','左ひじ','左手首','右肩','右腕','右ひじ','右手首',
+    '左足ＩＫ','右足ＩＫ','左つま先ＩＫ','右つま先ＩＫ',
+]
+
+#写入VMD,每隔key_step帧一个关键帧,插值为线性
+#write a VMD with a key every key_step frames and linear interpolation
+def write_vmd(filepath,frame_count,key_step=5,bone_names=vmd_bone_names,model_name='synthetic'):
+    linear=bytes((20,)*8+(107,)*8)
+    interpolation=linear*4
+    key_frames=list(range(0,frame_count,key_step))
+    with open(filepath,'wb') as f:
+        f.write(b'Vocaloid Motion Data 0002'.ljust(30,b'\0'))
+        f.write(model_name.encode('cp932')[:20].ljust(20,b'\0'))
+        f.write(struct.pack('<I',len(key_frames)*len(bone_names)))
+        for i,name in enumerate(bone_names):
+            raw_name=name.encode('cp932')[:15].ljust(15,b'\0')
+            for frame in key_frames:
+                t=frame/30.0
+                angle=0.3*math.sin(t+i)
+                location=(0.0,0.0,0.0)
+                if name.endswith('ＩＫ') or name=='センター':
+                    location=(math.sin(t+i),0.5*math.sin(2*t),math.cos(t+i))
+                f.write(raw_name)
+                f.write(struct.pack('<I3f4f',frame,*location,math.sin(angle/2),0.0,0.0,math.cos(angle/2)))
+                f.write(interpolation)
+        f.write(struct.pack('<I',0))
+    return filepath
+
+#MMD_JP预设命名的人形骨架:(名称,父级,头,尾),单位米,Z向上,-Y向前
+#MMD_JP preset named humanoid: (name,parent,head,tail), meters, Z up, -Y front
+def mmd_skeleton():
+    skeleton=[
+        ('全ての親',None,(0,0,0),(0,0,0.1)),
+        ('センター','全ての親',(0,0,0.75),(0,0,0.65)),
+        ('下半身','センター',(0,0,0.95),(0,0,0.82)),
+        ('上半身','センター',(0,0,0.95),(0,0,1.1)),
+        ('上半身3','上半身',(0,0,1.1),(0,0,1.2)),
+        ('上半身2','上半身3',(0,0,1.2),(0,0,1.38)),
+        ('首','上半身2',(0,0,1.38),(0,0,1.46)),
+        ('頭','首',(0,0,1.46),(0,0,1.6)),
+    ]
+    side_list=[]
+    side_list+=[
+        ('足','下半身',(0.08,0,0.85),(0.08,0,0.47)),
+        ('ひざ','足',(0.08,0,0.47),(0.08,0,0.08)),
+        ('足首','ひざ',(0.08,0,0.08),(0.08,-0.1,0.02)),
+        ('足先EX','足首',(0.08,-0.1,0.02),(0.08,-0.14,0.02)),
+        ('足ＩＫ','全ての親',(0.08,0,0.08),(0.08,0.1,0.08)),
+        ('つま先ＩＫ','足ＩＫ',(0.08,-0.1,0.02),(0.08,-0.1,-0.05)),
+        ('目','頭',(0.03,-0.08,1.52),(0.03,-0.12,1.52)),
+        ('肩','上半身2',(0.02,0,1.36),(0.15,0,1.34)),
+        ('腕','肩',(0.15,0,1.34),(0.38,0,1.18)),
+        ('腕捩','腕',(0.265,0,1.26),(0.3,0,1.235)),
+        ('ひじ','腕',(0.38,0,1.18),(0.58,0,1.04)),
+        ('手捩','ひじ',(0.48,0,1.11),(0.52,0,1.08)),
+        ('手首','ひじ',(0.58,0,1.04),(0.64,0,1.0)),
+    ]
+    #手指沿手臂方向伸直
+    #straight fingers along the arm direction
+    hand=(0.58,0,1.04)
+    direction=(0.82,0,-0.57)
+    finger_list=[('人指',-0.03),('中指',-0.01),('薬指',0.01),('小指',0.03)]
+    for finger,offset in finger_list:
+        point=[hand[0]+direction[0]*0.08,offset,hand[2]+direction[2]*0.08]
+        parent='手首'
+        for number,length in zip('１２３',(0.03,0.025,0.02)):
+            tail=(point[0]+direction[0]*length,point[1],point[2]+direction[2]*length)
+            side_list.append((finger+number,parent,tuple(point),tail))
+            parent=finger+number
+            point=list(tail)
+    thumb_direction=(0.6,-0.6,-0.5)
+    point=[hand[0]+direction[0]*0.02,-0.03,hand[2]+direction[2]*0.02]
+    parent='手首'
+    for number in '０１２':
+        tail=tuple(point[i]+thumb_direction[i]*0.03 for i in range(3))
+        side_list.append(('親指'+number,parent,tuple(point),tail))
+        parent='親指'+number
+        point=list(tail)
+
+    side_name_set={name for name,parent,head,tail in side_list}
+    for suffix,sign in (('.L',1),('.R',-1)):
+        for name,parent,head,tail in side_list:
+            if parent in side_name_set:
+                parent=parent+suffix
+            skeleton.append((name+suffix,parent,(head[0]*sign,head[1],head[2]),(tail[0]*sign,tail[1],tail[2])))
+    return skeleton
+
+#blender骨骼名称转回MMD日文名,足.L -> 左足
+#blender bone name back to the MMD japanese name, 足.L -> 左足
+def mmd_name_j(name):
+    if name.endswith('.L'):
+        return '左'+name[:-2]
+    if name.endswith('.R'):
+        return '右'+name[:-2]
+    return name
+
+#裙子骨骼,columns列围成一圈,每列rows节,挂在下半身上
+#skirt bones, columns chains around the hips with rows bones each, under 下半身
+def skirt_skeleton(columns,rows,parent='下半身',top=0.9,length=0.4,radius=0.12,flare=0.1):
+    def point(angle,row):
+        r=radius+flare*row/rows
+        return (r*math.sin(angle),-r*math.cos(angle),top-length*row/rows)
+    skeleton=[]
+    for column in range(columns):
+        angle=2*math.pi*column/columns
+        chain_parent=parent
+        for row in range(rows):
+            name='skirt_%02d_%02d'%(column,row)
+            skeleton.append((name,chain_parent,point(angle,row),point(angle,row+1)))
+            chain_parent=name
+    return skeleton
+
+#裙子网格,每根骨骼subdivision*subdivision个面,顶点权重给最近的骨骼
+#skirt mesh with subdivision*subdivision faces per bone, each vertex is
+#weighted to the bone that covers it, returns (verts,faces,vertex_bone_names)
+def skirt_mesh(columns,rows,subdivision=4,top=0.9,length=0.4,radius=0.13,flare=0.1):
+    ring=columns*subdivision
+    height=rows*subdivision
+    verts=[]
+    vertex_bone_names=[]
+    for j in range(height+1):
+        r=radius+flare*j/height
+        z=top-length*j/height
+        for i in range(ring):
+            angle=2*math.pi*i/ring
+            verts.append((r*math.sin(angle),-r*math.cos(angle),z))
+            vertex_bone_names.append('skirt_%02d_%02d'%(i//subdivision,min(j//subdivision,rows-1)))
+    faces=[]
+    for j in range(height):
+        for i in range(ring):
+            i2=(i+1)%ring
+            faces.append((j*ring+i,j*ring+i2,(j+1)*ring+i2,(j+1)*ring+i))
+    return verts,faces,vertex_bone_names
@@ -0,0 +1,75 @@
+import bpy
+import os
+
+#模板骨架:每个会话只从插件目录的blend文件读取一次,保存为隐藏并带伪用户的数据块,
+#之后每次使用都复制一份,避免批量绑定和批量导入时重复读取文件
+#template armatures: each asset is read from the add-on blend files once per
+#session into a hidden datablock with a fake user, every use then gets a copy
+#so batch rigging and batch import stop paying the library I/O per item
+
+my_dir = os.path.dirname(os.path.realpath(__file__))
+prefix='.MMR_template_'
+stamp_name='mmr_template_stamp'
+
+#模板名:所在的blend文件
+#template name: the blend file it lives in
+template_file_dict={
+    'MMR_Rig_relative3':'MMR_Rig.blend',
+    'mmd_leg':'MMD_leg.blend',
+}
+
+#文件大小和修改时间,插件文件更新后模板失效
+#file size and mtime, the template is invalidated when the add-on file changes
+def get_stamp(path):
+    stat=os.stat(path)
+    return '%d:%d'%(stat.st_size,stat.st_mtime_ns)
+
+def get_template(name):
+    path=os.path.join(my_dir,template_file_dict[name])
+    stamp=get_stamp(path)
+
+    #每次按名称查找,不保存物体引用,打开文件和撤销后旧的引用可能失效
+    #打开保存过模板的文件时直接使用文件里的模板
+    #looked up by name every time, object references are not kept since they
+    #can go stale after a file load or undo, a file saved with a template in
+    #it is reused after reopening
+    obj=bpy.data.objects.get(prefix+name)
+    if obj==None or obj.get(stamp_name)!=stamp:
+        if obj!=None:
+            remove(obj)
+        with bpy.data.libraries.load(path) as (data_from, data_to):
+            data_to.objects = [name]
+        obj=data_to.objects[0]
+        obj.name=prefix+name
+        obj.data.name=prefix+name
+        obj[stamp_name]=stamp
+        obj.use_fake_user=True
+        obj.data.use_fake_user=True
+    return obj
+
+#复制模板和骨架数据并链接到当前集合或指定的集合
+#copy the template with its armature data and link it to the active
+#collection, or to the given one
+def new_instance(context,name,collection=None):
+    template=get_template(name)
+    obj=template.copy()
+    obj.data=template.data.copy()
+    obj.use_fake_user=False
+    obj.data.use_fake_user=False
+    del obj[stamp_name]
+    obj.name=name
+    obj.data.name=name
+    if collection==None:
+        collection=context.collection
+    collection.objects.link(obj)
+    return obj
+
+#删除复制的骨架及其数据
+#remove an instance together with its armature data
+def remove(obj):
+    data=obj.data
+    bpy.data.objects.remove(obj,do_unlink=True)
+    if data!=None:
+        data.use_fake_user=False
+        if data.users==0:
+            bpy.data.armatures.remove(data)
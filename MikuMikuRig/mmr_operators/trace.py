@@ -0,0 +1,129 @@
+import bpy
+import os
+import json
+import time
+import bpy_extras
+from bpy.types import Operator
+
+#阶段计时,由debug属性或环境变量MMR_TRACE开启
+#MMR_TRACE=1只记录,MMR_TRACE=文件路径时同时写入JSON
+#stage tracing, enabled by the debug property or the MMR_TRACE environment
+#variable, MMR_TRACE=1 only records, MMR_TRACE=<file path> also dumps JSON
+trace_env='MMR_TRACE'
+data_name_list=['objects','armatures','meshes','actions','collections','libraries']
+
+#最近一次记录,显示在关于面板
+#the latest trace, shown in the About panel
+last_trace=None
+
+def is_enabled(context=None):
+    if os.environ.get(trace_env,'') not in ('','0'):
+        return True
+    context=context or bpy.context
+    mmr_property=getattr(context.scene,'mmr_property',None)
+    return bool(mmr_property and mmr_property.debug)
+
+def count_data():
+    return {name:len(getattr(bpy.data,name)) for name in data_name_list}
+
+def count_arm(obj):
+    return {
+        'bones':len(obj.data.bones),
+        'constraints':sum(len(pose_bone.constraints) for pose_bone in obj.pose.bones),
+    }
+
+class Tracer:
+    def __init__(self,name,enabled=True):
+        self.name=name
+        self.enabled=enabled
+        self.stage_list=[]
+        self.watch_dict={}
+        self.stage_name=None
+        self.start_time=time.perf_counter()
+        self.stage_start=self.start_time
+
+    #记录骨骼对象的骨骼数和约束数
+    #count the bones and constraints of this armature after every stage
+    def watch(self,label,obj):
+        if self.enabled:
+            self.watch_dict[label]=obj
+
+    #结束上一阶段,开始新阶段
+    #end the current stage and start the next one
+    def stage(self,name):
+        if not self.enabled:
+            return
+        self.end_stage()
+        self.stage_name=name
+        self.stage_start=time.perf_counter()
+
+    def end_stage(self):
+        if self.stage_name==None:
+            return
+        seconds=time.perf_counter()-self.stage_start
+        arm_dict={}
+        for label,obj in list(self.watch_dict.items()):
+            try:
+                arm_dict[label]=count_arm(obj)
+            except ReferenceError:
+                #对象已被删除
+                #the object was removed during the stage
+                del self.watch_dict[label]
+        self.stage_list.append({'name':self.stage_name,'seconds':seconds,'data':count_data(),'armatures':arm_dict})
+        self.stage_name=None
+
+    def finish(self,status='done'):
+        global last_trace
+        if not self.enabled:
+            return None
+        self.end_stage()
+        last_trace={
+            'name':self.name,
+            'status':status,
+            'date':time.strftime('%Y-%m-%d %H:%M:%S'),
+            'blender':bpy.app.version_string,
+            'seconds':time.perf_counter()-self.start_time,
+            'stages':self.stage_list,
+        }
+        for line in summary_lines(last_trace):
+            print(line)
+        path=os.environ.get(trace_env,'')
+        if path not in ('','0','1'):
+            dump(last_trace,path)
+        return last_trace
+
+def summary_lines(trace_data):
+    total=max(trace_data['seconds'],1e-9)
+    lines=['%s %s %.2fs'%(trace_data['name'],trace_data['status'],trace_data['seconds'])]
+    for stage in trace_data['stages']:
+        lines.append('%s %.2fs %d%%'%(stage['name'],stage['seconds'],round(stage['seconds']*100/total)))
+    return lines
+
+def dump(trace_data,path):
+    try:
+        with open(path,'w',encoding='utf-8') as f:
+            json.dump(trace_data,f,indent=4,ensure_ascii=False)
+        print('trace written to '+path)
+    except OSError as e:
+        print('trace not saved: '+str(e))
+
+class OT_Save_Trace(Operator, bpy_extras.io_utils.ExportHelper):
+    bl_idname = "mmr.save_trace"
+    bl_label = "Save trace"
+
+    filename_ext = ".json"
+
+    filter_glob: bpy.props.StringProperty(
+    default='*.json;',
+    options={'HIDDEN'}
+    )
+
+    @classmethod
+    def poll(cls, context):
+        return last_trace!=None
+
+    def execute(self,context):
+        dump(last_trace,self.filepath)
+        return{"FINISHED"}
+
+Class_list=[OT_Save_Trace]
@@ -0,0 +1,171 @@
+import numpy as np
+
+#批量四元数运算
+#四元数数组格式为(...,4),顺序为(w,x,y,z),与mathutils一致
+#vectorized quaternion math, arrays are (...,4) in (w,x,y,z) order like mathutils
+
+def quaternion_multiply(a,b):
+    a=np.asarray(a,dtype=np.float64)
+    b=np.asarray(b,dtype=np.float64)
+    aw,ax,ay,az=a[...,0],a[...,1],a[...,2],a[...,3]
+    bw,bx,by,bz=b[...,0],b[...,1],b[...,2],b[...,3]
+    return np.stack((
+        aw*bw-ax*bx-ay*by-az*bz,
+        aw*bx+ax*bw+ay*bz-az*by,
+        aw*by-ax*bz+ay*bw+az*bx,
+        aw*bz+ax*by-ay*bx+az*bw,
+    ),axis=-1)
+
+def quaternion_conjugate(q):
+    q=np.array(q,dtype=np.float64)
+    q[...,1:]*=-1
+    return q
+
+def quaternion_normalize(q):
+    q=np.asarray(q,dtype=np.float64)
+    length=np.linalg.norm(q,axis=-1,keepdims=True)
+    length[length==0]=1
+    return q/length
+
+#左乘矩阵:q_l @ x 等于 left_matrix(q_l) @ x
+def left_matrix(q):
+    w,x,y,z=q
+    return np.array([
+        (w,-x,-y,-z),
+        (x, w,-z, y),
+        (y, z, w,-x),
+        (z,-y, x, w),
+    ],dtype=np.float64)
+
+#右乘矩阵:x @ q_r 等于 right_matrix(q_r) @ x
+def right_matrix(q):
+    w,x,y,z=q
+    return np.array([
+        (w,-x,-y,-z),
+        (x, w, z,-y),
+        (y,-z, w, x),
+        (z, y,-x, w),
+    ],dtype=np.float64)
+
+#q_l @ x @ q_r 合并为一个4x4矩阵,整段动作只需一次矩阵乘法
+#combine q_l @ x @ q_r into one 4x4 matrix
+def sandwich_matrix(q_l,q_r):
+    return left_matrix(q_l) @ right_matrix(q_r)
+
+def axis_quaternion(angle,axis):
+    q=np.zeros(angle.shape+(4,),dtype=np.float64)
+    half=np.asarray(angle,dtype=np.float64)*0.5
+    q[...,0]=np.cos(half)
+    q[...,1+axis]=np.sin(half)
+    return q
+
+#欧拉角转四元数,支持所有旋转顺序
+#order 'XYZ' 表示先绕X再绕Y最后绕Z,即 q = qz @ qy @ qx
+#euler to quaternion for every rotation order
+def euler_to_quaternion(euler,order='XYZ'):
+    euler=np.asarray(euler,dtype=np.float64)
+    axis_index={'X':0,'Y':1,'Z':2}
+    q=None
+    for axis_name in order:
+        axis=axis_index[axis_name]
+        q_axis=axis_quaternion(euler[...,axis],axis)
+        if q is None:
+            q=q_axis
+        else:
+            q=quaternion_multiply(q_axis,q)
+    return q
+
+#四元数旋转向量
+#rotate vectors by quaternions
+def quaternion_rotate(q,v):
+    q=np.asarray(q,dtype=np.float64)
+    v=np.asarray(v,dtype=np.float64)
+    u=q[...,1:]
+    w=q[...,:1]
+    t=2*np.cross(u,v)
+    return v+w*t+np.cross(u,t)
+
+#四元数数组转3x3矩阵数组
+def quaternion_to_matrix(q):
+    q=quaternion_normalize(q)
+    w,x,y,z=q[...,0],q[...,1],q[...,2],q[...,3]
+    mat=np.empty(q.shape[:-1]+(3,3),dtype=np.float64)
+    mat[...,0,0]=1-2*(y*y+z*z)
+    mat[...,0,1]=2*(x*y-z*w)
+    mat[...,0,2]=2*(x*z+y*w)
+    mat[...,1,0]=2*(x*y+z*w)
+    mat[...,1,1]=1-2*(x*x+z*z)
+    mat[...,1,2]=2*(y*z-x*w)
+    mat[...,2,0]=2*(x*z-y*w)
+    mat[...,2,1]=2*(y*z+x*w)
+    mat[...,2,2]=1-2*(x*x+y*y)
+    return mat
+
+#3x3矩阵数组转四元数,按最大的对角组合求解以保证精度,w不小于0
+#3x3 rotation matrices to quaternions, solved from the largest diagonal
+#combination for precision, w >= 0
+def matrix_to_quaternion(mat):
+    mat=np.asarray(mat,dtype=np.float64)
+    m=[[mat[...,i,j] for j in range(3)] for i in range(3)]
+    trace=np.stack((
+        1+m[0][0]+m[1][1]+m[2][2],
+        1+m[0][0]-m[1][1]-m[2][2],
+        1-m[0][0]+m[1][1]-m[2][2],
+        1-m[0][0]-m[1][1]+m[2][2],
+    ),axis=-1)
+    candidate=np.stack((
+        np.stack((trace[...,0],m[2][1]-m[1][2],m[0][2]-m[2][0],m[1][0]-m[0][1]),axis=-1),
+        np.stack((m[2][1]-m[1][2],trace[...,1],m[0][1]+m[1][0],m[0][2]+m[2][0]),axis=-1),
+        np.stack((m[0][2]-m[2][0],m[0][1]+m[1][0],trace[...,2],m[1][2]+m[2][1]),axis=-1),
+        np.stack((m[1][0]-m[0][1],m[0][2]+m[2][0],m[1][2]+m[2][1],trace[...,3]),axis=-1),
+    ),axis=-2)
+    best=np.argmax(trace,axis=-1)
+    q=np.take_along_axis(candidate,best[...,None,None],axis=-2)[...,0,:]
+    q=quaternion_normalize(q)
+    q*=np.where(q[...,:1]<0,-1,1)
+    return q
+
+#让相邻四元数保持在同一半球,防止插值时绕远路
+#keep neighbouring quaternions in the same hemisphere
+def quaternion_make_continuous(q):
+    q=np.array(q,dtype=np.float64)
+    if len(q)<2:
+        return q
+    dot=np.einsum('ij,ij->i',q[1:],q[:-1])
+    flip=np.cumsum(dot<0)%2==1
+    q[1:][flip]*=-1
+    return q
+
+#批量球面插值,t为(n,)
+#vectorized slerp, t has shape (n,)
+def quaternion_slerp(q0,q1,t):
+    q0=np.asarray(q0,dtype=np.float64)
+    q1=np.array(q1,dtype=np.float64)
+    t=np.asarray(t,dtype=np.float64)[...,None]
+    dot=np.sum(q0*q1,axis=-1,keepdims=True)
+    q1=np.where(dot<0,-q1,q1)
+    dot=np.clip(np.abs(dot),0,1)
+    theta=np.arccos(dot)
+    sin_theta=np.sin(theta)
+    small=sin_theta<1e-6
+    safe_sin=np.where(small,1,sin_theta)
+    w0=np.where(small,1-t,np.sin((1-t)*theta)/safe_sin)
+    w1=np.where(small,t,np.sin(t*theta)/safe_sin)
+    return quaternion_normalize(w0*q0+w1*q1)
+
+#从a转到b的最短弧四元数
+#shortest arc quaternion rotating direction a onto direction b
+def quaternion_rotation_difference(a,b,fallback_axis=(1,0,0)):
+    a=np.asarray(a,dtype=np.float64)
+    b=np.asarray(b,dtype=np.float64)
+    a=a/np.maximum(np.linalg.norm(a,axis=-1,keepdims=True),1e-12)
+    b=b/np.maximum(np.linalg.norm(b,axis=-1,keepdims=True),1e-12)
+    q=np.empty(np.broadcast(a,b).shape[:-1]+(4,),dtype=np.float64)
+    q[...,0]=1+np.sum(a*b,axis=-1)
+    q[...,1:]=np.cross(a,b)
+    opposite=q[...,0]<1e-8
+    if np.any(opposite):
+        axis=np.broadcast_to(np.asarray(fallback_axis,dtype=np.float64),q[...,1:].shape)
+        q[...,0]=np.where(opposite,0,q[...,0])
+        q[...,1:]=np.where(opposite[...,None],axis,q[...,1:])
+    return quaternion_normalize(q)
@@ -0,0 +1,273 @@
+import bpy
+import mmap
+import numpy as np
+from . import vector_math
+from . import fcurve_utils
+
+#VMD文件格式
+#VMD file layout
+vmd_signature_new=b'Vocaloid Motion Data 0002'
+vmd_signature_old=b'Vocaloid Motion Data file'
+
+bone_frame_dtype=np.dtype([
+    ('name','S15'),
+    ('frame','<u4'),
+    ('location','<f4',(3,)),
+    ('rotation','<f4',(4,)),
+    ('interpolation','u1',(64,)),
+])
+morph_frame_dtype=np.dtype([
+    ('name','S15'),
+    ('frame','<u4'),
+    ('weight','<f4'),
+])
+count_dtype=np.dtype('<u4')
+
+#VMD名称以\0结尾,之后可能是垃圾数据
+#names end with \0, the rest of the field may be garbage
+def decode_name(raw_name):
+    return raw_name.split(b'\0')[0].decode('cp932',errors='replace')
+
+#按名称分组记录,同一帧重复时保留最后一个
+#group records by name without creating per-record objects,
+#duplicated frames keep the last record
+def group_by_name(records):
+    if len(records)==0:
+        return {}
+    raw_names,inverse=np.unique(records['name'],return_inverse=True)
+    name_id_dict={}
+    raw_to_id=np.empty(len(raw_names),dtype=np.int64)
+    for i,raw_name in enumerate(raw_names):
+        raw_to_id[i]=name_id_dict.setdefault(decode_name(raw_name),len(name_id_dict))
+    ids=raw_to_id[inverse.ravel()]
+    frames=records['frame']
+    order=np.lexsort((np.arange(len(records)),frames,ids))
+    ids=ids[order]
+    frames=frames[order]
+    keep=np.ones(len(order),dtype=bool)
+    keep[:-1]=(ids[1:]!=ids[:-1])|(frames[1:]!=frames[:-1])
+    order=order[keep]
+    ids=ids[keep]
+    starts=np.flatnonzero(np.r_[True,ids[1:]!=ids[:-1]])
+    ends=np.r_[starts[1:],len(ids)]
+    track_dict={}
+    for name,name_id in name_id_dict.items():
+        i=np.searchsorted(ids[starts],name_id)
+        track_dict[name]=order[starts[i]:ends[i]]
+    return track_dict
+
+class VmdMotion:
+
+    #内存映射读取,记录数组一次复制出来后立即关闭映射和文件
+    #memory-map the file, the record arrays are copied out in one pass and
+    #the mapping and the file are closed right away
+    def __init__(self,filepath):
+        with open(filepath,'rb') as f,mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as buffer:
+            self.read(filepath,buffer)
+        self.bone_tracks=group_by_name(self.bone_frames)
+        self.morph_tracks=group_by_name(self.morph_frames)
+
+    #解析文件内容,不保留对映射内存的引用,否则映射无法关闭
+    #parse the file, no reference into the mapping may survive or it cannot
+    #be closed
+    def read(self,filepath,buffer):
+        signature=buffer[:30]
+        if signature.startswith(vmd_signature_new):
+            offset=30+20
+        elif signature.startswith(vmd_signature_old):
+            offset=30+10
+        else:
+            raise ValueError('not a VMD file: '+str(filepath))
+        self.filepath=filepath
+        self.model_name=decode_name(buffer[30:offset])
+
+        bone_count=int(np.frombuffer(buffer,count_dtype,1,offset)[0])
+        offset+=count_dtype.itemsize
+        self.bone_frames=np.frombuffer(buffer,bone_frame_dtype,bone_count,offset).copy()
+        offset+=bone_frame_dtype.itemsize*bone_count
+
+        morph_count=0
+        if offset+count_dtype.itemsize<=len(buffer):
+            morph_count=int(np.frombuffer(buffer,count_dtype,1,offset)[0])
+            offset+=count_dtype.itemsize
+        self.morph_frames=np.frombuffer(buffer,morph_frame_dtype,morph_count,offset).copy()
+
+    def bone_track(self,name):
+        return self.bone_frames[self.bone_tracks[name]]
+
+    def morph_track(self,name):
+        return self.morph_frames[self.morph_tracks[name]]
+
+    @property
+    def frame_range(self):
+        frames=self.bone_frames['frame']
+        if len(frames)==0:
+            return (0,0)
+        return (int(frames.min()),int(frames.max()))
+
+#骨骼对应的MMD日文名
+#japanese name of a pose bone, falls back to the bone name
+def get_name_j(pose_bone):
+    mmd_bone=getattr(pose_bone,'mmd_bone',None)
+    if mmd_bone is not None and mmd_bone.name_j:
+        return mmd_bone.name_j
+    return pose_bone.name
+
+#MMD坐标到骨骼局部坐标的矩阵,与mmd_tools的BoneConverter一致
+#matrix from mmd space to bone local space, same as mmd_tools' BoneConverter
+def get_convert_matrix(pose_bone,use_pose_mode=False):
+    if use_pose_mode:
+        mat=np.array(pose_bone.matrix.to_3x3())
+    else:
+        mat=np.array(pose_bone.bone.matrix_local.to_3x3())
+    mat[[1,2]]=mat[[2,1]]
+    return mat.T
+
+#把一条骨骼轨道转换为blender局部坐标
+#convert one bone track to blender local location and quaternion
+def convert_bone_track(track,pose_bone,scale=1.0,use_pose_mode=False):
+    mat=get_convert_matrix(pose_bone,use_pose_mode)
+
+    locations=track['location'].astype(np.float64) @ mat.T
+    locations*=scale
+
+    rotations=track['rotation'].astype(np.float64)
+    quaternions=np.empty((len(track),4),dtype=np.float64)
+    quaternions[:,0]=rotations[:,3]
+    quaternions[:,1:]=-(rotations[:,:3] @ mat.T)
+    quaternions=vector_math.quaternion_normalize(quaternions)
+
+    if use_pose_mode:
+        mat_rot=np.array(pose_bone.matrix_basis.to_3x3())
+        locations=locations @ mat_rot.T
+        locations+=np.array(pose_bone.location)
+        q_basis=np.array(pose_bone.matrix_basis.to_quaternion())
+        quaternions=vector_math.quaternion_multiply(q_basis,quaternions)
+
+    quaternions=vector_math.quaternion_make_continuous(quaternions)
+
+    #每个blender轴使用主要对应的MMD轴的插值
+    #each blender axis takes the interpolation of its dominant mmd axis
+    axis_list=np.abs(mat).argmax(axis=1)
+    return locations,quaternions,axis_list
+
+#取出归一化的插值控制柄,返回(n,4,4):[帧,(x1,y1,x2,y2),(X,Y,Z,R)]
+#normalized interpolation, shape (n,4,4): [key,(x1,y1,x2,y2),(X,Y,Z,R)]
+def get_interpolation(track):
+    return track['interpolation'][:,:16].reshape(-1,4,4)/127.0
+
+#把VMD骨骼动作直接写入动作曲线
+#write the VMD bone motion straight into the action's fcurves
+def apply_bone_motion(motion,arm,action_name,scale=1.0,use_pose_mode=False,margin=0):
+    action=bpy.data.actions.new(name=action_name)
+    arm.animation_data_create()
+    arm.animation_data.action=action
+    fcurves=action.fcurves
+
+    for pose_bone in arm.pose.bones:
+        name_j=get_name_j(pose_bone)
+        if name_j not in motion.bone_tracks:
+            continue
+        track=motion.bone_track(name_j)
+        #与mmd_tools一致,VMD第0帧对应blender第1帧
+        #same as mmd_tools, VMD frame 0 is blender frame 1
+        frames=track['frame'].astype(np.float64)+margin+1
+        locations,quaternions,axis_list=convert_bone_track(track,pose_bone,scale,use_pose_mode)
+        interpolation=get_interpolation(track)
+
+        path=pose_bone.path_from_id('location')
+        for index in range(3):
+            fcurve=fcurve_utils.new_fcurve(fcurves,path,index,pose_bone.name)
+            bezier=interpolation[:,:,axis_list[index]]
+            fcurve_utils.set_bezier_keyframes(fcurve,frames,locations[:,index],bezier)
+
+        path=pose_bone.path_from_id('rotation_quaternion')
+        bezier=interpolation[:,:,3]
+        for index in range(4):
+            fcurve=fcurve_utils.new_fcurve(fcurves,path,index,pose_bone.name)
+            fcurve_utils.set_bezier_keyframes(fcurve,frames,quaternions[:,index],bezier)
+
+    return action
+
+#线性插值的控制柄
+#control points of a linear interpolation
+linear_bezier=np.array((20,20,107,107),dtype=np.float64)/127.0
+
+#名称按cp932编码,截断时不能切开多字节字符
+#encode a name as cp932 without cutting a multi-byte character
+def encode_name(name,length):
+    raw_name=name.encode('cp932',errors='replace')[:length]
+    while raw_name:
+        try:
+            raw_name.decode('cp932')
+            break
+        except UnicodeDecodeError:
+            raw_name=raw_name[:-1]
+    return raw_name
+
+#把(n,4)的(x1,y1,x2,y2)控制柄打包为64字节插值,四个通道使用同一条曲线
+#pack (n,4) normalized (x1,y1,x2,y2) into the 64 byte interpolation,
+#all four channels share one curve
+def make_interpolation(bezier):
+    values=np.clip(np.rint(np.asarray(bezier,dtype=np.float64)*127),0,127).astype(np.uint8)
+    return np.tile(np.repeat(values,4,axis=1),(1,4))
+
+#blender局部坐标转换回MMD坐标,convert_bone_track的逆运算
+#blender local transform back to mmd space, the inverse of convert_bone_track
+#mat是(n,3,3)的转换矩阵,basis为姿态模式下的(位置,四元数)参考姿态
+#mat is (n,3,3), basis is the (location,quaternion) reference pose in pose mode
+def convert_to_vmd(locations,quaternions,mat,scale=1.0,basis=None):
+    locations=np.asarray(locations,dtype=np.float64)
+    quaternions=np.asarray(quaternions,dtype=np.float64)
+    if basis is not None:
+        basis_location,basis_quaternion=basis
+        basis_inverse=vector_math.quaternion_conjugate(basis_quaternion)
+        locations=vector_math.quaternion_rotate(basis_inverse,locations-basis_location)
+        quaternions=vector_math.quaternion_multiply(basis_inverse,quaternions)
+    mat_t=np.swapaxes(mat,-1,-2)
+    vmd_locations=np.einsum('nij,nj->ni',mat_t,locations)/scale
+    rotations=np.empty((len(quaternions),4),dtype=np.float64)
+    rotations[:,:3]=-np.einsum('nij,nj->ni',mat_t,quaternions[:,1:])
+    rotations[:,3]=quaternions[:,0]
+    return vmd_locations,rotations
+
+#流式写入VMD,骨骼帧逐批写入文件,结束时回填数量
+#streaming VMD writer, bone frames are written batch by batch and the
+#count is patched in when the file is closed
+class VmdWriter:
+
+    def __init__(self,filepath,model_name=''):
+        self.file=open(filepath,'wb')
+        self.file.write(vmd_signature_new.ljust(30,b'\0'))
+        self.file.write(encode_name(model_name,20).ljust(20,b'\0'))
+        self.count_offset=self.file.tell()
+        self.file.write(np.zeros(1,dtype=count_dtype).tobytes())
+        self.bone_count=0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def write_bone_frames(self,raw_names,frames,locations,rotations,interpolation=None):
+        records=np.zeros(len(frames),dtype=bone_frame_dtype)
+        records['name']=raw_names
+        records['frame']=frames
+        records['location']=locations
+        records['rotation']=rotations
+        if interpolation is None:
+            interpolation=make_interpolation(linear_bezier[None,:])
+        records['interpolation']=interpolation
+        self.file.write(records.tobytes())
+        self.bone_count+=len(records)
+
+    def close(self):
+        if self.file.closed:
+            return
+        #表情,镜头,灯光帧数量
+        #morph, camera and light frame counts
+        self.file.write(np.zeros(3,dtype=count_dtype).tobytes())
+        self.file.seek(self.count_offset)
+        self.file.write(np.array([self.bone_count],dtype=count_dtype).tobytes())
+        self.file.close()
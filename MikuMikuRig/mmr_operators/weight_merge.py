@@ -0,0 +1,56 @@
+import numpy as np
+
+#顶点组权重合并:只遍历一次网格,把需要的顶点组读成稀疏数组(顶点序号,权重),
+#用bincount一次求和,再按权重分桶批量写回,代替每个顶点组遍历一次所有顶点
+#vertex group weight merge: the mesh is walked once to read the needed groups
+#as sparse (vertex index, weight) arrays, summed with one bincount and written
+#back with one add() per weight bucket, instead of a pass over every vertex
+#for every source group
+
+#权重分桶的大小,写入的权重与求和结果最多相差半个桶
+#weight bucket size, a written weight is at most half a bucket off the sum
+weight_step=1/4096
+
+#读取所给顶点组的权重,返回顶点序号和权重数组
+#blender没有批量读取顶点组权重的接口,这里仍是逐顶点的python循环,只是整个网格只遍历一次
+#read the weights of the given group indices as vertex index and weight arrays
+#blender has no bulk accessor for deform weights, so this is still a python
+#loop over the vertices, it just runs once for the whole merge
+def read_weights(mesh,group_index_set):
+    vertex_list=[]
+    weight_list=[]
+    for vertex in mesh.vertices:
+        for element in vertex.groups:
+            if element.group in group_index_set:
+                vertex_list.append(vertex.index)
+                weight_list.append(element.weight)
+    return np.array(vertex_list,dtype=np.int64),np.array(weight_list,dtype=np.float64)
+
+#权重限制在0到1之间并分桶,每个桶调用一次add,最多4097次
+#weights are clamped to 0-1 and bucketed, one add() per bucket, 4097 at most
+def write_weights(vertex_group,vertex_index,weights):
+    if len(weights)==0:
+        return
+    buckets=np.rint(np.clip(weights,0,1)/weight_step).astype(np.int64)
+    order=np.argsort(buckets,kind='stable')
+    values,starts=np.unique(buckets[order],return_index=True)
+    for value,indices in zip(values.tolist(),np.split(vertex_index[order],starts[1:])):
+        vertex_group.add(indices.tolist(),value*weight_step,'REPLACE')
+
+#把多个顶点组的权重加到目标顶点组,目标组原有的权重保留并参与求和,返回写入的顶点数
+#add the weights of several groups onto the target group, weights already in
+#the target are kept in the sum, returns the number of vertices written
+def merge_weights(obj,from_group_list,to_group):
+    mesh=obj.data
+    from_index_set={vertex_group.index for vertex_group in from_group_list}
+    from_index_set.discard(to_group.index)
+    if len(from_index_set)==0:
+        return 0
+    vertex_index,weights=read_weights(mesh,from_index_set|{to_group.index})
+    if len(vertex_index)==0:
+        return 0
+    vertex_len=len(mesh.vertices)
+    total=np.bincount(vertex_index,weights,minlength=vertex_len)
+    touched=np.flatnonzero(np.bincount(vertex_index,minlength=vertex_len))
+    write_weights(to_group,touched,total[touched])
+    return len(touched)